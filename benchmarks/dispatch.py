@@ -0,0 +1,153 @@
+"""
+Dispatch throughput and latency benchmark. Runs the listener against a local fake Slack (RTM websocket and Web API
+on loopback) and feeds it a synthetic stream of commands: brews followed by bursts of `me`, mixed with stats,
+leaderboard and help. Latency is measured from the event timestamp to the end of its dispatch.
+
+    python -m benchmarks.dispatch [--events 5000] [--rate 0] [--workers 4] [--output results.json]
+"""
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import platform
+import random
+import time
+from threading import Lock, Thread
+
+from benchmarks.fake_slack import FakeRTM, FakeWebAPI
+from benchmarks.utils import TEABOT_SLACK_ID, setup_database, use_fake_slack
+from src import models, utils
+from src.app import Listener
+from src.conf import DISPATCH_WORKERS
+from src.metrics import LatencyTracker
+from src.slack_client import get_client
+
+CHANNELS = ['tearoom', 'kitchen', 'floor-2']
+READ_ONLY_COMMANDS = ['stats', 'stats week', 'leaderboard', 'leaderboard 5', 'help', 'ping']
+
+
+class BenchmarkListener(Listener):
+    def __init__(self, teabot, events, workers):
+        super(BenchmarkListener, self).__init__([teabot], workers=workers)
+        self.latencies = {}
+        self.completed = 0
+        self.stopped = False
+        self._lock = Lock()
+        self._events = events
+
+    def run(self):
+        try:
+            super(BenchmarkListener, self).run()
+        except Exception:
+            if not self.stopped:  # The fake RTM connection is closed once the benchmark is done
+                raise
+
+    def dispatch(self, event):
+        super(BenchmarkListener, self).dispatch(event)
+        latency = time.time() - float(event['ts'])
+        command = event['text'].split(' ')[1]
+        with self._lock:
+            if command not in self.latencies:
+                self.latencies[command] = LatencyTracker(window=self._events)
+            self.latencies[command].record(latency)
+            self.completed += 1
+
+
+def generate_commands(slack_ids):
+    """
+    Endless rounds of: someone brews in a channel, then a burst of `me` replies with some read-only commands
+    """
+    while True:
+        channel = random.choice(CHANNELS)
+        yield channel, random.choice(slack_ids), 'brew'
+        for _ in range(random.randint(3, 10)):
+            yield channel, random.choice(slack_ids), 'me'
+            if random.random() < 0.3:
+                yield random.choice(CHANNELS), random.choice(slack_ids), random.choice(READ_ONLY_COMMANDS)
+
+
+def run(events, rate, workers, users, countdown):
+    web_api = FakeWebAPI().start()
+    rtm = FakeRTM().start()
+
+    # Talk to the fake Web API, which has no rate limits, and make brews finish while the benchmark runs
+    use_fake_slack(web_api)
+    models.BREW_COUNTDOWN = countdown
+
+    teabot, slack_ids = setup_database(users)
+    get_client().server.connect_slack_websocket(rtm.url)
+    rtm.wait_for_client()
+
+    listener = BenchmarkListener(teabot, events, workers)
+    thread = Thread(target=listener.run)
+    thread.daemon = True
+    thread.start()
+
+    started = time.time()
+    for index, (channel, slack_id, command) in enumerate(itertools.islice(generate_commands(slack_ids), events)):
+        if rate:
+            time.sleep(max(0, started + float(index) / rate - time.time()))
+        rtm.send({
+            'type': 'message',
+            'channel': channel,
+            'user': slack_id,
+            'text': '<@%s> %s' % (TEABOT_SLACK_ID, command),
+            'ts': '%.6f' % time.time(),
+        })
+
+    while listener.completed < events:
+        time.sleep(0.01)
+    duration = time.time() - started
+    utils.sender.join()
+    listener.stopped = True
+    rtm.close()
+    web_api.shutdown()
+
+    return {
+        'started': started,
+        'python': platform.python_version(),
+        'events': events,
+        'rate': rate,
+        'workers': workers,
+        'duration': duration,
+        'throughput': events / duration,
+        'api_calls': dict(web_api.calls),
+        'commands': dict(
+            (command, {
+                'count': tracker.count,
+                'p50': tracker.percentile(50),
+                'p95': tracker.percentile(95),
+                'p99': tracker.percentile(99),
+            })
+            for command, tracker in listener.latencies.items()
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=0, help='events per second to send (0 sends them all at once)')
+    parser.add_argument('--workers', type=int, default=DISPATCH_WORKERS)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--countdown', type=float, default=1, help='seconds before a brew completes')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = run(args.events, args.rate, args.workers, args.users, args.countdown)
+
+    print('%d events in %.2fs: %.1f events/s' % (results['events'], results['duration'], results['throughput']))
+    print('%-15s %8s %10s %10s %10s' % ('command', 'count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for command, result in sorted(results['commands'].items()):
+        print('%-15s %8d %10.1f %10.1f %10.1f' % (
+            command, result['count'], result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+A local stand-in for Slack on the loopback interface: a Web API that accepts every call (with canned responses and
+delays for chosen methods) and an RTM websocket server that pushes events to a single client.
+"""
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import json
+import socket
+import struct
+import time
+from collections import Counter
+from threading import Lock, Thread
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class _WebAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like slack.com
+    # Send each response in one write without Nagle delays, otherwise the fake itself dominates the latency
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rsplit('/', 1)[-1]
+        self.server.record(method)
+
+        time.sleep(self.server.delays.get(method, 0))
+        body = json.dumps(self.server.responses.get(method, {'ok': True})).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeWebAPI(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responses=None, delays=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _WebAPIHandler)
+        self.url = 'http://127.0.0.1:%s/api/' % self.server_address[1]
+        self.responses = responses or {}  # method -> JSON response, {"ok": true} for the others
+        self.delays = delays or {}  # method -> seconds to wait before responding
+        self.calls = Counter()
+        self._lock = Lock()
+
+    def record(self, method):
+        with self._lock:
+            self.calls[method] += 1
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class FakeRTM(object):
+    """
+    Accepts one websocket connection (call `start` before connecting) and sends it JSON events as text frames
+    """
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(1)
+        self.url = 'ws://127.0.0.1:%s/' % self.socket.getsockname()[1]
+        self.client = None
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def wait_for_client(self, timeout=10):
+        self._thread.join(timeout)
+        return self.client is not None
+
+    def send(self, event):
+        payload = json.dumps(event).encode('utf-8')
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, len(payload))
+        elif len(payload) < 1 << 16:
+            header = struct.pack('!BBH', 0x81, 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x81, 127, len(payload))
+        self.client.sendall(header + payload)
+
+    def close(self):
+        if self.client:
+            self.client.close()
+        self.socket.close()
+
+    def _accept(self):
+        client, _ = self.socket.accept()
+        request = b''
+        while b'\r\n\r\n' not in request:
+            request += client.recv(4096)
+
+        headers = dict(
+            (name.lower(), value) for name, value in
+            (line.split(b': ', 1) for line in request.split(b'\r\n')[1:] if b': ' in line)
+        )
+        key = headers[b'sec-websocket-key'].strip().decode('ascii')
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest())
+        client.sendall(
+            b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n'
+        )
+        self.client = client
@@ -0,0 +1,130 @@
+"""
+Concurrent join benchmark. Starts a brew with a cup limit, then has several processes (each with several threads)
+join it at the same moment, some users more than once, the way a channel stampedes `@teabot me`. Reports the
+outcomes and checks that the brew never went over its limit and that nobody joined twice.
+
+It recreates the tables of a scratch database (see benchmarks/utils.py).
+
+    python -m benchmarks.joins [--joins 300] [--limit 10] [--processes 4] [--threads 8] [--duplicates 0.2]
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import random
+import sys
+import time
+from collections import Counter
+from threading import Lock, Thread
+
+from benchmarks.utils import setup_database
+from src.managers import ServerManager, UserManager
+from src.models import Customer, Server, Session, engine, get_session, unit_of_work
+
+CHANNEL = 'tearoom'
+
+
+def join(slack_id):
+    with unit_of_work():
+        user = UserManager.get_identity(slack_id)
+        joined = ServerManager.join(CHANNEL, user.id)
+    return {True: 'joined', False: 'duplicate', None: 'rejected'}[joined]
+
+
+def run_replica(start, slack_ids, threads, results):
+    # Forked processes must not share the parent's database connections
+    Session.remove()
+    engine.dispose()
+    outcomes = Counter()
+    lock = Lock()
+
+    def work(chunk):
+        start.wait()
+        for slack_id in chunk:
+            outcome = join(slack_id)
+            with lock:
+                outcomes[outcome] += 1
+
+    workers = [Thread(target=work, args=(slack_ids[index::threads],)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put(dict(outcomes))
+
+
+def run(joins, limit, processes, threads, duplicates):
+    _, slack_ids = setup_database(users=joins + 1)
+    server_slack_id, slack_ids = slack_ids[0], slack_ids[1:]
+    attempts = slack_ids + random.sample(slack_ids, int(len(slack_ids) * duplicates))
+    random.shuffle(attempts)
+
+    with unit_of_work() as session:
+        server = Server(user_id=UserManager.get_by_slack_id(server_slack_id).id, channel=CHANNEL, limit=limit or None)
+        session.add(server)
+        session.flush()
+        server_id = server.id
+
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    replicas = [
+        multiprocessing.Process(target=run_replica, args=(start, attempts[index::processes], threads, results))
+        for index in range(processes)
+    ]
+    for replica in replicas:
+        replica.start()
+
+    started = time.time()
+    start.set()
+    outcomes = Counter()
+    for _ in replicas:
+        outcomes.update(results.get())
+    duration = time.time() - started
+    for replica in replicas:
+        replica.join()
+
+    with unit_of_work():
+        session = get_session()
+        customers = session.query(Customer.user_id).filter_by(server_id=server_id).all()
+        customer_count = session.query(Server.customer_count).filter_by(id=server_id).scalar()
+
+    return {
+        'attempts': len(attempts),
+        'duration': duration,
+        'outcomes': dict(outcomes),
+        'customers': len(customers),
+        'distinct_customers': len(set(customers)),
+        'customer_count': customer_count,
+        'max_customers': limit - 1 if limit else len(slack_ids),  # The limit includes the server's cup
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--joins', type=int, default=300, help='number of users joining')
+    parser.add_argument('--limit', type=int, default=10, help='cups the brew is limited to (0 for no limit)')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='threads per process')
+    parser.add_argument('--duplicates', type=float, default=0.2, help='fraction of the users who try to join twice')
+    args = parser.parse_args()
+
+    results = run(args.joins, args.limit, args.processes, args.threads, args.duplicates)
+    outcomes = results['outcomes']
+    print('%d join attempts from %d processes x %d threads in %.2fs: %s' % (
+        results['attempts'], args.processes, args.threads, results['duration'],
+        ', '.join('%s %d' % item for item in sorted(outcomes.items()))
+    ))
+    print('%d customers (%d distinct, count %d) for at most %d' % (
+        results['customers'], results['distinct_customers'], results['customer_count'], results['max_customers']
+    ))
+
+    correct = (
+        results['customers'] == results['distinct_customers'] == results['customer_count'] == outcomes.get('joined', 0)
+        and results['customers'] <= results['max_customers']
+    )
+    print('OK' if correct else 'LIMIT OR UNIQUENESS VIOLATED')
+    sys.exit(0 if correct else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Replay a recording of RTM events (see TEABOT_RECORD_EVENTS) through the dispatcher against a local fake Slack Web
+API. Time is virtual: the clock is moved to each event's recorded time before it is dispatched and the brew countdowns
+that are due run there and then, so a two minute countdown takes no real time whatever the replay speed.
+
+Every user in the recording is registered in a scratch database (see benchmarks/utils.py), in the workspace their
+events were received from, and each workspace's bot is the user mentioned the most there, unless --teabot is given.
+
+    python -m benchmarks.replay events.log [--speed 1] [--output results.json]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import re
+import time
+from collections import Counter
+from datetime import timedelta
+
+from benchmarks.fake_slack import FakeWebAPI
+from benchmarks.utils import register_users, reset_database, use_fake_slack
+from src import tasks, utils
+from src.app import Listener, command_name
+from src.clock import clock
+from src.conf import BREW_COUNTDOWN
+from src.metrics import LatencyTracker
+from src.recording import read_recording
+from src.scheduler import Scheduler
+
+MENTION_RE = re.compile(r'^<@([\w\d]+)>')
+
+
+def find_teabot(events):
+    mentions = Counter(
+        MENTION_RE.match(event.get('text', '')).group(1)
+        for received_at, event in events if MENTION_RE.match(event.get('text', ''))
+    )
+    return mentions.most_common(1)[0][0] if mentions else None
+
+
+def replay(events, speed=0, teabot_slack_id=None):
+    """
+    Dispatch `events`, the `(received_at, event)` pairs of a recording, at `speed` times their recorded pace
+    (0 for as fast as possible) and return the per-command dispatch latencies
+    """
+    latencies = {}
+    if not events:
+        return latencies
+
+    reset_database()
+    teabots = []
+    for workspace in sorted(set(event['workspace'] for received_at, event in events)):
+        workspace_events = [(received_at, event) for received_at, event in events if event['workspace'] == workspace]
+        slack_ids = set(
+            event['user'] for received_at, event in workspace_events
+            if event.get('type') == 'message' and 'user' in event
+        )
+        workspace_teabot_slack_id = teabot_slack_id or find_teabot(workspace_events)
+        teabots.append(register_users(slack_ids - {workspace_teabot_slack_id}, workspace_teabot_slack_id, workspace))
+    utils.sender.tokens = dict((teabot.workspace, 'xoxb-replay') for teabot in teabots)  # The fake Slack takes any
+
+    # Countdowns only run when the replay reaches their deadline
+    tasks.scheduler = Scheduler(background=False)
+    listener = Listener(teabots, workers=0)
+    first_received_at = events[0][0]
+    started = time.time()
+    clock.freeze()
+    virtual_start = clock.utcnow()
+    try:
+        for received_at, event in events:
+            offset = received_at - first_received_at
+            if speed:
+                time.sleep(max(0, started + offset / speed - time.time()))
+
+            clock.freeze(virtual_start + timedelta(seconds=offset))
+            tasks.scheduler.run_pending()
+
+            dispatch_started = time.time()
+            listener.handle_event(event)
+            if event.get('type') == 'message':
+                command = command_name(event.get('text', ''))
+                if command not in latencies:
+                    latencies[command] = LatencyTracker(window=len(events))
+                latencies[command].record(time.time() - dispatch_started)
+
+        # Let the brews still brewing at the end of the recording finish
+        clock.freeze(clock.utcnow() + timedelta(seconds=BREW_COUNTDOWN))
+        tasks.scheduler.run_pending()
+    finally:
+        clock.unfreeze()
+
+    return latencies
+
+
+def run(path, speed, teabot_slack_id):
+    events = list(read_recording(path))
+    web_api = FakeWebAPI().start()
+    use_fake_slack(web_api)
+
+    started = time.time()
+    latencies = replay(events, speed, teabot_slack_id)
+    utils.sender.join()
+    duration = time.time() - started
+    web_api.shutdown()
+
+    return {
+        'recording': path,
+        'events': len(events),
+        'recorded_duration': events[-1][0] - events[0][0] if events else 0,
+        'speed': speed,
+        'duration': duration,
+        'api_calls': dict(web_api.calls),
+        'commands': dict(
+            (command, {
+                'count': tracker.count,
+                'p50': tracker.percentile(50),
+                'p95': tracker.percentile(95),
+                'p99': tracker.percentile(99),
+            })
+            for command, tracker in latencies.items()
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('recording', help='a file written with TEABOT_RECORD_EVENTS')
+    parser.add_argument('--speed', type=float, default=0, help='1 replays in real time, N N times faster, 0 at full speed')
+    parser.add_argument('--teabot', help="the bot's slack id in every workspace (the most mentioned user by default)")
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = run(args.recording, args.speed, args.teabot)
+
+    print('%d events recorded over %.1fs replayed in %.2fs' % (
+        results['events'], results['recorded_duration'], results['duration']
+    ))
+    print('%-15s %8s %10s %10s %10s' % ('command', 'count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'))
+    for command, result in sorted(results['commands'].items()):
+        print('%-15s %8d %10.1f %10.1f %10.1f' % (
+            command, result['count'], result['p50'] * 1000, result['p95'] * 1000, result['p99'] * 1000
+        ))
+    print('Slack API calls: %s' % ', '.join('%s=%s' % item for item in sorted(results['api_calls'].items())))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Memory soak benchmark for the dispatch path. Replays a stream of commands through the listener (with Slack calls
+stubbed out) and reports the process RSS as it goes, which should stay flat once caches have warmed up.
+
+It recreates the tables of a scratch database (see benchmarks/utils.py).
+
+    python -m benchmarks.soak [events]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from mock import patch
+
+from benchmarks.utils import TEABOT_SLACK_ID, rss_mb, setup_database
+from src.app import Listener
+from src.models import Server, unit_of_work
+from src.tasks import _brew_countdown
+
+CHANNELS = ['tearoom', 'kitchen', 'floor-2', 'floor-3']
+COMMANDS = ['ping', 'help', 'leaderboard', 'leaderboard 3', 'stats', 'stats week', 'me', 'me', 'me', 'brew']
+
+
+def run(events):
+    teabot, slack_ids = setup_database()
+    listener = Listener([teabot], workers=0)
+    noop = lambda *args, **kwargs: None
+
+    with patch('src.app.post_message', noop), patch('src.tasks.post_message', noop), \
+            patch('src.app.brew_countdown', noop):
+        started = time.time()
+        samples = []
+        for index in range(1, events + 1):
+            listener.dispatch({
+                'type': 'message',
+                'channel': random.choice(CHANNELS),
+                'user': random.choice(slack_ids),
+                'text': '<@%s> %s' % (TEABOT_SLACK_ID, random.choice(COMMANDS)),
+                'ts': '%.6f' % time.time(),
+            })
+
+            if index % 200 == 0:
+                with unit_of_work() as session:
+                    for server_id, in session.query(Server.id).filter_by(completed=False).all():
+                        _brew_countdown(server_id)
+
+            if index % (events // 10 or 1) == 0:
+                samples.append(rss_mb())
+                print('%8d events  %7.1fs  RSS %7.1f MB' % (index, time.time() - started, samples[-1]))
+
+    print('RSS growth after the first 10%% of events: %.1f MB' % (samples[-1] - samples[0]))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
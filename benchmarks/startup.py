@@ -0,0 +1,142 @@
+"""
+Startup benchmark. Starts teabot in fresh processes against a local fake Slack, whose users.list takes --sync-delay
+seconds like it does for big workspaces, and reports how long the imports took, how long until teabot was connected
+and ready to handle events and how long until its users were synced.
+
+The first run starts on an empty scratch database (see benchmarks/utils.py) so it creates the schema, the others
+start where it left off unless --fresh empties the database before every run.
+
+    python -m benchmarks.startup [--runs 5] [--users 1000] [--sync-delay 2] [--fresh]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from threading import Event
+
+OPTIONAL_MODULES = ['giphypop', 'slackclient']
+
+
+def use_fake_slack_client(web_api):
+    """
+    Send slackclient's Web API calls (rtm.start, users.list...) to `web_api` instead of slack.com
+    """
+    import requests
+    from slackclient._slackrequest import SlackRequest
+
+    def do(self, token, request='?', post_data=None, domain=None, timeout=None):
+        return requests.post(web_api.url + request, data=dict(post_data or {}, token=token), timeout=timeout)
+
+    SlackRequest.do = do
+
+
+def start(users, sync_delay):
+    """
+    Start teabot in this process, which must not have imported it yet, and return its timings
+    """
+    started = time.time()
+    from src import app, tasks
+    imported = time.time()
+    eager_modules = [name for name in OPTIONAL_MODULES if name in sys.modules]
+
+    from benchmarks.fake_slack import FakeRTM, FakeWebAPI
+    from benchmarks.utils import TEABOT_SLACK_ID, use_fake_slack
+
+    rtm = FakeRTM().start()
+    members = [{'id': TEABOT_SLACK_ID, 'name': 'teabot', 'profile': {}}] + [
+        {'id': 'U%05d' % index, 'name': 'user%s' % index, 'profile': {'real_name': 'User %s' % index}}
+        for index in range(users)
+    ]
+    web_api = FakeWebAPI(responses={
+        'rtm.start': {
+            'ok': True, 'url': rtm.url, 'self': {'id': TEABOT_SLACK_ID, 'name': 'teabot'}, 'team': {'domain': 'tea'},
+            'channels': [], 'groups': [], 'ims': [], 'users': [],
+        },
+        'auth.test': {'ok': True, 'user_id': TEABOT_SLACK_ID, 'user': 'teabot'},
+        'users.list': {'ok': True, 'members': members},
+    }, delays={'users.list': sync_delay}).start()
+    use_fake_slack(web_api)
+    use_fake_slack_client(web_api)
+
+    synced = Event()
+    warm_up = tasks.warm_up
+
+    def timed_warm_up(workspaces):
+        warm_up(workspaces)
+        synced.set()
+
+    tasks.warm_up = timed_warm_up
+
+    starting = time.time()
+    app.start()
+    ready = time.time()
+    synced.wait(60)
+    done = time.time()
+
+    return {
+        'import': imported - started,
+        'ready': imported - started + ready - starting,
+        'synced': imported - started + done - starting,
+        'eager_modules': eager_modules,
+    }
+
+
+def run(runs, users, sync_delay, fresh):
+    from sqlalchemy import MetaData
+    from benchmarks.utils import engine
+
+    def empty_database():
+        metadata = MetaData()
+        metadata.reflect(engine)
+        metadata.drop_all(engine)
+
+    empty_database()
+    results = []
+    for index in range(runs if fresh else runs + 1):
+        if fresh:
+            empty_database()
+        output = subprocess.check_output([
+            sys.executable, '-m', 'benchmarks.startup', '--child', '--users', str(users),
+            '--sync-delay', str(sync_delay)
+        ])
+        if fresh or index:  # Without --fresh the first run only sets up the database
+            results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--users', type=int, default=1000, help='users in the workspace')
+    parser.add_argument('--sync-delay', type=float, default=2, help='seconds users.list takes to respond')
+    parser.add_argument('--fresh', action='store_true', help='start every run on an empty database')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        logging.basicConfig(level=logging.WARNING)
+        print(json.dumps(start(args.users, args.sync_delay)))
+        sys.stdout.flush()
+        os._exit(0)  # Don't wait for teabot's background threads
+
+    results = run(args.runs, args.users, args.sync_delay, args.fresh)
+    print('%d starts on %s database, users.list takes %.1fs for %d users' % (
+        len(results), 'an empty' if args.fresh else 'an existing', args.sync_delay, args.users
+    ))
+    print('%-8s %10s %10s %10s' % ('', 'import (s)', 'ready (s)', 'synced (s)'))
+    for label, aggregate in (('min', min), ('median', lambda values: sorted(values)[len(values) // 2]), ('max', max)):
+        print('%-8s %10.3f %10.3f %10.3f' % ((label,) + tuple(
+            aggregate([result[timing] for result in results]) for timing in ('import', 'ready', 'synced')
+        )))
+    eager_modules = sorted(set(name for result in results for name in result['eager_modules']))
+    print('Optional integrations imported at startup: %s' % (', '.join(eager_modules) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Shared helpers for the benchmarks. Importing this module points teabot at a scratch SQLite database unless
+TEABOT_DATABASE_URL is already set, so import it before anything from `src`.
+"""
+from __future__ import absolute_import
+
+import os
+import resource
+import tempfile
+
+os.environ.setdefault('TEABOT_DATABASE_URL', 'sqlite:///%s' % os.path.join(tempfile.gettempdir(), 'teabot-bench.db'))
+
+from src import sender as sender_module, utils  # noqa: E402
+from src.conf import DEFAULT_WORKSPACE  # noqa: E402
+from src.managers import UserIdentity  # noqa: E402
+from src.models import Base, User, engine, unit_of_work  # noqa: E402
+
+TEABOT_SLACK_ID = 'UTEABOT'
+
+
+class NoGiphy(object):
+    def search(self, phrase=None, limit=None):
+        return []
+
+
+def use_fake_slack(web_api):
+    """
+    Send Slack Web API calls to `web_api` (a FakeWebAPI) without rate limits and don't search Giphy
+    """
+    sender_module.SLACK_API_URL = web_api.url
+    sender_module.SLACK_CHANNEL_RATE = sender_module.SLACK_CHANNEL_BURST = 10 ** 6
+    utils.gif_cache.client = NoGiphy()
+
+
+def setup_database(users=50, slack_ids=None, teabot_slack_id=TEABOT_SLACK_ID):
+    """
+    Recreate the tables with the bot and registered users, `users` generated ones unless `slack_ids` are given.
+    Returns the bot and the users' slack ids.
+    """
+    reset_database()
+    slack_ids = list(slack_ids) if slack_ids is not None else ['U%05d' % index for index in range(users)]
+    return register_users(slack_ids, teabot_slack_id), slack_ids
+
+
+def reset_database():
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+
+def register_users(slack_ids, teabot_slack_id=TEABOT_SLACK_ID, workspace=DEFAULT_WORKSPACE):
+    """
+    Add the bot and registered users with the given slack ids to a workspace of the scratch database. Returns the bot.
+    """
+    with unit_of_work(workspace) as session:
+        teabot = User(slack_id=teabot_slack_id, username='teabot', workspace=workspace)
+        session.add(teabot)
+        session.add_all([
+            User(
+                slack_id=slack_id, username='user%s' % index, first_name='User %s' % index, tea_type='tea',
+                workspace=workspace
+            )
+            for index, slack_id in enumerate(slack_ids)
+        ])
+        session.flush()
+        return UserIdentity(teabot)
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024.0
+    except IOError:  # No procfs, fall back to the peak RSS (kB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
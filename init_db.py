@@ -1,6 +1,5 @@
-from src.models import Base, engine
-from src.tasks import update_slack_users
+from src.migrations import migrate
 
-Base.metadata.drop_all(engine)
-Base.metadata.create_all(engine)
-update_slack_users()
+# Creates the schema or applies pending migrations. The app does the same when it starts and syncs the users of every
+# workspace in the background, running this beforehand only keeps schema changes out of the restart.
+migrate()
@@ -0,0 +1,43 @@
+"""
+Send a message event to teabot's Events API endpoint, signed with SLACK_SIGNING_SECRET the way Slack signs them.
+Handy to try the "events" ingestion mode locally:
+
+    python send_event.py "<@UTEABOT> brew" --user U12345 --channel tearoom --url http://localhost:3000/
+"""
+import argparse
+import time
+
+import requests
+
+from src.conf import SLACK_SIGNING_SECRET
+from src.events_api import signed_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('text')
+    parser.add_argument('--user', required=True, help='slack id of the user sending the message')
+    parser.add_argument('--channel', default='tearoom')
+    parser.add_argument('--url', default='http://localhost:3000/')
+    parser.add_argument('--secret', default=SLACK_SIGNING_SECRET)
+    args = parser.parse_args()
+
+    now = time.time()
+    body, headers = signed_request(args.secret, {
+        'type': 'event_callback',
+        'event_id': 'Ev%d' % (now * 1000000),
+        'event_time': int(now),
+        'event': {
+            'type': 'message',
+            'channel': args.channel,
+            'user': args.user,
+            'text': args.text,
+            'ts': '%.6f' % now,
+        },
+    })
+    response = requests.post(args.url, data=body, headers=headers)
+    print(response.status_code)
+
+
+if __name__ == '__main__':
+    main()
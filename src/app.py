@@ -1,13 +1,35 @@
+import errno
+import logging
 import random
 import re
+import select
+import socket
 import time
 
-from conf import HELP_TEXT, NOMINATION_POINTS_REQUIRED
-from managers import UserManager, ServerManager
-from models import Server, Customer, User, get_session, Session
-from slack_client import sc
-from tasks import brew_countdown, update_slack_users
-from utils import post_message
+from clock import clock
+from conf import (
+    DEFAULT_WORKSPACE, DISPATCH_WORKERS, EVENTS_PORT, GIF_PREFETCH_PHRASES, HELP_TEXT, INGEST_LAG_REPORT_INTERVAL, INGEST_LAG_WINDOW,
+    INGESTION_MODE, METRICS_ENABLED, METRICS_PORT, NOMINATION_POINTS_REQUIRED, PROFILING_ENABLED, RECORD_EVENTS_PATH,
+    REPLICAS_ENABLED, RTM_POLL_TIMEOUT, RTM_RECONNECT_BACKOFF, RTM_RECONNECT_MAX_BACKOFF, SLACK_WORKSPACES
+)
+from dedup import EventDeduplicator
+from events_api import EventsServer
+from leaderboard import leaderboards
+from managers import EventClaimManager, UserIdentity, UserManager, ServerManager
+from metrics import LatencyTracker, command_duration, event_dedup_requests, start_metrics_server
+from migrations import migrate
+from rollups import STAT_FIELDS, WINDOWS, get_stats
+from models import Server, Customer, User, current_workspace, get_session, unit_of_work
+from profiling import profiler
+from recording import EventRecorder
+from responses import response_cache
+from slack_client import get_client
+from tasks import (
+    brew_countdown, restore_brew_countdowns, schedule_brew_sweep, schedule_event_claim_pruning, schedule_leaderboard_check,
+    update_slack_users, warm_up_async
+)
+from utils import gif_cache, post_message
+from workers import DispatchPool
 
 COMMAND_RE = re.compile(
     r'^<@([\w\d]+)>:? (register|brew|me|stats|leaderboard|nominate|update_users|yo|ping|help)\s?(.*)?$',
@@ -16,6 +38,16 @@ COMMAND_RE = re.compile(
 MENTION_RE = re.compile(r'^<@([\w\d]+)>$')
 MENTION_ANYWHERE_RE = re.compile(r'<@([\w\d]+)>')
 
+logger = logging.getLogger(__name__)
+
+
+def command_name(text):
+    """
+    The command an event's text asks for, or "unknown", for labelling metrics and profiles
+    """
+    match = COMMAND_RE.search(text)
+    return match.group(2).strip().lower() if match else 'unknown'
+
 
 # Decorator
 def require_registration(func):
@@ -27,53 +59,225 @@ def require_registration(func):
     return func_wrapper
 
 
+def cached_reply(func):
+    """
+    For read-only commands that return their reply, as the text and the other arguments of `post_message`, instead of
+    posting it. The reply is cached per workspace, command and arguments (and day, for the stats windows) until the
+    workspace's data changes.
+    """
+    def func_wrapper(self, *args, **kwargs):
+        key = (func.__name__, self.command_body, clock.utcnow().date())
+        version = response_cache.version(self.workspace)
+        reply = response_cache.get(self.workspace, key)
+        if reply is None:
+            reply = func(self, *args, **kwargs)
+            response_cache.set(self.workspace, key, version, reply)
+
+        text, options = reply
+        return post_message(text, self.channel, **options)
+    return func_wrapper
+
+
 class Listener(object):
-    def __init__(self, teabot):
-        self.teabot = teabot
+    """
+    Receives the events of every workspace served by the process and dispatches them from a shared worker pool.
+    `teabots` are the bot's identities, one per workspace.
+    """
+    def __init__(self, teabots, workers=DISPATCH_WORKERS, recorder=None):
+        self.teabots = dict((teabot.workspace, teabot) for teabot in teabots)
+        self.recorder = recorder
+        self.deduplicator = EventDeduplicator()
+        self.ingest_lag = LatencyTracker(window=INGEST_LAG_WINDOW)
+        self.dispatch_pool = DispatchPool(self.dispatch, workers=workers) if workers else None
+        self._backoff = {}  # workspace -> seconds waited before its latest reconnection
+        self._reconnect_at = {}  # workspace -> when to reconnect its RTM websocket
 
     def listen(self):
-        if sc.rtm_connect():
-            while True:
-                event = sc.rtm_read()
-                if event and event[0].get('type', '') == 'message':
-                    Dispatcher(self.teabot).dispatch(event)
-                time.sleep(1)
+        self.connect()
+        self.run()
+
+    def connect(self, workspaces=None):
+        for workspace in workspaces or list(self.teabots):
+            if get_client(workspace).rtm_connect():
+                self._reconnect_at.pop(workspace, None)
+            else:
+                self.disconnected(workspace)
+                logger.error(
+                    'Could not connect to the RTM API of workspace %s, retrying in %ss',
+                    workspace, self._backoff[workspace]
+                )
+
+    def disconnected(self, workspace):
+        """
+        Drop a workspace's RTM websocket and schedule its reconnection, backing off while it keeps failing. The other
+        workspaces are not affected.
+        """
+        server = get_client(workspace).server
+        websocket, server.websocket, server.connected = server.websocket, None, False
+        if websocket:
+            websocket.shutdown()
+
+        backoff = self._backoff.get(workspace)
+        self._backoff[workspace] = min(backoff * 2, RTM_RECONNECT_MAX_BACKOFF) if backoff else RTM_RECONNECT_BACKOFF
+        self._reconnect_at[workspace] = time.time() + self._backoff[workspace]
+
+    def run(self):
+        """
+        Handle events from the connected RTM websockets of every workspace forever, from a single thread
+        """
+        while True:
+            self.poll()
+
+    def poll(self):
+        """
+        Reconnect the workspaces that are due, then handle the events of the websockets that have some
+        """
+        now = time.time()
+        due = [workspace for workspace, reconnect_at in self._reconnect_at.items() if reconnect_at <= now]
+        if due:
+            self.connect(due)
+
+        for workspace in self.wait_for_events():
+            try:
+                events = list(self.read_events(workspace))
+            except Exception:
+                logger.exception('Lost the RTM connection of workspace %s', workspace)
+                self.disconnected(workspace)
+                continue
+
+            if events:
+                self._backoff.pop(workspace, None)  # Connected for good
+            for event in events:
+                event['workspace'] = workspace
+                self.receive(event)
+
+    def wait_for_events(self):
+        """
+        Block until RTM websockets have data to read (or the poll timeout expires, or a reconnection is due) and return
+        their workspaces
+        """
+        websockets = dict(
+            (get_client(workspace).server.websocket.sock, workspace) for workspace in self.teabots
+            if get_client(workspace).server.websocket
+        )
+        timeout = min([RTM_POLL_TIMEOUT] + [max(0, when - time.time()) for when in self._reconnect_at.values()])
+        readable, _, _ = select.select(list(websockets), [], [], timeout)
+        return [websockets[sock] for sock in readable]
+
+    def read_events(self, workspace=DEFAULT_WORKSPACE):
+        """
+        Drain every event that is currently buffered on a workspace's RTM websocket
+        """
+        client = get_client(workspace)
+        while True:
+            try:
+                events = client.rtm_read()
+            except socket.error as e:  # Plain (non TLS) websockets raise instead of returning nothing
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            if not events:
+                return
+
+            for event in events:
+                yield event
+
+    def receive(self, event):
+        if self.recorder:
+            self.recorder.record(event)
+        self.handle_event(event)
+
+    def handle_event(self, event):
+        if event.get('type', '') != 'message' or self.deduplicator.is_duplicate(event):
+            return
+
+        # Events from the same channel are handled by the same worker so their replies stay in order
+        if self.dispatch_pool:
+            self.dispatch_pool.submit((event.get('workspace'), event.get('channel', '')), event)
+        else:
+            self.dispatch(event)
+
+    def dispatch(self, event):
+        workspace = event.get('workspace', DEFAULT_WORKSPACE)
+        teabot = self.teabots.get(workspace)
+        if teabot is None:
+            logger.warning('Ignoring an event for unknown workspace %s', workspace)
+            return
+
+        self.record_ingest_lag(event)
+        with profiler.profile(command_name(event.get('text', ''))), unit_of_work(workspace):
+            Dispatcher(teabot).dispatch(event)
+
+    def record_ingest_lag(self, event):
+        """
+        Track the time between Slack timestamping an event and us dispatching it
+        """
+        try:
+            lag = time.time() - float(event.get('ts'))
+        except (TypeError, ValueError):
+            return
+
+        self.ingest_lag.record(lag)
+        if self.ingest_lag.count % INGEST_LAG_REPORT_INTERVAL == 0:
+            logger.info(
+                'Ingest lag p50=%.3fs p99=%.3fs',
+                self.ingest_lag.percentile(50),
+                self.ingest_lag.percentile(99)
+            )
 
 
 class Dispatcher(object):
     def __init__(self, teabot):
         self.teabot = teabot
+        self.workspace = current_workspace()
         self.channel = ''
         self.command_body = ''
         self.request_user = None
         self.session = get_session()
 
     def dispatch(self, event):
-        self.channel = event[0].get('channel', '')
-        text = event[0].get('text', '')
-
-        try:
-            slack_user_id, command, command_body = COMMAND_RE.search(text).groups()
-            if slack_user_id != self.teabot.slack_id:
+        self.channel = event.get('channel', '')
+        text = event.get('text', '')
+
+        match = COMMAND_RE.search(text)
+        with command_duration.time(command=command_name(text), outcome='ok') as timer:
+            if match:
+                mentioned = match.groups()[0] == self.teabot.slack_id
+            else:
+                mention = MENTION_ANYWHERE_RE.search(text)
+                mentioned = bool(mention) and mention.groups()[0] == self.teabot.slack_id
+            if not mentioned:
+                timer.labels['outcome'] = 'ignored'
                 return
 
-            command = command.strip()
-            self.command_body = command_body.strip()
-            self.request_user = UserManager.get_by_slack_id(event[0].get('user', ''))
-            if not self.request_user:
-                return
+            # Every replica receives the event, only the first to claim it replies to it (even if not understood)
+            if REPLICAS_ENABLED:
+                claimed = EventClaimManager.claim(event)
+                event_dedup_requests.inc(store='database', result='miss' if claimed else 'hit')
+                if not claimed:
+                    timer.labels['outcome'] = 'duplicate'
+                    return
 
-            # Call the appropriate function
-            getattr(self, command)()
-        except AttributeError:
-            regex = MENTION_ANYWHERE_RE.search(text)
-            if regex and regex.groups()[0] == self.teabot.slack_id:
+            try:
+                _, command, command_body = match.groups()
+                command = command.strip()
+                self.command_body = command_body.strip()
+                self.request_user = UserManager.get_identity(event.get('user', ''))
+                if not self.request_user:
+                    timer.labels['outcome'] = 'unknown_user'
+                    return
+
+                # Call the appropriate function
+                getattr(self, command)()
+            except AttributeError:
+                timer.labels['outcome'] = 'not_understood'
                 post_message('I did not understand that. Try `@teabot help`',  self.channel)
 
     @require_registration
     def brew(self):
-        # Make sure the user is not brewing already
-        if ServerManager.has_active_server():
+        # Make sure no one is brewing in this channel already
+        if ServerManager.has_active_server(self.channel):
             return post_message('Someone else is already making tea. Want in?',  self.channel)
 
         limit = None
@@ -89,9 +293,10 @@ class Dispatcher(object):
             except ValueError:
                 return post_message('I did not understand what `%s` means' % stripped_command_body, self.channel)
 
-        self.session.add(Server(user_id=self.request_user.id, limit=limit))
-        self.session.commit()
-        brew_countdown(self.channel)
+        server = ServerManager.start_brew(self.channel, self.request_user.id, limit)
+        if server is None:  # Someone started a brew in the channel at the same time
+            return post_message('Someone else is already making tea. Want in?',  self.channel)
+        brew_countdown(server)
 
         return post_message(
             random.choice([
@@ -105,48 +310,71 @@ class Dispatcher(object):
             gif_search_phrase='' if random.random() >= 0.3 else 'tea time'
         )
 
+    @cached_reply
     def help(self):
-        return post_message(HELP_TEXT,  self.channel)
+        return HELP_TEXT, {}
 
+    @cached_reply
     def leaderboard(self):
-        leaderboard = self.session.query(User).filter(User.tea_type.isnot(None)).order_by(User.teas_brewed.desc()).all()
-        _message = '*Teabot Leaderboard*\n\n'
-        for index, user in enumerate(leaderboard):
-            _message += '%s. _%s_ has brewed *%s* cups of tea\n' % (index + 1, user.real_name, user.teas_brewed)
+        """
+        Show the leaderboard. Takes an optional number of places to show (`@teabot leaderboard 5`)
+        or a user to show the position of (`@teabot leaderboard @george`)
+        """
+        try:
+            slack_id = MENTION_RE.search(self.command_body).groups()[0]
+        except AttributeError:
+            slack_id = None
 
-        return post_message(_message, self.channel)
+        if slack_id:
+            user = UserManager.get_identity(slack_id)
+            rank = leaderboards.current().rank(user.id) if user else None
+            if rank is None:
+                return '<@%s> is not on the leaderboard yet' % slack_id, {}
+            return '<@%s> is number *%s* on the leaderboard' % (slack_id, rank), {}
+
+        limit = None
+        if self.command_body:
+            try:
+                limit = int(self.command_body)
+            except ValueError:
+                limit = 0
+            if limit < 1:  # A negative limit would slice from the end of the leaderboard
+                return 'I did not understand what `%s` means' % self.command_body, {}
+
+        return '*Teabot Leaderboard*\n\n' + ''.join(
+            '%s. _%s_ has brewed *%s* cups of tea\n' % (index + 1, real_name, teas_brewed)
+            for index, (real_name, teas_brewed) in enumerate(leaderboards.current().top(limit))
+        ), {}
 
     @require_registration
     def me(self):
-        server = self.session.query(Server).filter_by(completed=False)
-        if not server.count():
-            return post_message('No one has volunteered to make tea, why dont you make it %s?' % self.request_user.display_name, self.channel)
+        joined = ServerManager.join(self.channel, self.request_user.id)
+        if joined:
+            return post_message('Hang tight %s, tea is being served soon' % self.request_user.display_name, self.channel)
 
-        server = server.first()
+        if joined is not None:
+            return post_message('You said it once already %s.' % self.request_user.display_name, self.channel)
+
+        # Work out why the user could not join
+        server = ServerManager.get_active_server(self.channel)
+        if not server:
+            return post_message('No one has volunteered to make tea, why dont you make it %s?' % self.request_user.display_name, self.channel)
 
         if server.user_id == self.request_user.id:
             return post_message(
                 '%s you are making tea! :face_with_rolling_eyes:' % self.request_user.display_name, self.channel
             )
 
-        if self.session.query(Customer).filter_by(user_id=self.request_user.id, server_id=server.id).count():
-            return post_message('You said it once already %s.' % self.request_user.display_name, self.channel)
-
-        # Check if the server's brew limit has been exceeded. The limit is inclusive of the server's cup.
-        customers = self.session.query(Customer).filter_by(server_id=server.id).count()
-        if server.limit and customers + 1 >= server.limit:
-            return post_message(
-                'I am sorry %s but %s will only brew %s cups' % (self.request_user.display_name, server.user.display_name, server.limit),
-                self.channel
-            )
-
-        self.session.add(Customer(user_id=self.request_user.id, server_id=server.id))
-        self.session.commit()
-        return post_message('Hang tight %s, tea is being served soon' % self.request_user.display_name, self.channel)
+        return post_message(
+            'I am sorry %s but %s will only brew %s cups' % (
+                self.request_user.display_name, server.user.display_name, server.limit or 0
+            ),
+            self.channel
+        )
 
     @require_registration
     def nominate(self):
-        if ServerManager.has_active_server():
+        if ServerManager.has_active_server(self.channel):
             return post_message(
                 'Someone else is already making tea, I\'ll save your nomination for later :smile:',
                 self.channel
@@ -158,21 +386,27 @@ class Dispatcher(object):
             return post_message('You must nominate another user to brew!', self.channel)
 
         nominated_user = UserManager.get_by_slack_id(slack_id)
-        if self.request_user.nomination_points < NOMINATION_POINTS_REQUIRED:
+        nomination_points = self.session.query(User.nomination_points).filter_by(id=self.request_user.id).scalar()
+        if nomination_points < NOMINATION_POINTS_REQUIRED:
             return post_message(
                 'You can\'t nominate someone unless you brew tea %s times!' % NOMINATION_POINTS_REQUIRED,
                 self.channel
             )
 
+        server = ServerManager.start_brew(self.channel, nominated_user.id)
+        if server is None:  # Someone started a brew in the channel at the same time
+            return post_message(
+                'Someone else is already making tea, I\'ll save your nomination for later :smile:',
+                self.channel
+            )
+
         # Subtract nomination points from request user.
         nominated_user.nomination_points -= NOMINATION_POINTS_REQUIRED
 
-        server = Server(user_id=nominated_user.id)
-        self.session.add(server)
-        self.session.flush()
-        self.session.add(Customer(user_id=self.request_user.id, server_id=server.id))
+        server.customer_count = Server.customer_count + 1
+        self.session.add(Customer(user_id=self.request_user.id, server_id=server.id, workspace=self.workspace))
         self.session.commit()
-        brew_countdown(self.channel)
+        brew_countdown(server)
 
         return post_message(
             '%s has nominated %s to make tea! Who wants in?' % (
@@ -186,33 +420,45 @@ class Dispatcher(object):
     def ping(self):
         return post_message('pong', self.channel)
 
+    @cached_reply
     def stats(self):
         """
         Get stats for user(s) - (# of teas drunk, # of teas brewed, # of times brewed, # of teas received)
-        :param command_body: can either be empty (get stats for all users) or can reference a specific user
+        :param command_body: can either be empty (get stats for all users) or can reference a specific user,
+        optionally preceded by a time window (`today`, `week` or `month`)
         """
+        window = None
+        command_body = self.command_body
+        if command_body.split(' ')[0].lower() in WINDOWS:
+            window, _, command_body = command_body.partition(' ')
+            window = window.lower()
+
         try:
-            slack_id = MENTION_RE.search(self.command_body).groups()[0]
+            slack_id = MENTION_RE.search(command_body.strip()).groups()[0]
         except AttributeError:
             slack_id = None
 
-        if slack_id:
-            users = [UserManager.get_by_slack_id(slack_id)]
+        user = UserManager.get_by_slack_id(slack_id) if slack_id else None
+        if slack_id and not user:
+            return 'I did not understand that. Try `@teabot help`', {}
+
+        if window:
+            results = [
+                dict(real_name=real_name, **counters)
+                for real_name, counters in get_stats(window, user_id=user.id if user else None)
+            ]
+            if user and not results:
+                results = [dict([('real_name', user.real_name)] + [(field, 0) for field in STAT_FIELDS])]
         else:
-            users = self.session.query(User).filter(User.tea_type.isnot(None)).all()
-
-        results = []
-
-        for user in users:
-            results.append({
-                'real_name': user.real_name,
-                'teas_drunk': user.teas_drunk,
-                'teas_brewed': user.teas_brewed,
-                'times_brewed': user.times_brewed,
-                'teas_received': user.teas_received
-            })
-
-        return post_message('', self.channel, attachments=[
+            users = [user] if user else self.session.query(User).filter(
+                User.workspace == self.workspace, User.tea_type.isnot(None)
+            ).order_by(User.id).all()
+            results = [
+                dict([('real_name', _user.real_name)] + [(field, getattr(_user, field)) for field in STAT_FIELDS])
+                for _user in users
+            ]
+
+        return '*Stats for %s*' % WINDOWS[window] if window else '', {'attachments': [
             {
                 "fallback": "Teabot Stats",
                 "pretext": "",
@@ -225,7 +471,7 @@ class Dispatcher(object):
                 ]
             }
             for result in results
-        ])
+        ]}
 
     def register(self):
         if not self.command_body:
@@ -235,17 +481,75 @@ class Dispatcher(object):
         if self.request_user.tea_type:
             message = 'I have updated your tea preference.'
 
-        self.request_user.tea_type = self.command_body
+        user = self.session.query(User).get(self.request_user.id)
+        user.tea_type = self.command_body
         self.session.commit()
+        UserManager.invalidate(user.slack_id)
+        leaderboards.current().update(user.id, user.real_name, user.teas_brewed)
+        response_cache.bump(self.workspace)
         return post_message(message, self.channel)
 
     def yo(self):
         return post_message('Sup?', self.channel)
 
     def update_users(self):
-        update_slack_users()
-        return post_message('I have updated the user registry', self.channel)
+        counts = update_slack_users()
+        if counts is None:
+            return post_message('I could not get the user list from Slack', self.channel)
+
+        return post_message(
+            'I have updated the user registry (%(added)s added, %(updated)s updated, %(unchanged)s unchanged)' % counts,
+            self.channel
+        )
+
+
+def teabot_identity(workspace):
+    """
+    The bot's identity in the current workspace. Until the workspace's users are synced the bot is only known to Slack.
+    """
+    teabot = UserManager.get_by_username('teabot')
+    if teabot is None:
+        response = get_client(workspace).api_call('auth.test')
+        if not response.get('ok'):
+            raise ValueError('Could not identify teabot in workspace %s: %s' % (workspace, response.get('error')))
+        teabot = User(workspace=workspace, slack_id=response['user_id'], username=response['user'])
+
+    return UserIdentity(teabot)
+
+
+def start():
+    """
+    Get teabot ready to handle events: create or migrate the schema if needed, restore the brew countdowns and connect
+    to Slack. Users are synced and leaderboards loaded in the background afterwards. Returns the function that handles
+    events forever.
+    """
+    migrate()
+    gif_cache.prefetch(GIF_PREFETCH_PHRASES)
+    with unit_of_work():
+        restore_brew_countdowns()
+    teabots = []
+    for workspace in SLACK_WORKSPACES:
+        with unit_of_work(workspace):
+            teabots.append(teabot_identity(workspace))
+    schedule_leaderboard_check()
+    if REPLICAS_ENABLED:
+        schedule_brew_sweep()
+        schedule_event_claim_pruning()
+    listener = Listener(teabots, recorder=EventRecorder(RECORD_EVENTS_PATH) if RECORD_EVENTS_PATH else None)
+    if INGESTION_MODE == 'events':
+        serve = EventsServer(listener, EVENTS_PORT).serve_forever
+    else:
+        listener.connect()
+        serve = listener.run
+    warm_up_async(SLACK_WORKSPACES)
+    return serve
 
 
 if __name__ == '__main__':
-    Listener(UserManager.get_by_username('teabot')).listen()
+    logging.basicConfig(level=logging.INFO)
+    if METRICS_ENABLED:
+        start_metrics_server(METRICS_PORT)
+    if PROFILING_ENABLED:
+        profiler.enable()
+    serve = start()
+    serve()
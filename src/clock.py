@@ -0,0 +1,23 @@
+from datetime import datetime
+
+
+class Clock(object):
+    """
+    The current UTC time. Replays freeze it and move it forward by hand, so brew countdowns end as soon as the
+    replayed events reach their deadline instead of after a real wait.
+    """
+    def __init__(self):
+        self.frozen_at = None
+
+    def utcnow(self):
+        frozen_at = self.frozen_at
+        return frozen_at if frozen_at is not None else datetime.utcnow()
+
+    def freeze(self, when=None):
+        self.frozen_at = when or datetime.utcnow()
+
+    def unfreeze(self):
+        self.frozen_at = None
+
+
+clock = Clock()
@@ -2,10 +2,108 @@ import os
 
 SLACK_WEBHOOK_SECRET = os.environ.get('SLACK_WEBHOOK_SECRET')
 
-SQLALCHEMY_ENGINE = 'sqlite:////tmp/test.db'
+# The Slack teams (workspaces) served by this process and their bot tokens, set as "<team id>=<token>" pairs separated
+# by commas in TEABOT_WORKSPACES. Without it the process serves a single team, the "default" workspace, with
+# SLACK_WEBHOOK_SECRET. Data created before workspaces existed belongs to the default workspace.
+DEFAULT_WORKSPACE = 'default'
+SLACK_WORKSPACES = dict(
+    pair.strip().split('=', 1) for pair in os.environ.get('TEABOT_WORKSPACES', '').split(',') if pair.strip()
+) or {DEFAULT_WORKSPACE: SLACK_WEBHOOK_SECRET}
+
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://slack.com/api/')
+
+# How events are received: "rtm" keeps one RTM websocket open, "events" serves the Events API over HTTP on EVENTS_PORT
+# (verifying requests with the app's signing secret) so several replicas can share the load
+INGESTION_MODE = os.environ.get('TEABOT_INGESTION_MODE', 'rtm')
+SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
+EVENTS_PORT = int(os.environ.get('TEABOT_EVENTS_PORT', 3000))
+EVENTS_MAX_BODY_SIZE = 1024 * 1024
+EVENTS_SIGNATURE_MAX_AGE = 60 * 5
+
+# Outbound messages: chat.postMessage allows about one message per second per channel with short bursts.
+# Requests that fail or are rate limited are retried up to SENDER_MAX_RETRIES times.
+SLACK_CHANNEL_RATE = 1
+SLACK_CHANNEL_BURST = 3
+SENDER_WORKERS = 4
+SENDER_QUEUE_SIZE = 100
+SENDER_MAX_RETRIES = 3
+SENDER_TIMEOUT = 10
+
+SQLALCHEMY_ENGINE = os.environ.get('TEABOT_DATABASE_URL', 'sqlite:////tmp/test.db')
+
+# Engine profile: 'sqlite' (WAL journal, busy timeout) or 'server' (a pooled database server such as PostgreSQL)
+DATABASE_PROFILE = os.environ.get('TEABOT_DATABASE_PROFILE', 'sqlite')
+SQLITE_BUSY_TIMEOUT = 10  # Seconds a write waits for the lock before failing with "database is locked"
+DATABASE_POOL_SIZE = int(os.environ.get('TEABOT_DATABASE_POOL_SIZE', 10))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('TEABOT_DATABASE_MAX_OVERFLOW', 10))
+DATABASE_POOL_RECYCLE = int(os.environ.get('TEABOT_DATABASE_POOL_RECYCLE', 60 * 60))
+DATABASE_POOL_TIMEOUT = 30
 
 BREW_COUNTDOWN = 120
 
+# Seconds the listener blocks waiting for the RTM websocket to become readable
+RTM_POLL_TIMEOUT = 5
+# A workspace whose RTM connection fails is reconnected after 1 second, doubling up to a minute while it keeps failing
+RTM_RECONNECT_BACKOFF = 1
+RTM_RECONNECT_MAX_BACKOFF = 60
+
+# Number of threads dispatching commands concurrently (0 dispatches inline on the listener thread) and
+# the number of events each of them can have waiting before the listener blocks
+DISPATCH_WORKERS = int(os.environ.get('TEABOT_DISPATCH_WORKERS', 4))
+DISPATCH_QUEUE_SIZE = 100
+
+# Slack delivers events again after reconnects and retries. The events received in the last EVENT_DEDUP_WINDOW seconds
+# (at most EVENT_DEDUP_SIZE of them) are remembered and duplicates dropped before they are dispatched.
+EVENT_DEDUP_WINDOW = 10 * 60
+EVENT_DEDUP_SIZE = 10000
+
+# Run as one of several replicas sharing the database: every command is claimed by the first replica to dispatch it
+# (claims are kept for EVENT_CLAIM_TTL seconds) and every BREW_SWEEP_INTERVAL seconds each replica completes the brews
+# that are more than BREW_SWEEP_GRACE seconds past their deadline, e.g. because the replica counting them down stopped
+REPLICAS_ENABLED = os.environ.get('TEABOT_REPLICAS_ENABLED', '').lower() in ('1', 'true', 'yes')
+EVENT_CLAIM_TTL = 60 * 60
+BREW_SWEEP_INTERVAL = 5
+BREW_SWEEP_GRACE = 5
+
+# Number of recent events used for ingest lag percentiles and how often (in events) they are logged
+INGEST_LAG_WINDOW = 1000
+INGEST_LAG_REPORT_INTERVAL = 100
+
+# Serve command, database and outbound API timings in the Prometheus format on http://<host>:METRICS_PORT/metrics
+METRICS_ENABLED = os.environ.get('TEABOT_METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+METRICS_PORT = int(os.environ.get('TEABOT_METRICS_PORT', 9100))
+
+# Record the queries and DB time of every dispatched event per command, log a report every PROFILE_REPORT_INTERVAL
+# events and cProfile a PROFILE_SAMPLE_RATE fraction of the events into PROFILE_DIR (the temp dir by default)
+PROFILING_ENABLED = os.environ.get('TEABOT_PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+PROFILE_SAMPLE_RATE = float(os.environ.get('TEABOT_PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('TEABOT_PROFILE_DIR')
+PROFILE_REPORT_INTERVAL = 1000
+
+# Append every RTM event the listener reads to this file so the traffic can be replayed (see benchmarks/replay.py)
+RECORD_EVENTS_PATH = os.environ.get('TEABOT_RECORD_EVENTS')
+
+# How long (in seconds) GIF search results are cached, how many search phrases are kept and how many
+# results are fetched per phrase
+GIF_CACHE_TTL = 60 * 60
+GIF_CACHE_SIZE = 32
+GIF_SEARCH_LIMIT = 50
+# How long (in seconds) to wait before searching Giphy again for a phrase whose search failed
+GIF_RETRY_TTL = 60
+GIF_PREFETCH_PHRASES = ['tea time', 'celebrate']
+
+# Number of user identities kept in memory by UserManager. Replicas don't see each other's registrations so they
+# don't cache them.
+USER_CACHE_SIZE = 0 if REPLICAS_ENABLED else 10000
+
+# Number of rendered replies of read-only commands (help, leaderboard, stats) kept in memory until the data they show
+# changes. Replicas don't see each other's writes so they don't cache them.
+RESPONSE_CACHE_SIZE = 0 if REPLICAS_ENABLED else 256
+
+# How often (in seconds) the in-memory leaderboard is checked against the counters in the database, which other
+# replicas update too
+LEADERBOARD_CHECK_INTERVAL = 60 if REPLICAS_ENABLED else 60 * 60
+
 VERSION = '0.2'
 
 NOMINATION_POINTS_REQUIRED = 15
@@ -16,8 +114,8 @@ HELP_TEXT = '''
 1. _register_ -> Registers the tea preference of a user (`@teabot register green tea`)
 2. _brew_ - Initiates the brewing process (users have %s seconds to respond) and takes an optional argument to limit the number of cups to brew (`@teabot brew` or `@teabot brew 5`)
 3. _me_ -> Reply with `@teabot me` when someone has offered to brew
-4. _leaderboard_ -> Displays the current leaderboard based on tea cups brewed (`@teabot leaderboard`)
-5. _stats_ -> Displays the stats for all users (`@teabot stats`) or (`@teabot stats @george`) for a single user
+4. _leaderboard_ -> Displays the current leaderboard based on tea cups brewed (`@teabot leaderboard`), its top places (`@teabot leaderboard 5`) or the position of a user (`@teabot leaderboard @george`)
+5. _stats_ -> Displays the stats for all users (`@teabot stats`) or (`@teabot stats @george`) for a single user. Add `today`, `week` or `month` to limit them to a time window (`@teabot stats week`)
 6. _nominate_ -> Nominate someone to brew tea. You must brew tea more than %s times to use this (`@teabot nominate @george`)
 7. _update_users_ -> Update teabot's user registry based on changes in your Slack team (`@teabot update_users`)
 ''' % (VERSION, BREW_COUNTDOWN, NOMINATION_POINTS_REQUIRED)
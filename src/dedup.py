@@ -0,0 +1,49 @@
+import time
+from collections import deque
+from threading import Lock
+
+from conf import EVENT_DEDUP_SIZE, EVENT_DEDUP_WINDOW
+from metrics import event_dedup_requests
+
+
+class EventDeduplicator(object):
+    """
+    Remembers the events received in the last `window` seconds (at most `size` of them) to drop the ones Slack
+    delivers again after reconnects and retries. Events are identified by their workspace, channel and
+    client_msg_id or ts, events without either are never considered duplicates.
+    """
+    def __init__(self, window=EVENT_DEDUP_WINDOW, size=EVENT_DEDUP_SIZE):
+        self.window = window
+        self.size = size
+        self._seen = set()
+        self._received = deque()  # (time received, key), oldest first
+        self._lock = Lock()
+
+    @staticmethod
+    def key(event):
+        message_id = event.get('client_msg_id') or event.get('ts')
+        if not message_id:
+            return None
+
+        return event.get('workspace'), event.get('channel'), message_id
+
+    def is_duplicate(self, event):
+        """
+        Return True if the event was received before, remember it otherwise
+        """
+        key = self.key(event)
+        if key is None:
+            return False
+
+        now = time.time()
+        with self._lock:
+            while self._received and (len(self._received) >= self.size or self._received[0][0] <= now - self.window):
+                self._seen.discard(self._received.popleft()[1])
+
+            duplicate = key in self._seen
+            if not duplicate:
+                self._seen.add(key)
+                self._received.append((now, key))
+
+        event_dedup_requests.inc(store='memory', result='hit' if duplicate else 'miss')
+        return duplicate
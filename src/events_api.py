@@ -0,0 +1,140 @@
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from conf import DEFAULT_WORKSPACE, EVENTS_MAX_BODY_SIZE, EVENTS_SIGNATURE_MAX_AGE, SLACK_SIGNING_SECRET, SLACK_WORKSPACES
+
+logger = logging.getLogger(__name__)
+
+
+def signature(signing_secret, timestamp, body):
+    """
+    Slack's v0 request signature of `body` (bytes) sent at `timestamp`
+    """
+    base = b'v0:' + str(timestamp).encode('ascii') + b':' + body
+    return 'v0=' + hmac.new(signing_secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+
+
+def verify_signature(signing_secret, timestamp, body, signed, now=None):
+    """
+    Whether `signed` is the signature of `body` and `timestamp` is recent enough to rule out a replayed request
+    """
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except (TypeError, ValueError):
+        return False
+
+    if age > EVENTS_SIGNATURE_MAX_AGE or not signed:
+        return False
+
+    return hmac.compare_digest(str(signature(signing_secret, timestamp, body)), str(signed))
+
+
+def signed_request(signing_secret, payload, timestamp=None):
+    """
+    Encode an Events API `payload` and sign it the way Slack does. Returns the body and its headers.
+    """
+    timestamp = int(timestamp or time.time())
+    body = json.dumps(payload).encode('utf-8')
+    return body, {
+        'Content-Type': 'application/json',
+        'X-Slack-Request-Timestamp': str(timestamp),
+        'X-Slack-Signature': signature(signing_secret, timestamp, body),
+    }
+
+
+class EventsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = None
+
+        if length is None or length > EVENTS_MAX_BODY_SIZE:
+            self.close_connection = True  # The body is left unread
+            return self._respond(411 if length is None else 413)
+
+        body = self.rfile.read(length)
+        if not verify_signature(
+            self.server.signing_secret,
+            self.headers.get('X-Slack-Request-Timestamp'),
+            body,
+            self.headers.get('X-Slack-Signature')
+        ):
+            logger.warning('Rejected an Events API request with a bad signature')
+            return self._respond(401)
+
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return self._respond(400)
+
+        if payload.get('type') == 'url_verification':
+            return self._respond(200, json.dumps({'challenge': payload.get('challenge')}), 'application/json')
+
+        # Acknowledge straight away: Slack retries events that are not acknowledged within 3 seconds
+        self._respond(200)
+        if payload.get('type') == 'event_callback' and isinstance(payload.get('event'), dict):
+            workspace = self.server.workspace_for(payload.get('team_id'))
+            if workspace is None:
+                logger.warning('Ignoring an event from team %s, which is not configured', payload.get('team_id'))
+                return
+
+            event = payload['event']
+            event['workspace'] = workspace
+            self.server.listener.receive(event)
+
+    def _respond(self, status, body='', content_type='text/plain'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class EventsServer(ThreadingMixIn, HTTPServer):
+    """
+    Receives Slack Events API requests and hands their events to `listener`, which dispatches them from its worker
+    pool. It keeps no state of its own so several replicas can run behind a load balancer.
+    """
+    daemon_threads = True
+
+    def __init__(self, listener, port, host='', signing_secret=SLACK_SIGNING_SECRET, workspaces=SLACK_WORKSPACES):
+        if not signing_secret:
+            raise ValueError('The Events API needs SLACK_SIGNING_SECRET to verify requests')
+
+        HTTPServer.__init__(self, (host, port), EventsHandler)
+        self.listener = listener
+        self.signing_secret = signing_secret
+        self.workspaces = workspaces
+
+    def workspace_for(self, team_id):
+        """
+        The workspace of a Slack team: its own if it is configured, the default workspace otherwise (if there is one)
+        """
+        if team_id in self.workspaces:
+            return team_id
+        return DEFAULT_WORKSPACE if DEFAULT_WORKSPACE in self.workspaces else None
+
+    def serve_in_background(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,103 @@
+import logging
+import random
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from conf import GIF_CACHE_SIZE, GIF_CACHE_TTL, GIF_RETRY_TTL, GIF_SEARCH_LIMIT
+from metrics import gif_cache_requests, giphy_duration
+
+logger = logging.getLogger(__name__)
+
+
+class GifCache(object):
+    """
+    In-memory pool of GIF urls per search phrase. Lookups never call Giphy: a missing or expired phrase is
+    (re)fetched on a background thread and the lookup is served from whatever is cached at the time.
+    A failed search keeps the phrase's cached urls, or caches none, for `retry_ttl` seconds before the next one.
+    The least recently used phrases are evicted once more than `size` phrases are cached. Without a `client` a Giphy
+    one is created by the first fetch, which keeps giphypop out of teabot's startup.
+    """
+    def __init__(self, client=None, ttl=GIF_CACHE_TTL, size=GIF_CACHE_SIZE, limit=GIF_SEARCH_LIMIT,
+                 retry_ttl=GIF_RETRY_TTL):
+        self._client = client
+        self.ttl = ttl
+        self.retry_ttl = retry_ttl
+        self.size = size
+        self.limit = limit
+        self._entries = OrderedDict()  # phrase -> (expires_at, urls)
+        self._refreshing = set()
+        self._lock = Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            from giphypop import Giphy
+            self._client = Giphy()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def get(self, phrase):
+        """
+        Return a random cached url for `phrase` or None if nothing has been fetched for it yet
+        """
+        with self._lock:
+            entry = self._entries.pop(phrase, None)
+            if entry is not None:
+                self._entries[phrase] = entry  # Mark as most recently used
+
+        if entry is None:
+            gif_cache_requests.inc(result='miss')
+            self.refresh_async(phrase)
+        elif entry[0] <= time.time():
+            gif_cache_requests.inc(result='stale')
+            self.refresh_async(phrase)
+        else:
+            gif_cache_requests.inc(result='hit')
+
+        if entry is None or not entry[1]:
+            return None
+
+        return random.choice(entry[1])
+
+    def prefetch(self, phrases):
+        for phrase in phrases:
+            self.refresh_async(phrase)
+
+    def refresh_async(self, phrase):
+        with self._lock:
+            if phrase in self._refreshing:
+                return
+            self._refreshing.add(phrase)
+
+        thread = Thread(target=self.refresh, args=(phrase,))
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self, phrase):
+        from giphypop import GiphyApiException
+
+        try:
+            with giphy_duration.time(outcome='ok'):
+                urls = [gif.media_url for gif in self.client.search(phrase=phrase, limit=self.limit)]
+        except (GiphyApiException, IOError):  # Keep serving what we have if Giphy is unavailable
+            logger.warning('Could not fetch GIFs for "%s"', phrase)
+            with self._lock:
+                entry = self._entries.get(phrase)
+                self._store(phrase, time.time() + self.retry_ttl, entry[1] if entry else [])
+            return
+        finally:
+            with self._lock:
+                self._refreshing.discard(phrase)
+
+        with self._lock:
+            self._store(phrase, time.time() + self.ttl, urls)
+
+    def _store(self, phrase, expires_at, urls):
+        self._entries.pop(phrase, None)
+        self._entries[phrase] = (expires_at, urls)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
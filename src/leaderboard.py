@@ -0,0 +1,115 @@
+import logging
+from bisect import bisect_left, insort
+from threading import Lock
+
+from conf import DEFAULT_WORKSPACE
+from models import User, current_workspace, get_session
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard(object):
+    """
+    Registered users of a workspace ordered by the number of teas they have brewed. It is loaded from the database on
+    first use and then kept up to date in memory, so reading it does not touch the database.
+    """
+    def __init__(self, workspace=DEFAULT_WORKSPACE):
+        self.workspace = workspace
+        self._ranking = []  # Sorted (-teas_brewed, user_id) keys
+        self._users = {}  # user_id -> (teas_brewed, real_name)
+        self._lock = Lock()
+        self.loaded = False
+
+    def load(self):
+        users = self._registered_users()
+        with self._lock:
+            self._users = dict((user_id, (teas_brewed, real_name)) for user_id, real_name, teas_brewed in users)
+            self._ranking = sorted((-teas_brewed, user_id) for user_id, (teas_brewed, _) in self._users.items())
+            self.loaded = True
+
+    def reset(self):
+        with self._lock:
+            self._users = {}
+            self._ranking = []
+            self.loaded = False
+
+    def update(self, user_id, real_name, teas_brewed):
+        with self._lock:
+            if not self.loaded:
+                return  # Picked up from the database when it is loaded
+            self._remove(user_id)
+            self._users[user_id] = (teas_brewed, real_name)
+            insort(self._ranking, (-teas_brewed, user_id))
+
+    def add_brewed(self, user_id, teas):
+        with self._lock:
+            if not self.loaded or user_id not in self._users:
+                return
+            teas_brewed, real_name = self._users[user_id]
+            self._remove(user_id)
+            self._users[user_id] = (teas_brewed + teas, real_name)
+            insort(self._ranking, (-(teas_brewed + teas), user_id))
+
+    def top(self, limit=None):
+        """
+        Return (real_name, teas_brewed) for the best `limit` brewers (or everyone)
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return [(self._users[user_id][1], -key) for key, user_id in self._ranking[:limit]]
+
+    def rank(self, user_id):
+        """
+        Return the 1-based position of the user or None if they are not on the leaderboard
+        """
+        self._ensure_loaded()
+        with self._lock:
+            if user_id not in self._users:
+                return None
+            return bisect_left(self._ranking, (-self._users[user_id][0], user_id)) + 1
+
+    def check(self):
+        """
+        Compare with the counters stored on `User` and return the ids of the users that have drifted
+        """
+        users = self._registered_users()
+        expected = dict((user_id, (teas_brewed, real_name)) for user_id, real_name, teas_brewed in users)
+        with self._lock:
+            if not self.loaded:
+                return []
+            actual = dict(self._users)
+
+        return sorted(
+            user_id for user_id in set(expected) | set(actual) if expected.get(user_id) != actual.get(user_id)
+        )
+
+    def _registered_users(self):
+        return get_session().query(User.id, User.real_name, User.teas_brewed).filter(
+            User.workspace == self.workspace, User.tea_type.isnot(None)
+        )
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def _remove(self, user_id):
+        if user_id in self._users:
+            key = (-self._users.pop(user_id)[0], user_id)
+            del self._ranking[bisect_left(self._ranking, key)]
+
+
+class Leaderboards(dict):
+    """
+    The leaderboard of every workspace, created when first needed
+    """
+    def __missing__(self, workspace):
+        return self.setdefault(workspace, Leaderboard(workspace))
+
+    def current(self):
+        """
+        The leaderboard of the current unit of work's workspace
+        """
+        return self[current_workspace()]
+
+
+leaderboards = Leaderboards()
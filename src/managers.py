@@ -1,23 +1,196 @@
-from models import get_session, User, Server, Customer
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Lock
+
+from sqlalchemy import literal, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from clock import clock
+from conf import EVENT_CLAIM_TTL, USER_CACHE_SIZE
+from metrics import identity_cache_requests
+from models import current_workspace, get_session, EventClaim, User, Server, Customer
+
+
+class UserIdentity(object):
+    """
+    Read-only snapshot of the user fields needed to handle a command
+    """
+    __slots__ = ('id', 'workspace', 'slack_id', 'username', 'first_name', 'real_name', 'tea_type')
+
+    def __init__(self, user):
+        for field in self.__slots__:
+            setattr(self, field, getattr(user, field))
+
+    @property
+    def display_name(self):
+        return self.first_name or self.username
+
+
+class IdentityCache(object):
+    """
+    Bounded LRU cache of UserIdentity entries keyed by workspace and slack id
+    """
+    def __init__(self, size=USER_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            identity = self._entries.pop(key, None)
+            if identity is None:
+                identity_cache_requests.inc(result='miss')
+                return None
+
+            self._entries[key] = identity
+            identity_cache_requests.inc(result='hit')
+            return identity
+
+    def set(self, key, identity):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = identity
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
 
 
 class UserManager(object):
+    identities = IdentityCache()
+
     @classmethod
     def get_by_slack_id(cls, slack_id):
-        return get_session().query(User).filter_by(slack_id=slack_id).first()
+        return get_session().query(User).filter_by(workspace=current_workspace(), slack_id=slack_id).first()
 
     @classmethod
     def get_by_username(cls, username):
-        return get_session().query(User).filter_by(username=username).first()
+        return get_session().query(User).filter_by(workspace=current_workspace(), username=username).first()
+
+    @classmethod
+    def get_identity(cls, slack_id):
+        """
+        Like get_by_slack_id but served from memory after the first lookup. The result can't be used for writes.
+        """
+        key = (current_workspace(), slack_id)
+        identity = cls.identities.get(key)
+        if identity is None:
+            user = cls.get_by_slack_id(slack_id)
+            if user is None:
+                return None
+
+            identity = UserIdentity(user)
+            cls.identities.set(key, identity)
+
+        return identity
+
+    @classmethod
+    def invalidate(cls, slack_id=None):
+        """
+        Drop the cached identity of a user of the current workspace, or of every user if no slack id is given
+        """
+        cls.identities.invalidate((current_workspace(), slack_id) if slack_id else None)
 
 
 class ServerManager(object):
     @classmethod
-    def has_active_server(cls):
-        return bool(get_session().query(Server).filter_by(completed=False).count())
+    def get_active_server(cls, channel):
+        return get_session().query(Server).filter_by(
+            workspace=current_workspace(), channel=channel, completed=False
+        ).first()
+
+    @classmethod
+    def has_active_server(cls, channel):
+        return get_session().query(Server.id).filter_by(
+            workspace=current_workspace(), channel=channel, completed=False
+        ).first() is not None
+
+    @classmethod
+    def start_brew(cls, channel, user_id, limit=None):
+        """
+        Start a brew in the channel, in a transaction of its own. Returns the new server, or None if the channel has an
+        active brew already: the unique index on active brews rejects the second of two brews started at once.
+        """
+        session = get_session()
+        server = Server(user_id=user_id, limit=limit, channel=channel, workspace=current_workspace())
+        session.add(server)
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return None
+        return server
+
+    @classmethod
+    def join(cls, channel, user_id):
+        """
+        Add the user to the channel's active brew, in a transaction of its own. The brew's customer count is bumped by
+        a conditional update, which can't go over the brew's limit however many people join at once, and the unique
+        (server, user) index rejects users who have joined already.
+        Returns True if the user joined, False if they had already and None if there is no brew they can join
+        (there is none, they are brewing it or it is full). A channel has at most one active brew, so the brew being
+        joined is the only one the customer insert can select.
+        """
+        session = get_session()
+        workspace = current_workspace()
+        joinable = session.query(Server).filter_by(workspace=workspace, channel=channel, completed=False).filter(
+            Server.user_id != user_id,
+            or_(Server.limit.is_(None), Server.customer_count + 1 < Server.limit)  # The limit includes the server's cup
+        ).update({Server.customer_count: Server.customer_count + 1}, synchronize_session=False)
+        if not joinable:
+            return None
+
+        active_server = session.query(Server.id).filter_by(workspace=workspace, channel=channel, completed=False)
+        try:
+            session.execute(Customer.__table__.insert().from_select(
+                ['workspace', 'user_id', 'server_id'],
+                select([literal(workspace), literal(user_id), active_server.as_scalar()])
+            ))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
+        return True
 
 
 class CustomerManager(object):
     @classmethod
     def get_for_user_server(cls, user_id, server_id):
         return get_session().query(Customer).filter_by(user_id=user_id, server_id=server_id).first()
+
+
+class EventClaimManager(object):
+    @classmethod
+    def claim(cls, event):
+        """
+        Claim an event for this replica, in a transaction of its own so the other replicas see the claim straight away.
+        Returns False if another replica claimed it first. Events without a timestamp can't be told apart and are
+        always claimed.
+        """
+        if not event.get('ts'):
+            return True
+
+        session = get_session()
+        session.add(EventClaim(workspace=current_workspace(), channel=event.get('channel', ''), ts=event['ts']))
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def prune(cls):
+        """
+        Delete the claims of events too old to be delivered again
+        """
+        session = get_session()
+        session.query(EventClaim).filter(
+            EventClaim.claimed < clock.utcnow() - timedelta(seconds=EVENT_CLAIM_TTL)
+        ).delete(synchronize_session=False)
+        session.commit()
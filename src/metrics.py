@@ -0,0 +1,285 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+from sqlalchemy import event
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker(object):
+    """
+    Rolling window of latency samples (in seconds) that can report percentiles
+    """
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, percent):
+        with self._lock:
+            samples = sorted(self._samples)
+
+        if not samples:
+            return None
+
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs
+    )
+
+
+class Counter(object):
+    """
+    Monotonic counter with one series per combination of label values
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._series.get(tuple(labels[name] for name in self.labels), 0)
+
+    def samples(self):
+        with self._lock:
+            series = sorted(self._series.items())
+
+        for key, value in series:
+            yield '%s%s %s' % (self.name, _format_labels(self.labels, key), value)
+
+
+class Gauge(object):
+    """
+    Value read when the registry is rendered, from the function given to `set_function`
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._function = None
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self):
+        return self._function() if self._function else 0
+
+    def samples(self):
+        yield '%s %s' % (self.name, self.value())
+
+
+class Timer(object):
+    """
+    Context manager observing the duration of its block. The labels can be filled in while the block runs and
+    `outcome`, if it is one of the histogram's labels, is set to "error" when the block raises.
+    """
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and 'outcome' in self.histogram.labels:
+            self.labels['outcome'] = 'error'
+        self.histogram.observe(time.time() - self.started, **self.labels)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of durations (in seconds) with one series per combination of label values
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def count(self, **labels):
+        series = self._series.get(tuple(labels[name] for name in self.labels))
+        return series[2] if series else 0
+
+    def samples(self):
+        with self._lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '%s_bucket%s %s' % (self.name, _format_labels(self.labels, key, [('le', repr(float(bound)))]), cumulative)
+            yield '%s_bucket%s %s' % (self.name, _format_labels(self.labels, key, [('le', '+Inf')]), count)
+            yield '%s_sum%s %r' % (self.name, _format_labels(self.labels, key), total)
+            yield '%s_count%s %s' % (self.name, _format_labels(self.labels, key), count)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation):
+        metric = Gauge(name, documentation)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+command_duration = registry.histogram(
+    'teabot_command_duration_seconds', 'Time to dispatch a command', ['command', 'outcome']
+)
+brew_countdown_duration = registry.histogram(
+    'teabot_brew_countdown_duration_seconds', 'Time to complete a brew once its countdown is over', ['outcome']
+)
+database_duration = registry.histogram(
+    'teabot_database_statement_duration_seconds', 'Time to execute a SQL statement', ['statement']
+)
+slack_api_duration = registry.histogram(
+    'teabot_slack_api_duration_seconds', 'Time to call a Slack Web API method, retries included', ['method', 'outcome']
+)
+slack_api_retries = registry.counter(
+    'teabot_slack_api_retries_total', 'Slack Web API calls retried', ['method', 'reason']
+)
+slack_messages = registry.counter(
+    'teabot_slack_messages_total', 'Slack Web API calls sent or given up on by the sender', ['outcome']
+)
+sender_queue_depth = registry.gauge('teabot_sender_queue_depth', 'Slack Web API calls waiting to be sent')
+giphy_duration = registry.histogram('teabot_giphy_search_duration_seconds', 'Time to search Giphy', ['outcome'])
+gif_cache_requests = registry.counter('teabot_gif_cache_requests_total', 'GIF cache lookups', ['result'])
+identity_cache_requests = registry.counter(
+    'teabot_identity_cache_requests_total', 'User identity cache lookups', ['result']
+)
+response_cache_requests = registry.counter(
+    'teabot_response_cache_requests_total', 'Cached reply lookups of read-only commands', ['result']
+)
+event_dedup_requests = registry.counter(
+    'teabot_event_dedup_requests_total', 'Events checked for duplicates, in memory or against the replicas\' claims',
+    ['store', 'result']
+)
+
+
+def instrument_engine(engine):
+    """
+    Time every SQL statement executed through `engine`, labelled by its verb (SELECT, INSERT...)
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_metrics_started', None)
+        if started is not None:
+            database_duration.observe(time.time() - started, statement=statement.split(None, 1)[0].upper())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, host=''):
+    """
+    Serve the registry on http://host:port/metrics from a daemon thread
+    """
+    server = MetricsServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on port %s', server.server_address[1])
+    return server
@@ -0,0 +1,323 @@
+"""
+Versioned, non-destructive schema migrations. Every migration runs once, in order, and records its number in the
+`schema_version` table. Migrations only ever add tables, columns and indexes that are missing so they are safe
+to run against databases created by any earlier version of teabot.
+"""
+import logging
+from collections import Counter
+
+from sqlalchemy import (
+    Boolean, Column, Date, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, UniqueConstraint, func,
+    inspect, select, text
+)
+from sqlalchemy.schema import AddConstraint, CreateTable
+
+from models import engine
+from rollups import rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('applied', DateTime, default=func.current_timestamp()),
+)
+
+
+# Every migration uses the table definitions of its own version below, never the current models, so replaying the
+# migrations on an old database builds the schema each of them knew whatever the models look like by then. Tables a
+# migration only adds columns or indexes to just define those.
+def _user_columns():
+    return [
+        Column('email', String(255), nullable=True),
+        Column('real_name', String(255), nullable=True),
+        Column('first_name', String(255), nullable=True),
+        Column('last_name', String(255), nullable=True),
+        Column('deleted', Boolean),
+        Column('profile_hash', String(40), nullable=True),
+        Column('nomination_points', Integer, nullable=False),
+        Column('tea_type', String(1024)),
+        Column('teas_brewed', Integer, nullable=False),
+        Column('teas_drunk', Integer, nullable=False),
+        Column('teas_received', Integer, nullable=False),
+        Column('times_brewed', Integer, nullable=False),
+        Index('ix_user_tea_type_teas_brewed', 'tea_type', 'teas_brewed'),
+    ]
+
+
+def _stats_table(name, period, metadata):
+    return Table(
+        name, metadata,
+        Column('id', Integer, primary_key=True),
+        Column(period, Date, nullable=False),
+        Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+        Column('teas_brewed', Integer, nullable=False),
+        Column('teas_drunk', Integer, nullable=False),
+        Column('teas_received', Integer, nullable=False),
+        Column('times_brewed', Integer, nullable=False),
+        UniqueConstraint(period, 'user_id'),
+    )
+
+
+schema_1 = MetaData()
+user_1 = Table(
+    'user', schema_1,
+    Column('id', Integer, primary_key=True),
+    Column('slack_id', String(255), unique=True),
+    Column('username', String(255), unique=True),
+    *_user_columns()
+)
+server_1 = Table(
+    'server', schema_1,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('user.id')),
+    Column('completed', Boolean),
+    Column('limit', Integer, nullable=True),
+    Column('channel', String(255), nullable=True),
+    Column('deadline', DateTime),
+    Column('created', DateTime),
+    Index('ix_server_channel_completed', 'channel', 'completed'),
+    Index('ix_server_completed', 'completed'),
+)
+customer_1 = Table(
+    'customer', schema_1,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('user.id')),
+    Column('server_id', Integer, ForeignKey('server.id')),
+    Column('created', DateTime),
+    Index('ix_customer_server_user', 'server_id', 'user_id'),
+)
+daily_stats_1 = _stats_table('daily_stats', 'day', schema_1)
+weekly_stats_1 = _stats_table('weekly_stats', 'week', schema_1)
+
+schema_4 = MetaData()
+user_4 = Table(
+    'user', schema_4,
+    Column('id', Integer, primary_key=True),
+    Column('workspace', String(32), nullable=False, server_default='default'),
+    Column('slack_id', String(255)),
+    Column('username', String(255)),
+    UniqueConstraint('workspace', 'slack_id', name='uq_user_workspace_slack_id'),
+    UniqueConstraint('workspace', 'username', name='uq_user_workspace_username'),
+    *_user_columns()
+)
+server_4 = Table('server', schema_4, Column('workspace', String(32), nullable=False, server_default='default'))
+customer_4 = Table('customer', schema_4, Column('workspace', String(32), nullable=False, server_default='default'))
+
+schema_5 = MetaData()
+event_claim_5 = Table(
+    'event_claim', schema_5,
+    Column('id', Integer, primary_key=True),
+    Column('workspace', String(32), nullable=False),
+    Column('channel', String(255), nullable=False),
+    Column('ts', String(32), nullable=False),
+    Column('claimed', DateTime, nullable=False),
+    UniqueConstraint('workspace', 'channel', 'ts', name='uq_event_claim'),
+    Index('ix_event_claim_claimed', 'claimed'),
+)
+
+schema_6 = MetaData()
+user_6 = Table(
+    'user', schema_6,
+    Column('id', Integer, primary_key=True),
+    Column('teas_brewed', Integer),
+    Column('teas_drunk', Integer),
+    Column('teas_received', Integer),
+)
+server_6 = Table(
+    'server', schema_6,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer),
+    Column('completed', Boolean),
+    Column('customer_count', Integer, nullable=False, server_default='0'),
+)
+customer_6 = Table(
+    'customer', schema_6,
+    Column('id', Integer, primary_key=True),
+    Column('server_id', Integer),
+    Column('user_id', Integer),
+    Index('uq_customer_server_user', 'server_id', 'user_id', unique=True),
+)
+
+schema_7 = MetaData()
+server_7 = Table(
+    'server', schema_7,
+    Column('id', Integer, primary_key=True),
+    Column('completed', Boolean),
+    Column('workspace', String(32)),
+    Column('channel', String(255)),
+    Index(
+        'uq_server_active_channel', 'workspace', 'channel', unique=True,
+        sqlite_where=text('completed = 0'), postgresql_where=text('NOT completed')
+    ),
+)
+
+MIGRATIONS = []
+
+
+def migration(fn):
+    MIGRATIONS.append(fn)
+    return fn
+
+
+def _add_column(connection, column):
+    table = column.table.name
+    if column.name in [existing['name'] for existing in inspect(connection).get_columns(table)]:
+        return
+
+    ddl = 'ALTER TABLE "%s" ADD COLUMN %s %s' % (table, column.name, column.type.compile(dialect=connection.dialect))
+    if column.server_default is not None:  # Existing rows get the default, which allows NOT NULL
+        ddl += " NOT NULL DEFAULT '%s'" % column.server_default.arg.replace("'", "''")
+    connection.execute(ddl)
+
+
+def _add_missing_indexes(connection, table):
+    existing = [index['name'] for index in inspect(connection).get_indexes(table.name)]
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(connection)
+
+
+def _rebuild_table(connection, table):
+    """
+    Recreate `table` with the given definition and copy its rows over, for the changes SQLite's ALTER TABLE can't
+    make (like dropping a constraint). Every column of the definition must already exist in the database.
+    """
+    rebuilt = table.tometadata(MetaData(), name='%s_rebuilt' % table.name)
+    columns = ', '.join('"%s"' % column.name for column in table.columns)
+    connection.execute(CreateTable(rebuilt))
+    connection.execute('INSERT INTO "%s" (%s) SELECT %s FROM "%s"' % (rebuilt.name, columns, columns, table.name))
+    connection.execute('DROP TABLE "%s"' % table.name)
+    connection.execute('ALTER TABLE "%s" RENAME TO "%s"' % (rebuilt.name, table.name))
+    for index in table.indexes:
+        index.create(connection)
+
+
+@migration
+def create_missing_tables(connection):
+    """
+    Create the tables missing from the database. Rollups added to a database with brews are rebuilt from its history.
+    """
+    existing = inspect(connection).get_table_names()
+    schema_1.create_all(connection)
+    if daily_stats_1.name not in existing or weekly_stats_1.name not in existing:
+        rebuild_rollups(connection, server_1, customer_1, daily_stats_1, weekly_stats_1)
+
+
+@migration
+def add_server_channel_deadline_and_profile_hash(connection):
+    _add_column(connection, server_1.c.channel)
+    _add_column(connection, server_1.c.deadline)
+    _add_column(connection, user_1.c.profile_hash)
+
+
+@migration
+def add_missing_indexes(connection):
+    for table in schema_1.sorted_tables:
+        _add_missing_indexes(connection, table)
+
+
+@migration
+def partition_by_workspace(connection):
+    """
+    Add the workspace columns and make slack ids and usernames unique per workspace instead of globally
+    """
+    for table in (user_4, server_4, customer_4):
+        _add_column(connection, table.c.workspace)
+
+    global_constraints = [
+        constraint for constraint in inspect(connection).get_unique_constraints(user_4.name)
+        if constraint['column_names'] in (['slack_id'], ['username'])
+    ]
+    if not global_constraints:
+        return
+
+    if connection.dialect.name == 'sqlite':
+        _rebuild_table(connection, user_4)
+        return
+
+    for constraint in global_constraints:
+        connection.execute('ALTER TABLE "%s" DROP CONSTRAINT "%s"' % (user_4.name, constraint['name']))
+    for constraint in user_4.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            connection.execute(AddConstraint(constraint))
+
+
+@migration
+def add_event_claim_table(connection):
+    event_claim_5.create(connection, checkfirst=True)
+
+
+@migration
+def unique_customers_and_customer_count(connection):
+    """
+    Drop the duplicate customers racing joins could create, then make them unique and count every brew's customers.
+    Completing a brew counted a cup for every customer row, so the cups of the duplicates are taken back from the
+    counters of their users and brewers (as the rollups, rebuilt without duplicates, never counted them).
+    """
+    first = select([func.min(customer_6.c.id)]).group_by(customer_6.c.server_id, customer_6.c.user_id)
+    served, brewed = Counter(), Counter()
+    for user_id, server_user_id in connection.execute(
+        select([customer_6.c.user_id, server_6.c.user_id]).select_from(
+            customer_6.join(server_6, customer_6.c.server_id == server_6.c.id)
+        ).where(customer_6.c.id.notin_(first) & server_6.c.completed.is_(True))
+    ):
+        served[user_id] += 1
+        brewed[server_user_id] += 1
+    for user_id, cups in served.items():
+        connection.execute(user_6.update().where(user_6.c.id == user_id).values(
+            teas_drunk=user_6.c.teas_drunk - cups, teas_received=user_6.c.teas_received - cups
+        ))
+    for user_id, cups in brewed.items():
+        connection.execute(
+            user_6.update().where(user_6.c.id == user_id).values(teas_brewed=user_6.c.teas_brewed - cups)
+        )
+
+    removed = connection.execute(customer_6.delete().where(customer_6.c.id.notin_(first))).rowcount
+    if removed:
+        logger.warning('Removed %s duplicate customers and the %s cups counted for them', removed, sum(served.values()))
+
+    existing = [index['name'] for index in inspect(connection).get_indexes(customer_6.name)]
+    _add_missing_indexes(connection, customer_6)
+    if 'ix_customer_server_user' in existing:  # Superseded by the unique index on the same columns
+        connection.execute('DROP INDEX "ix_customer_server_user"')
+
+    _add_column(connection, server_6.c.customer_count)
+    connection.execute(
+        'UPDATE server SET customer_count = (SELECT count(*) FROM customer WHERE customer.server_id = server.id)'
+    )
+
+
+@migration
+def unique_active_brews(connection):
+    """
+    Allow one active brew per channel. Extra brews racing brew commands could start are completed, keeping the first.
+    """
+    first = select([func.min(server_7.c.id)]).where(server_7.c.completed.is_(False)).group_by(
+        server_7.c.workspace, server_7.c.channel
+    )
+    extra = connection.execute(server_7.update().where(
+        server_7.c.completed.is_(False) & server_7.c.id.notin_(first)
+    ).values(completed=True)).rowcount
+    if extra:
+        logger.warning('Completed %s extra active brews, only the first brew of a channel stays active', extra)
+    _add_missing_indexes(connection, server_7)
+
+
+def current_version(connection):
+    schema_version.create(connection, checkfirst=True)
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def migrate(bind=engine):
+    """
+    Apply every pending migration and return the resulting schema version
+    """
+    with bind.begin() as connection:
+        version = current_version(connection)
+        for number, fn in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info('Applying migration %s: %s', number, fn.__name__)
+            fn(connection)
+            connection.execute(schema_version.insert(), version=number)
+
+    return len(MIGRATIONS)
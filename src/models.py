@@ -1,10 +1,57 @@
-from sqlalchemy import Boolean, Column, String, DateTime, ForeignKey, Integer, func, create_engine
-from sqlalchemy.orm import relationship, sessionmaker, scoped_session
+from contextlib import contextmanager
+from datetime import timedelta
+
+from sqlalchemy import (
+    Boolean, Column, Date, String, DateTime, ForeignKey, Index, Integer, UniqueConstraint, event, func, create_engine, text
+)
+from sqlalchemy.orm import backref, relationship, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
-from conf import SQLALCHEMY_ENGINE
+from clock import clock
+from conf import (
+    BREW_COUNTDOWN, DEFAULT_WORKSPACE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_RECYCLE, DATABASE_POOL_SIZE, DATABASE_POOL_TIMEOUT,
+    DATABASE_PROFILE, SQLALCHEMY_ENGINE, SQLITE_BUSY_TIMEOUT
+)
+from metrics import instrument_engine
+
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')  # Readers don't block the writer and vice versa
+    cursor.execute('PRAGMA synchronous=NORMAL')  # Safe with WAL, fsyncs only at checkpoints
+    cursor.execute('PRAGMA busy_timeout=%d' % (SQLITE_BUSY_TIMEOUT * 1000))
+    cursor.close()
+
+
+def make_engine(url=SQLALCHEMY_ENGINE, profile=DATABASE_PROFILE):
+    if profile == 'sqlite':
+        options = {}
+        if url.rstrip('/') != 'sqlite:' and ':memory:' not in url:
+            # Keep a pool of file connections shared by the worker threads instead of reopening one per session
+            options = dict(poolclass=QueuePool, pool_size=DATABASE_POOL_SIZE, max_overflow=DATABASE_MAX_OVERFLOW)
+        _engine = create_engine(
+            url, echo=False, connect_args={'timeout': SQLITE_BUSY_TIMEOUT, 'check_same_thread': False}, **options
+        )
+        event.listen(_engine, 'connect', _configure_sqlite_connection)
+        return _engine
+
+    if profile == 'server':
+        return create_engine(
+            url,
+            echo=False,
+            poolclass=QueuePool,
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_recycle=DATABASE_POOL_RECYCLE,
+            pool_timeout=DATABASE_POOL_TIMEOUT
+        )
+
+    raise ValueError('Unknown database profile %r' % profile)
+
 
-engine = create_engine(SQLALCHEMY_ENGINE, echo=False)
+engine = make_engine()
+instrument_engine(engine)
 Base = declarative_base()
 
 session_factory = sessionmaker(bind=engine)
@@ -15,16 +62,53 @@ def get_session():
     return Session()
 
 
+@contextmanager
+def unit_of_work(workspace=DEFAULT_WORKSPACE):
+    """
+    Scope the thread's session to one unit of work (an event, a countdown...) in a workspace. It is committed if the
+    block succeeds, rolled back if it raises and removed either way, so loaded objects don't pile up in long running
+    threads.
+    """
+    session = Session()
+    session.info['workspace'] = workspace
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
+
+def current_workspace():
+    """
+    The workspace of the thread's unit of work, whose data queries are limited to
+    """
+    return get_session().info.get('workspace', DEFAULT_WORKSPACE)
+
+
+def brew_deadline():
+    return clock.utcnow() + timedelta(seconds=BREW_COUNTDOWN)
+
+
 class User(Base):
     __tablename__ = 'user'
+    __table_args__ = (
+        Index('ix_user_tea_type_teas_brewed', 'tea_type', 'teas_brewed'),  # Registered users and the leaderboard
+        UniqueConstraint('workspace', 'slack_id', name='uq_user_workspace_slack_id'),
+        UniqueConstraint('workspace', 'username', name='uq_user_workspace_username'),
+    )
     id = Column(Integer, primary_key=True)
-    slack_id = Column(String(255), unique=True)
-    username = Column(String(255), unique=True)
+    workspace = Column(String(32), nullable=False, default=DEFAULT_WORKSPACE, server_default=DEFAULT_WORKSPACE)
+    slack_id = Column(String(255))
+    username = Column(String(255))
     email = Column(String(255), nullable=True)
     real_name = Column(String(255), nullable=True)
     first_name = Column(String(255), nullable=True)
     last_name = Column(String(255), nullable=True)
     deleted = Column(Boolean, default=False)
+    profile_hash = Column(String(40), nullable=True)  # Hash of the Slack profile fields above, set by update_slack_users
 
     nomination_points = Column(Integer, nullable=False, default=0)
     tea_type = Column(String(1024))
@@ -40,19 +124,89 @@ class User(Base):
 
 class Server(Base):
     __tablename__ = 'server'
+    __table_args__ = (
+        Index('ix_server_channel_completed', 'channel', 'completed'),  # Active brew lookups per channel
+        Index('ix_server_completed', 'completed'),  # Unfinished brews on startup
+        # At most one active brew per channel, even when two are started at once
+        Index(
+            'uq_server_active_channel', 'workspace', 'channel', unique=True,
+            sqlite_where=text('completed = 0'), postgresql_where=text('NOT completed')
+        ),
+    )
     id = Column(Integer, primary_key=True)
+    workspace = Column(String(32), nullable=False, default=DEFAULT_WORKSPACE, server_default=DEFAULT_WORKSPACE)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User', foreign_keys=[user_id])
     completed = Column(Boolean, default=False)
     limit = Column(Integer, default=None, nullable=True)  # An optional limit on the number of teas the server will brew
+    # Kept in step with the customers by the conditional update that lets someone join, so joins can't go over the limit
+    customer_count = Column(Integer, nullable=False, default=0, server_default='0')
+    channel = Column(String(255), nullable=True)  # The channel the brew belongs to
+    deadline = Column(DateTime, default=brew_deadline)  # When the brew countdown ends (UTC)
     created = Column(DateTime, default=func.current_timestamp())
 
 
 class Customer(Base):
     __tablename__ = 'customer'
+    __table_args__ = (
+        # A brew's customers and joining a brew, which nobody can do twice
+        Index('uq_customer_server_user', 'server_id', 'user_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
+    workspace = Column(String(32), nullable=False, default=DEFAULT_WORKSPACE, server_default=DEFAULT_WORKSPACE)
     user_id = Column(Integer, ForeignKey('user.id'))
     server_id = Column(Integer, ForeignKey('server.id'))
     user = relationship('User', foreign_keys=[user_id])
-    server = relationship('Server', foreign_keys=[server_id])
+    server = relationship('Server', foreign_keys=[server_id], backref=backref('customers', order_by='Customer.id'))
     created = Column(DateTime, default=func.current_timestamp())
+
+
+class EventClaim(Base):
+    """
+    A command dispatched by one of the replicas sharing the database. Slack timestamps are unique per channel, so a
+    second claim of the same event fails on the unique constraint.
+    """
+    __tablename__ = 'event_claim'
+    __table_args__ = (
+        UniqueConstraint('workspace', 'channel', 'ts', name='uq_event_claim'),
+        Index('ix_event_claim_claimed', 'claimed'),  # Pruning of old claims
+    )
+    id = Column(Integer, primary_key=True)
+    workspace = Column(String(32), nullable=False)
+    channel = Column(String(255), nullable=False)
+    ts = Column(String(32), nullable=False)
+    claimed = Column(DateTime, nullable=False, default=clock.utcnow)
+
+
+class DailyStats(Base):
+    """
+    Per user counters for a single (UTC) day, kept up to date as brews complete
+    """
+    __tablename__ = 'daily_stats'
+    __table_args__ = (
+        UniqueConstraint('day', 'user_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    teas_brewed = Column(Integer, nullable=False, default=0)
+    teas_drunk = Column(Integer, nullable=False, default=0)
+    teas_received = Column(Integer, nullable=False, default=0)
+    times_brewed = Column(Integer, nullable=False, default=0)
+
+
+class WeeklyStats(Base):
+    """
+    Per user counters for a week, identified by the date of its Monday
+    """
+    __tablename__ = 'weekly_stats'
+    __table_args__ = (
+        UniqueConstraint('week', 'user_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    week = Column(Date, nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    teas_brewed = Column(Integer, nullable=False, default=0)
+    teas_drunk = Column(Integer, nullable=False, default=0)
+    teas_received = Column(Integer, nullable=False, default=0)
+    times_brewed = Column(Integer, nullable=False, default=0)
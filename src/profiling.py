@@ -0,0 +1,180 @@
+import cProfile
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from conf import PROFILE_DIR, PROFILE_REPORT_INTERVAL, PROFILE_SAMPLE_RATE
+from models import engine
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    """
+    Count the SQL statements executed by the current thread while the context manager is active
+    """
+    def __init__(self, bind=engine):
+        self.bind = bind
+        self.statements = []
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.current_thread()
+        event.listen(self.bind, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.bind, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.current_thread() is self._thread:
+            self.statements.append(statement)
+
+
+class EventProfile(object):
+    __slots__ = ('queries', 'db_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+class CommandProfile(object):
+    __slots__ = ('events', 'queries', 'max_queries', 'db_time', 'wall_time')
+
+    def __init__(self):
+        self.events = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.wall_time = 0.0
+
+    def add(self, profile, wall_time):
+        self.events += 1
+        self.queries += profile.queries
+        self.max_queries = max(self.max_queries, profile.queries)
+        self.db_time += profile.db_time
+        self.wall_time += wall_time
+
+
+class Profiler(object):
+    """
+    Opt-in profiling of dispatched events: the number of queries and the time spent in the database per command and,
+    for a sample of events, a cProfile dump written to `dump_dir`
+    """
+    def __init__(self, bind=engine, sample_rate=PROFILE_SAMPLE_RATE, dump_dir=PROFILE_DIR,
+                 report_interval=PROFILE_REPORT_INTERVAL):
+        self.bind = bind
+        self.sample_rate = sample_rate
+        self.dump_dir = dump_dir or tempfile.gettempdir()
+        self.report_interval = report_interval
+        self.enabled = False
+        self.commands = {}
+        self.events = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        if self.enabled:
+            return
+        event.listen(self.bind, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(self.bind, 'after_cursor_execute', self._after_cursor_execute)
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        event.remove(self.bind, 'before_cursor_execute', self._before_cursor_execute)
+        event.remove(self.bind, 'after_cursor_execute', self._after_cursor_execute)
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.events = 0
+
+    @contextmanager
+    def profile(self, command):
+        if not self.enabled:
+            yield None
+            return
+
+        profile = self._local.profile = EventProfile()
+        sampler = cProfile.Profile() if random.random() < self.sample_rate else None
+        started = time.time()
+        try:
+            if sampler:
+                sampler.enable()
+            yield profile
+        finally:
+            if sampler:
+                sampler.disable()
+            self._local.profile = None
+            self._add(command, profile, time.time() - started)
+            if sampler:
+                self._dump(command, sampler)
+
+    def report(self):
+        """
+        One line per command with its average (and worst) number of queries, DB time and total time per event
+        """
+        with self._lock:
+            commands = sorted(self.commands.items())
+
+        lines = ['%-15s %8s %10s %12s %10s %12s' % ('command', 'events', 'queries', 'max queries', 'db (ms)', 'total (ms)')]
+        for command, stats in commands:
+            lines.append('%-15s %8d %10.1f %12d %10.1f %12.1f' % (
+                command,
+                stats.events,
+                float(stats.queries) / stats.events,
+                stats.max_queries,
+                stats.db_time * 1000 / stats.events,
+                stats.wall_time * 1000 / stats.events,
+            ))
+        return '\n'.join(lines)
+
+    def _add(self, command, profile, wall_time):
+        with self._lock:
+            if command not in self.commands:
+                self.commands[command] = CommandProfile()
+            self.commands[command].add(profile, wall_time)
+            self.events += 1
+            report = self.report_interval and self.events % self.report_interval == 0
+
+        if report:
+            logger.info('Profile of the last %s events:\n%s', self.events, self.report())
+
+    def _dump(self, command, sampler):
+        path = os.path.join(self.dump_dir, 'teabot-%s-%d-%d.prof' % (
+            command, int(time.time() * 1000), threading.current_thread().ident
+        ))
+        try:
+            sampler.dump_stats(path)
+        except (IOError, OSError):
+            logger.warning('Could not write profile to %s', path)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile.queries += 1
+            if context is not None:
+                context._profile_started = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = getattr(self._local, 'profile', None)
+        started = getattr(context, '_profile_started', None)
+        if profile is not None and started is not None:
+            profile.db_time += time.time() - started
+
+
+profiler = Profiler()
@@ -0,0 +1,42 @@
+import json
+import time
+from threading import Lock
+
+from conf import DEFAULT_WORKSPACE
+
+
+class EventRecorder(object):
+    """
+    Appends the RTM events the listener reads to a log, one `[received_at, event]` JSON array per line. Every event
+    is recorded with the workspace it was received from.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = Lock()
+
+    def record(self, event):
+        event = dict(event, workspace=event.get('workspace', DEFAULT_WORKSPACE))
+        line = json.dumps([round(time.time(), 3), event], separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_recording(path):
+    """
+    Yield the `(received_at, event)` pairs of a log written by EventRecorder, skipping a truncated last line. Events
+    recorded without a workspace are from the default one.
+    """
+    with open(path) as recording:
+        for line in recording:
+            try:
+                received_at, event = json.loads(line)
+            except ValueError:
+                continue
+            event.setdefault('workspace', DEFAULT_WORKSPACE)
+            yield received_at, event
@@ -0,0 +1,57 @@
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+from conf import RESPONSE_CACHE_SIZE
+from metrics import response_cache_requests
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of the rendered replies of read-only commands. Every workspace has a data version that goes up
+    whenever something the replies show changes (a brew completes, someone registers, the users are synced...).
+    Replies are stored with the version they were rendered at and are stale once it has moved on.
+    """
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        self.size = size
+        self._versions = defaultdict(int)
+        self._entries = OrderedDict()  # (workspace, key) -> (version, reply)
+        self._lock = Lock()
+
+    def version(self, workspace):
+        with self._lock:
+            return self._versions[workspace]
+
+    def bump(self, workspace):
+        """
+        Invalidate every reply cached for the workspace
+        """
+        with self._lock:
+            self._versions[workspace] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, workspace, key):
+        with self._lock:
+            entry = self._entries.pop((workspace, key), None)
+            if entry is None or entry[0] != self._versions[workspace]:
+                response_cache_requests.inc(result='miss')
+                return None
+
+            self._entries[(workspace, key)] = entry
+            response_cache_requests.inc(result='hit')
+            return entry[1]
+
+    def set(self, workspace, key, version, reply):
+        """
+        Cache a reply rendered at `version`, the workspace's version read before rendering it
+        """
+        with self._lock:
+            self._entries.pop((workspace, key), None)
+            self._entries[(workspace, key)] = (version, reply)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+response_cache = ResponseCache()
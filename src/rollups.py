@@ -0,0 +1,137 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql
+
+from clock import clock
+from models import Customer, DailyStats, Server, User, WeeklyStats, current_workspace, get_session
+
+STAT_FIELDS = ('teas_drunk', 'teas_brewed', 'times_brewed', 'teas_received')
+
+WINDOWS = {
+    'today': 'today',
+    'week': 'this week',
+    'month': 'this month',
+}
+
+
+def week_start(day):
+    return day - timedelta(days=day.weekday())
+
+
+def _insert_missing_rows(session, table, rows):
+    """
+    Insert rollup rows, skipping those another transaction inserted since they were found missing: two brews completed
+    at once (by two replicas or pooled connections) would otherwise both insert them and one would fail.
+    """
+    if session.get_bind().dialect.name == 'postgresql':
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        statement = table.insert().prefix_with('OR IGNORE', dialect='sqlite').prefix_with('IGNORE', dialect='mysql')
+    session.execute(statement, rows)
+
+
+def record_brew(session, server_user_id, customer_user_ids, day=None):
+    """
+    Add a completed brew to the daily and weekly rollups. Issues the same handful of statements however many
+    customers there are and leaves committing to the caller.
+    """
+    day = day or clock.utcnow().date()
+    for model, period in ((DailyStats, day), (WeeklyStats, week_start(day))):
+        period_column = model.day if model is DailyStats else model.week
+        user_ids = set(customer_user_ids) | {server_user_id}
+
+        existing = set(
+            user_id for user_id, in session.query(model.user_id).filter(
+                period_column == period, model.user_id.in_(user_ids)
+            )
+        )
+        missing = user_ids - existing
+        if missing:
+            _insert_missing_rows(session, model.__table__, [
+                dict([(period_column.key, period), ('user_id', user_id)] + [(field, 0) for field in STAT_FIELDS])
+                for user_id in missing
+            ])
+
+        if customer_user_ids:
+            session.query(model).filter(period_column == period, model.user_id.in_(customer_user_ids)).update({
+                model.teas_drunk: model.teas_drunk + 1,
+                model.teas_received: model.teas_received + 1,
+            }, synchronize_session=False)
+
+        session.query(model).filter(period_column == period, model.user_id == server_user_id).update({
+            model.teas_brewed: model.teas_brewed + len(customer_user_ids) + 1,
+            model.teas_drunk: model.teas_drunk + 1,
+            model.times_brewed: model.times_brewed + 1,
+        }, synchronize_session=False)
+
+
+def get_stats(window, user_id=None, today=None):
+    """
+    Return (real_name, {field: total}) for every user of the workspace with activity in the window (or just `user_id`).
+    Only the rollup rows inside the window are read.
+    """
+    today = today or clock.utcnow().date()
+    if window == 'today':
+        model, condition = DailyStats, DailyStats.day == today
+    elif window == 'week':
+        model, condition = WeeklyStats, WeeklyStats.week == week_start(today)
+    elif window == 'month':
+        model, condition = DailyStats, DailyStats.day >= today.replace(day=1)
+    else:
+        raise ValueError(window)
+
+    query = get_session().query(
+        User.id, User.real_name, *[func.sum(getattr(model, field)) for field in STAT_FIELDS]
+    ).join(model, model.user_id == User.id).filter(condition)
+
+    if user_id is None:
+        query = query.filter(User.workspace == current_workspace(), User.tea_type.isnot(None))
+    else:
+        query = query.filter(User.id == user_id)
+
+    return [
+        (row[1], dict(zip(STAT_FIELDS, row[2:])))
+        for row in query.group_by(User.id, User.real_name).order_by(User.id)
+    ]
+
+
+def rebuild_rollups(connection=None, servers=Server.__table__, customers=Customer.__table__,
+                    daily_stats=DailyStats.__table__, weekly_stats=WeeklyStats.__table__):
+    """
+    Recreate the rollups from the full brew history, e.g. when they are introduced to an existing database. Works on
+    plain tables so migrations can pass the definitions of their schema version. Uses the session's connection by
+    default and leaves committing to the caller. Brews without a creation time can't be placed and are left out.
+    """
+    connection = connection if connection is not None else get_session().connection()
+
+    brew_customers = defaultdict(set)
+    for server_id, user_id in connection.execute(select([customers.c.server_id, customers.c.user_id])):
+        brew_customers[server_id].add(user_id)
+
+    totals = {daily_stats: defaultdict(Counter), weekly_stats: defaultdict(Counter)}
+    brews = connection.execute(
+        select([servers.c.id, servers.c.user_id, servers.c.created]).where(servers.c.completed.is_(True))
+    )
+    for server_id, server_user_id, created in brews:
+        if created is None:
+            continue
+
+        customer_user_ids = brew_customers[server_id]
+        for table, period in ((daily_stats, created.date()), (weekly_stats, week_start(created.date()))):
+            brewer = totals[table][(period, server_user_id)]
+            brewer['teas_brewed'] += len(customer_user_ids) + 1
+            brewer['teas_drunk'] += 1
+            brewer['times_brewed'] += 1
+            for user_id in customer_user_ids:
+                totals[table][(period, user_id)].update(teas_drunk=1, teas_received=1)
+
+    for table, period_column in ((daily_stats, 'day'), (weekly_stats, 'week')):
+        connection.execute(table.delete())
+        rows = [
+            dict([(period_column, period), ('user_id', user_id)] + [(field, counts[field]) for field in STAT_FIELDS])
+            for (period, user_id), counts in totals[table].items()
+        ]
+        if rows:
+            connection.execute(table.insert(), rows)
@@ -0,0 +1,94 @@
+import itertools
+import logging
+from heapq import heappop, heappush
+from threading import Condition, Thread
+
+from clock import clock
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Runs callables at given (UTC) datetimes from a single thread, however many are pending.
+    Jobs are identified by a key so they can be rescheduled or cancelled. Without a `background` thread due jobs
+    only run when `run_pending` is called.
+    """
+    def __init__(self, background=True):
+        self.background = background
+        self._heap = []
+        self._jobs = {}  # key -> heap entry
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._thread = None
+
+    def schedule(self, key, when, fn, *args):
+        with self._condition:
+            self._cancel(key)
+            entry = [when, next(self._counter), key, fn, args]
+            self._jobs[key] = entry
+            heappush(self._heap, entry)
+
+            if self.background and self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            return self._cancel(key)
+
+    def pending(self):
+        with self._condition:
+            return list(self._jobs)
+
+    def _cancel(self, key):
+        # Cancelled entries stay on the heap and are skipped once they are popped
+        entry = self._jobs.pop(key, None)
+        if entry is None:
+            return False
+
+        entry[3] = None
+        return True
+
+    def run_pending(self):
+        """
+        Run the jobs that are due in the calling thread and return how many ran
+        """
+        ran = 0
+        while True:
+            with self._condition:
+                if not self._heap or self._heap[0][0] > clock.utcnow():
+                    return ran
+                job = self._pop()
+
+            if job:
+                self._call(*job)
+                ran += 1
+
+    def _pop(self):
+        when, _, key, fn, args = heappop(self._heap)
+        if fn is None:
+            return None
+
+        del self._jobs[key]
+        return key, fn, args
+
+    def _call(self, key, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception('Scheduled job %s failed', key)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > clock.utcnow():
+                    timeout = (self._heap[0][0] - clock.utcnow()).total_seconds() if self._heap else None
+                    self._condition.wait(timeout)
+
+                job = self._pop()
+
+            if job:
+                self._call(*job)
@@ -0,0 +1,148 @@
+import json
+import logging
+import time
+from threading import Lock
+
+import requests
+
+from conf import (
+    DEFAULT_WORKSPACE, SLACK_API_URL, SLACK_CHANNEL_BURST, SLACK_CHANNEL_RATE, SLACK_WORKSPACES, SENDER_MAX_RETRIES,
+    SENDER_QUEUE_SIZE, SENDER_TIMEOUT, SENDER_WORKERS
+)
+from metrics import slack_api_duration, slack_api_retries, slack_messages
+from workers import DispatchPool
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` calls per second on average with bursts of up to `capacity` calls
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = Lock()
+
+    def reserve(self):
+        """
+        Take a token and return how many seconds the caller has to wait before using it
+        """
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def wait(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class MessageSender(object):
+    """
+    Queues outbound Slack Web API calls and sends them from a pool of worker threads over a shared
+    keep-alive HTTP session. Calls to the same channel are sent in order and throttled by a per channel
+    token bucket, rate limited (429) responses are retried after their `Retry-After` delay. Calls are made with the
+    token of the workspace they are for and the workers are shared by every workspace.
+    """
+    def __init__(self, tokens=SLACK_WORKSPACES, workers=SENDER_WORKERS, queue_size=SENDER_QUEUE_SIZE):
+        self.tokens = tokens
+        self.workers = workers
+        self.queue_size = queue_size
+        self.session = requests.Session()
+        self.buckets = {}
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._pool = None
+        self._lock = Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = DispatchPool(self.send_now, workers=self.workers, queue_size=self.queue_size)
+            return self._pool
+
+    def send(self, method, channel, workspace=DEFAULT_WORKSPACE, **kwargs):
+        """
+        Queue an API call and return straight away. Blocks only if the channel's queue is full.
+        """
+        self.pool.submit((workspace, channel), method, channel, kwargs, workspace)
+
+    def send_now(self, method, channel, kwargs, workspace=DEFAULT_WORKSPACE):
+        self._bucket(workspace, channel).wait()
+
+        data = dict(
+            (key, json.dumps(value) if isinstance(value, (bool, dict, list)) else value)
+            for key, value in kwargs.items() if value is not None
+        )
+        data.update(token=self.tokens[workspace], channel=channel)
+
+        with slack_api_duration.time(method=method, outcome='ok') as timer:
+            for attempt in range(SENDER_MAX_RETRIES + 1):
+                last_attempt = attempt == SENDER_MAX_RETRIES
+                try:
+                    response = self.session.post(SLACK_API_URL + method, data=data, timeout=SENDER_TIMEOUT)
+                except requests.RequestException:
+                    logger.warning('%s to %s failed (attempt %s)', method, channel, attempt + 1)
+                    if not last_attempt:
+                        slack_api_retries.inc(method=method, reason='error')
+                        time.sleep(2 ** attempt)
+                        self.retried += 1
+                    continue
+
+                if response.status_code == 429:
+                    if not last_attempt:
+                        slack_api_retries.inc(method=method, reason='rate_limited')
+                        time.sleep(float(response.headers.get('Retry-After', 1)))
+                        self.retried += 1
+                    continue
+
+                # Slack answers errors such as channel_not_found or invalid_auth with a 200, they are not worth retrying
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {'error': 'invalid response'}
+                if not body.get('ok'):
+                    timer.labels['outcome'] = 'failed'
+                    self.failed += 1
+                    slack_messages.inc(outcome='failed')
+                    logger.error('%s to %s failed: %s', method, channel, body.get('error'))
+                    return response
+
+                self.sent += 1
+                slack_messages.inc(outcome='sent')
+                return response
+
+            timer.labels['outcome'] = 'failed'
+
+        self.failed += 1
+        slack_messages.inc(outcome='failed')
+        logger.error('Giving up on %s to %s after %s attempts', method, channel, SENDER_MAX_RETRIES + 1)
+
+    def queue_depth(self):
+        return self._pool.qsize() if self._pool else 0
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+        }
+
+    def join(self):
+        if self._pool:
+            self._pool.join()
+
+    def _bucket(self, workspace, channel):
+        with self._lock:
+            if (workspace, channel) not in self.buckets:
+                self.buckets[(workspace, channel)] = TokenBucket(SLACK_CHANNEL_RATE, SLACK_CHANNEL_BURST)
+            return self.buckets[(workspace, channel)]
@@ -1,5 +1,19 @@
-from slackclient import SlackClient
+from threading import Lock
 
-from conf import SLACK_WEBHOOK_SECRET
+from conf import DEFAULT_WORKSPACE, SLACK_WORKSPACES
 
-sc = SlackClient(SLACK_WEBHOOK_SECRET)
+# One client per workspace, created on first use so slackclient is only imported once teabot talks to Slack.
+# Until it connects to RTM a client is little more than its token.
+clients = {}
+_lock = Lock()
+
+
+def get_client(workspace=DEFAULT_WORKSPACE):
+    client = clients.get(workspace)
+    if client is None:
+        with _lock:
+            if workspace not in clients:
+                from slackclient import SlackClient
+                clients[workspace] = SlackClient(SLACK_WORKSPACES[workspace])
+            client = clients[workspace]
+    return client
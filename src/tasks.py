@@ -1,97 +1,243 @@
-import time
-
-from functools import wraps
+import hashlib
+import json
+import logging
+from datetime import timedelta
 from threading import Thread
 
-from conf import BREW_COUNTDOWN
-from models import Server, Customer, get_session, User
-from slack_client import sc
+from clock import clock
+from conf import BREW_SWEEP_GRACE, BREW_SWEEP_INTERVAL, DEFAULT_WORKSPACE, EVENT_CLAIM_TTL, LEADERBOARD_CHECK_INTERVAL
+from leaderboard import leaderboards
+from managers import EventClaimManager, UserManager
+from metrics import brew_countdown_duration
+from models import Server, Customer, current_workspace, get_session, unit_of_work, User
+from responses import response_cache
+from rollups import record_brew
+from scheduler import Scheduler
+from slack_client import get_client
 from utils import post_message
 
+logger = logging.getLogger(__name__)
+
+scheduler = Scheduler()
+
+
+def brew_countdown(server):
+    """
+    Complete the server's brew once its deadline has passed
+    """
+    scheduler.schedule(server.id, server.deadline or clock.utcnow(), complete_brew, server.id, server.workspace)
+
+
+def cancel_brew_countdown(server):
+    return scheduler.cancel(server.id)
+
+
+def restore_brew_countdowns():
+    """
+    Reschedule the countdowns of brews that were still running when the bot stopped
+    """
+    for server in get_session().query(Server).filter_by(completed=False):
+        brew_countdown(server)
 
-def delay(seconds):
-    def decorator(fn):
-        @wraps(fn)
-        def wrapper(*args, **kwargs):
-            time.sleep(seconds)
-            return fn(*args, **kwargs)
-        return wrapper
-    return decorator
 
+def schedule_brew_sweep():
+    scheduler.schedule('brew_sweep', clock.utcnow() + timedelta(seconds=BREW_SWEEP_INTERVAL), sweep_brews)
+
+
+def sweep_brews():
+    """
+    Periodic task to complete the brews that are well past their deadline, because the replica counting them down
+    stopped. Replicas racing to complete the same brew are fine, only one of them can mark it completed.
+    """
+    try:
+        with unit_of_work():
+            overdue = get_session().query(Server.id, Server.workspace, Server.channel).filter(
+                Server.completed.is_(False), Server.deadline < clock.utcnow() - timedelta(seconds=BREW_SWEEP_GRACE)
+            ).all()
+
+        for server_id, workspace, channel in overdue:
+            logger.warning('Brew in %s of %s is overdue, completing it', channel, workspace)
+            complete_brew(server_id, workspace)
+    finally:
+        schedule_brew_sweep()
+
+
+def schedule_event_claim_pruning():
+    scheduler.schedule(
+        'event_claim_pruning', clock.utcnow() + timedelta(seconds=EVENT_CLAIM_TTL), prune_event_claims
+    )
+
+
+def prune_event_claims():
+    """
+    Periodic task to delete the event claims too old for their events to be delivered again
+    """
+    try:
+        with unit_of_work():
+            EventClaimManager.prune()
+    finally:
+        schedule_event_claim_pruning()
 
-def brew_countdown(channel):
-    Thread(target=_brew_countdown, args=(channel,)).start()
 
+def schedule_leaderboard_check():
+    scheduler.schedule(
+        'leaderboard_check', clock.utcnow() + timedelta(seconds=LEADERBOARD_CHECK_INTERVAL), check_leaderboard
+    )
 
-@delay(BREW_COUNTDOWN)
-def _brew_countdown(channel):
+
+def check_leaderboard():
+    """
+    Periodic task to reload the leaderboards if they no longer match the user counters
+    """
+    try:
+        for workspace, leaderboard in list(leaderboards.items()):
+            try:
+                with unit_of_work(workspace):
+                    drifted = leaderboard.check()
+                    if drifted:
+                        logger.warning('Leaderboard of %s out of date for users %s, reloading', workspace, drifted)
+                        leaderboard.load()
+                        response_cache.bump(workspace)
+            except Exception:
+                logger.exception('Could not check the leaderboard of workspace %s', workspace)
+    finally:
+        schedule_leaderboard_check()
+
+
+def complete_brew(server_id, workspace=DEFAULT_WORKSPACE):
+    with brew_countdown_duration.time(outcome='ok'), unit_of_work(workspace):
+        _brew_countdown(server_id)
+
+
+def _brew_countdown(server_id):
+    """
+    Complete the brew of the given server. Countdowns are bound to their server, so a stale one (restored after a
+    restart, from another replica or a sweep) can't end a newer brew in the same channel.
+    """
     session = get_session()
 
-    server = session.query(Server).filter_by(completed=False).first()
+    server = session.query(Server.user_id, Server.channel).filter_by(
+        id=server_id, workspace=current_workspace(), completed=False
+    ).first()
     if not server:
         return
+    server_user_id, channel = server
+
+    # Only one of the replicas (or overdue brew sweeps) racing to complete the brew can flip it. Once it is completed
+    # nobody can join it any more, so the customers read below are final.
+    if not session.query(Server).filter_by(id=server_id, completed=False).update(
+        {Server.completed: True}, synchronize_session=False
+    ):
+        session.rollback()
+        return
 
-    server.completed = True
-    customers = session.query(Customer).filter_by(server_id=server.id)
-
-    for customer in customers.all():
-        customer.user.teas_drunk += 1
-        customer.user.teas_received += 1
-        server.user.teas_brewed += 1
-
-    server.user.teas_brewed += 1  # Account for server's tea
-    server.user.teas_drunk += 1
-    server.user.times_brewed += 1
+    customer_users = session.query(User).join(Customer, Customer.user_id == User.id).filter(
+        Customer.server_id == server_id
+    ).order_by(Customer.id).all()
+    customer_user_ids = [user.id for user in customer_users]
+    customers = [(user.display_name, user.tea_type) for user in customer_users]
 
-    if not customers.count():
-        session.commit()
-        return post_message('Time is up! Looks like no one else wants a cuppa.', channel)
+    if customers:
+        session.query(User).filter(User.id.in_(customer_user_ids)).update({
+            User.teas_drunk: User.teas_drunk + 1,
+            User.teas_received: User.teas_received + 1,
+        }, synchronize_session=False)
 
     # There must be at least 1 customer to get a nomination point.
-    server.user.nomination_points += 1
+    session.query(User).filter_by(id=server_user_id).update({
+        User.teas_brewed: User.teas_brewed + len(customers) + 1,  # Account for server's tea
+        User.teas_drunk: User.teas_drunk + 1,
+        User.times_brewed: User.times_brewed + 1,
+        User.nomination_points: User.nomination_points + (1 if customers else 0),
+    }, synchronize_session=False)
+    record_brew(session, server_user_id, customer_user_ids)
     session.commit()
+    leaderboards.current().add_brewed(server_user_id, len(customers) + 1)
+    response_cache.bump(current_workspace())
+
+    if not customers:
+        return post_message('Time is up! Looks like no one else wants a cuppa.', channel)
 
     return post_message("\n".join(
         ['Time is up!'] +
-        ['%s wants %s' % (customer.user.display_name, customer.user.tea_type) for customer in customers]
+        ['%s wants %s' % customer for customer in customers]
     ), channel)
 
 
+def profile_hash(profile):
+    return hashlib.sha1(json.dumps(profile, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def update_slack_users():
     """
-    Periodic task to update slack user info
+    Periodic task to update the current workspace's slack user info. Only new users and users whose profile changed
+    are written, in one transaction. Returns how many users were added, updated and left unchanged.
     """
     session = get_session()
-    slack_users = sc.api_call('users.list')
+    workspace = current_workspace()
+    slack_users = get_client(workspace).api_call('users.list')
     if not slack_users['ok']:
         return
 
+    existing = dict(
+        (slack_id, (user_id, _profile_hash))
+        for user_id, slack_id, _profile_hash in session.query(User.id, User.slack_id, User.profile_hash).filter(
+            User.workspace == workspace
+        )
+    )
+    added, updated = [], []
+    unchanged = 0
+
     for member in slack_users['members']:
-        slack_id = member.get('id')
-        username = member.get('name')
-        email = member.get('profile').get('email', '')
-        real_name = member.get('profile').get('real_name', '')
-        first_name = member.get('profile').get('first_name', '')
-        last_name = member.get('profile').get('last_name', '')
-        deleted = member.get('profile').get('deleted')
-
-        user = session.query(User).filter_by(slack_id=slack_id).first()
-        if user:
-            user.username = username
-            user.email = email
-            user.real_name = real_name
-            user.first_name = first_name
-            user.last_name = last_name
-            user.deleted = deleted
+        profile = {
+            'slack_id': member.get('id'),
+            'username': member.get('name'),
+            'email': member.get('profile').get('email', ''),
+            'real_name': member.get('profile').get('real_name', ''),
+            'first_name': member.get('profile').get('first_name', ''),
+            'last_name': member.get('profile').get('last_name', ''),
+            'deleted': member.get('profile').get('deleted'),
+        }
+        profile['profile_hash'] = profile_hash(profile)
+
+        user_id, _profile_hash = existing.get(profile['slack_id'], (None, None))
+        if user_id is None:
+            profile['workspace'] = workspace
+            added.append(profile)
+        elif _profile_hash != profile['profile_hash']:
+            profile['id'] = user_id
+            updated.append(profile)
         else:
-            session.add(User(
-                slack_id=slack_id,
-                username=username,
-                email=email,
-                real_name=real_name,
-                first_name=first_name,
-                last_name=last_name,
-                deleted=deleted
-            ))
-
-        session.commit()
+            unchanged += 1
+
+    session.bulk_insert_mappings(User, added)
+    session.bulk_update_mappings(User, updated)
+    session.commit()
+
+    if added or updated:
+        UserManager.invalidate()
+        leaderboards.current().reset()  # Names may have changed, reload on next use
+        response_cache.bump(workspace)
+
+    return {'added': len(added), 'updated': len(updated), 'unchanged': unchanged}
+
+
+def warm_up(workspaces):
+    """
+    Sync the users of every workspace and load their leaderboards. Runs in the background once teabot is connected,
+    events are handled meanwhile and load whatever they need themselves.
+    """
+    for workspace in workspaces:
+        try:
+            with unit_of_work(workspace):
+                update_slack_users()
+                leaderboards.current().load()
+        except Exception:
+            logger.exception('Could not warm up workspace %s', workspace)
+
+
+def warm_up_async(workspaces):
+    thread = Thread(target=warm_up, args=(list(workspaces),))
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -1,10 +1,12 @@
-import random
-
-from giphypop import Giphy, GiphyApiException
-from slack_client import sc
+from gifs import GifCache
+from metrics import sender_queue_depth
+from models import current_workspace
+from sender import MessageSender
 from sqlalchemy.sql import ClauseElement
 
-giphy_client = Giphy()
+gif_cache = GifCache()
+sender = MessageSender()
+sender_queue_depth.set_function(sender.queue_depth)
 
 
 def get_or_create(session, model, defaults=None, **kwargs):
@@ -22,19 +24,15 @@ def get_or_create(session, model, defaults=None, **kwargs):
 def post_message(text, channel, attachments=None, mrkdwn=False, gif_search_phrase=None):
     gif_url = None
     if gif_search_phrase:
-        try:
-            gif_url = random.choice(list(giphy_client.search(phrase=gif_search_phrase, limit=50))).media_url
-        except GiphyApiException:  # If the API call errors
-            pass
-        except IndexError:  # If the API call returns no results
-            pass
+        gif_url = gif_cache.get(gif_search_phrase)
 
     if gif_url is not None:
         text += '\n\n%s' % gif_url
 
-    sc.api_call(
+    sender.send(
         'chat.postMessage',
-        channel=channel,
+        channel,
+        workspace=current_workspace(),
         text=text,
         icon_emoji=':tea:',
         username='Tea Bot',
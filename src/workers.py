@@ -0,0 +1,59 @@
+import logging
+from threading import Thread
+
+try:
+    from Queue import Queue
+except ImportError:  # Python 3
+    from queue import Queue
+
+from conf import DISPATCH_QUEUE_SIZE, DISPATCH_WORKERS
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class DispatchPool(object):
+    """
+    A fixed number of worker threads that call `handler` concurrently. Every job is submitted with a key
+    (e.g. the channel) and all jobs sharing a key run on the same worker, so they are handled in order.
+    Each worker has a bounded queue, submitting to a full queue blocks the caller.
+    """
+    def __init__(self, handler, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE):
+        self.handler = handler
+        self.queues = [Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = [Thread(target=self._work, args=(queue,)) for queue in self.queues]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, *args):
+        self.queues[hash(key) % len(self.queues)].put(args)
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def join(self):
+        """
+        Wait until every submitted job has been handled
+        """
+        for queue in self.queues:
+            queue.join()
+
+    def shutdown(self):
+        for queue in self.queues:
+            queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self, queue):
+        while True:
+            args = queue.get()
+            try:
+                if args is _STOP:
+                    return
+                self.handler(*args)
+            except Exception:
+                logger.exception('Dispatch failed')
+            finally:
+                queue.task_done()
@@ -0,0 +1,44 @@
+from unittest import TestCase
+
+from mock import patch
+
+from src.dedup import EventDeduplicator
+from src.metrics import event_dedup_requests
+
+
+class EventDeduplicatorTestCase(TestCase):
+    def setUp(self):
+        super(EventDeduplicatorTestCase, self).setUp()
+        self.deduplicator = EventDeduplicator(window=60, size=3)
+        self.event = {'type': 'message', 'channel': 'tearoom', 'ts': '1500000000.000100', 'workspace': 'default'}
+
+    def test_duplicates(self):
+        hits = event_dedup_requests.value(store='memory', result='hit')
+        self.assertFalse(self.deduplicator.is_duplicate(self.event))
+        self.assertTrue(self.deduplicator.is_duplicate(dict(self.event)))
+        self.assertFalse(self.deduplicator.is_duplicate(dict(self.event, channel='kitchen')))
+        self.assertFalse(self.deduplicator.is_duplicate(dict(self.event, workspace='T2')))
+        self.assertEqual(event_dedup_requests.value(store='memory', result='hit') - hits, 1)
+
+    def test_client_msg_id(self):
+        self.assertFalse(self.deduplicator.is_duplicate(dict(self.event, client_msg_id='abc')))
+        self.assertTrue(self.deduplicator.is_duplicate(dict(self.event, ts='1500000001.000100', client_msg_id='abc')))
+
+    def test_events_without_id(self):
+        event = {'type': 'message', 'channel': 'tearoom'}
+        self.assertFalse(self.deduplicator.is_duplicate(event))
+        self.assertFalse(self.deduplicator.is_duplicate(event))
+
+    def test_window(self):
+        with patch('src.dedup.time.time', return_value=0):
+            self.assertFalse(self.deduplicator.is_duplicate(self.event))
+        with patch('src.dedup.time.time', return_value=30):
+            self.assertTrue(self.deduplicator.is_duplicate(self.event))
+        with patch('src.dedup.time.time', return_value=61):
+            self.assertFalse(self.deduplicator.is_duplicate(self.event))
+
+    def test_size(self):
+        for ts in ('1.0', '2.0', '3.0', '4.0'):
+            self.assertFalse(self.deduplicator.is_duplicate(dict(self.event, ts=ts)))
+        self.assertFalse(self.deduplicator.is_duplicate(dict(self.event, ts='1.0')))
+        self.assertTrue(self.deduplicator.is_duplicate(dict(self.event, ts='4.0')))
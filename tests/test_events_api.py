@@ -0,0 +1,93 @@
+import json
+import time
+from unittest import TestCase
+
+import requests
+from mock import Mock
+
+from src.events_api import EventsServer, signature, signed_request, verify_signature
+
+SECRET = '8f742231b10e8888abcd99yyyzzz85a5'
+
+
+class SignatureTestCase(TestCase):
+    def test_slack_example(self):
+        # The example from https://api.slack.com/authentication/verifying-requests-from-slack
+        body = (
+            b'token=xyzz0WbapA4vBCDEFasx0q6G&team_id=T1DC2JH3J&team_domain=testteamnow&channel_id=G8PSS9T3V&'
+            b'channel_name=foobar&user_id=U2CERLKJA&user_name=roadrunner&command=%2Fwebhook-collect&text=&'
+            b'response_url=https%3A%2F%2Fhooks.slack.com%2Fcommands%2FT1DC2JH3J%2F397700885554%2F96rGlfmibIGlgcZRskXaIFfN&'
+            b'trigger_id=398738663015.47445629121.803a0bc887a14d10d2c447fce8b6703c'
+        )
+        signed = 'v0=a2114d57b48eac39b9ad189dd8316235a7b4a8d21a10bd27519666489c69b503'
+        self.assertEqual(signature(SECRET, 1531420618, body), signed)
+        self.assertTrue(verify_signature(SECRET, '1531420618', body, signed, now=1531420618 + 60))
+
+    def test_rejects(self):
+        body, headers = signed_request(SECRET, {'type': 'event_callback'}, timestamp=1500000000)
+        timestamp, signed = headers['X-Slack-Request-Timestamp'], headers['X-Slack-Signature']
+
+        self.assertTrue(verify_signature(SECRET, timestamp, body, signed, now=1500000000))
+        self.assertFalse(verify_signature(SECRET, timestamp, body + b' ', signed, now=1500000000))
+        self.assertFalse(verify_signature('another secret', timestamp, body, signed, now=1500000000))
+        self.assertFalse(verify_signature(SECRET, timestamp, body, signed, now=1500000000 + 60 * 60))
+        self.assertFalse(verify_signature(SECRET, None, body, signed, now=1500000000))
+        self.assertFalse(verify_signature(SECRET, timestamp, body, None, now=1500000000))
+
+
+class EventsServerTestCase(TestCase):
+    def setUp(self):
+        super(EventsServerTestCase, self).setUp()
+        self.listener = Mock()
+        self.server = EventsServer(self.listener, 0, host='127.0.0.1', signing_secret=SECRET)
+        self.server.serve_in_background()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+
+    def tearDown(self):
+        super(EventsServerTestCase, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _post(self, payload, secret=SECRET):
+        body, headers = signed_request(secret, payload)
+        return requests.post(self.url, data=body, headers=headers)
+
+    def test_requires_signing_secret(self):
+        with self.assertRaises(ValueError):
+            EventsServer(self.listener, 0, signing_secret=None)
+
+    def test_url_verification(self):
+        response = self._post({'type': 'url_verification', 'challenge': 'abc123'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'challenge': 'abc123'})
+
+    def test_event_callback(self):
+        event = {'type': 'message', 'channel': 'tearoom', 'user': 'U123', 'text': '<@U123456> brew', 'ts': '1.0'}
+        response = self._post({'type': 'event_callback', 'event_id': 'Ev1', 'event': event})
+        self.assertEqual(response.status_code, 200)
+
+        for _ in range(100):
+            if self.listener.receive.called:
+                break
+            time.sleep(0.01)
+        self.listener.receive.assert_called_once_with(dict(event, workspace='default'))
+
+    def test_workspace_for(self):
+        server = EventsServer(self.listener, 0, host='127.0.0.1', signing_secret=SECRET, workspaces={'T1': 'xoxb-1'})
+        self.assertEqual(server.workspace_for('T1'), 'T1')
+        self.assertIsNone(server.workspace_for('T2'))
+        server.server_close()
+
+        self.assertEqual(self.server.workspace_for('T2'), 'default')
+
+    def test_rejects_bad_requests(self):
+        self.assertEqual(self._post({'type': 'event_callback'}, secret='wrong').status_code, 401)
+        self.assertEqual(requests.post(self.url, data=b'{}').status_code, 401)
+
+        body, headers = signed_request(SECRET, {})
+        self.assertEqual(requests.post(self.url, data=b'not json', headers=dict(
+            headers, **{'X-Slack-Signature': signature(SECRET, headers['X-Slack-Request-Timestamp'], b'not json')}
+        )).status_code, 400)
+
+        self.assertEqual(requests.post(self.url, data=b'x' * (1024 * 1024 + 1), headers=headers).status_code, 413)
+        self.listener.receive.assert_not_called()
@@ -0,0 +1,75 @@
+from unittest import TestCase
+
+from giphypop import GiphyApiException
+from mock import Mock, patch
+
+from src.gifs import GifCache
+
+
+class GifCacheTestCase(TestCase):
+    def setUp(self):
+        super(GifCacheTestCase, self).setUp()
+        self.client = Mock()
+        self.client.search.return_value = [Mock(media_url='http://gif/1'), Mock(media_url='http://gif/2')]
+        self.cache = GifCache(self.client, ttl=60, size=2)
+
+    def test_cold_cache_returns_nothing_and_fetches_in_background(self):
+        with patch.object(self.cache, 'refresh_async') as mock_refresh_async:
+            self.assertIsNone(self.cache.get('tea time'))
+            mock_refresh_async.assert_called_once_with('tea time')
+
+    def test_warm_cache(self):
+        self.cache.refresh('tea time')
+        with patch.object(self.cache, 'refresh_async') as mock_refresh_async:
+            self.assertIn(self.cache.get('tea time'), ['http://gif/1', 'http://gif/2'])
+            mock_refresh_async.assert_not_called()
+        self.client.search.assert_called_once_with(phrase='tea time', limit=50)
+
+    def test_expired_entry_is_served_and_refreshed(self):
+        with patch('src.gifs.time.time', return_value=0):
+            self.cache.refresh('tea time')
+
+        with patch.object(self.cache, 'refresh_async') as mock_refresh_async:
+            self.assertIsNotNone(self.cache.get('tea time'))
+            mock_refresh_async.assert_called_once_with('tea time')
+
+    def test_least_recently_used_phrase_is_evicted(self):
+        self.cache.refresh('tea time')
+        self.cache.refresh('celebrate')
+        with patch.object(self.cache, 'refresh_async'):
+            self.cache.get('tea time')
+            self.cache.refresh('coffee')
+            self.assertIsNotNone(self.cache.get('tea time'))
+            self.assertIsNotNone(self.cache.get('coffee'))
+            self.assertIsNone(self.cache.get('celebrate'))
+
+    def test_giphy_error_keeps_cached_results(self):
+        self.cache.refresh('tea time')
+        self.client.search.side_effect = GiphyApiException()
+        self.cache.refresh('tea time')
+        with patch.object(self.cache, 'refresh_async'):
+            self.assertIsNotNone(self.cache.get('tea time'))
+
+    def test_giphy_error_is_cached_until_the_retry(self):
+        self.client.search.side_effect = IOError()
+        with patch('src.gifs.time.time', return_value=0):
+            self.cache.refresh('tea time')
+
+        with patch.object(self.cache, 'refresh_async') as mock_refresh_async:
+            with patch('src.gifs.time.time', return_value=30):
+                self.assertIsNone(self.cache.get('tea time'))
+                mock_refresh_async.assert_not_called()  # Not searched again for every message
+
+            with patch('src.gifs.time.time', return_value=self.cache.retry_ttl):
+                self.assertIsNone(self.cache.get('tea time'))
+                mock_refresh_async.assert_called_once_with('tea time')
+
+    def test_giphy_client_is_created_on_first_fetch(self):
+        with patch('giphypop.Giphy') as mock_giphy:
+            cache = GifCache()
+            mock_giphy.assert_not_called()
+
+            mock_giphy.return_value.search.return_value = [Mock(media_url='http://gif/1')]
+            cache.refresh('tea time')
+            cache.refresh('celebrate')
+            mock_giphy.assert_called_once_with()
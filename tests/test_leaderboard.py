@@ -0,0 +1,44 @@
+from src.leaderboard import Leaderboard
+from tests.utils import BaseTestCase
+
+
+class LeaderboardTestCase(BaseTestCase):
+    def setUp(self):
+        super(LeaderboardTestCase, self).setUp()
+        self.user1 = self._create_user(tea_type='green tea', teas_brewed=3)
+        self.user2 = self._create_user(tea_type='green tea', teas_brewed=7)
+        self.user3 = self._create_user(tea_type='green tea', teas_brewed=3)
+        self._create_user(teas_brewed=20)  # Unregistered users are not ranked
+        self.leaderboard = Leaderboard()
+        self.leaderboard.load()
+
+    def test_top(self):
+        self.assertEqual(self.leaderboard.top(), [
+            (self.user2.real_name, 7), (self.user1.real_name, 3), (self.user3.real_name, 3)
+        ])
+        self.assertEqual(self.leaderboard.top(1), [(self.user2.real_name, 7)])
+
+    def test_rank(self):
+        self.assertEqual(self.leaderboard.rank(self.user2.id), 1)
+        self.assertEqual(self.leaderboard.rank(self.user3.id), 3)
+        self.assertIsNone(self.leaderboard.rank(12345))
+
+    def test_add_brewed(self):
+        self.leaderboard.add_brewed(self.user3.id, 5)
+        self.assertEqual(self.leaderboard.rank(self.user3.id), 1)
+        self.assertEqual(self.leaderboard.top(1), [(self.user3.real_name, 8)])
+
+    def test_update(self):
+        user = self._create_user(tea_type='mint tea', teas_brewed=4)
+        self.leaderboard.update(user.id, user.real_name, user.teas_brewed)
+        self.assertEqual(self.leaderboard.rank(user.id), 2)
+
+    def test_check(self):
+        self.assertEqual(self.leaderboard.check(), [])
+
+        self.user1.teas_brewed = 10
+        self.session.commit()
+        self.assertEqual(self.leaderboard.check(), [self.user1.id])
+
+        self.leaderboard.load()
+        self.assertEqual(self.leaderboard.check(), [])
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+from src.managers import EventClaimManager, IdentityCache, UserIdentity, UserManager
+from src.metrics import identity_cache_requests
+from src.models import EventClaim
+from tests.utils import BaseTestCase
+
+
+class UserManagerTestCase(BaseTestCase):
+    def test_get_identity(self):
+        user = self._create_user(first_name='Jon', tea_type='green tea')
+        hits, misses = identity_cache_requests.value(result='hit'), identity_cache_requests.value(result='miss')
+        identity = UserManager.get_identity(user.slack_id)
+        self.assertEqual((identity.id, identity.display_name, identity.tea_type), (user.id, 'Jon', 'green tea'))
+        self.assertIs(UserManager.get_identity(user.slack_id), identity)
+        self.assertEqual(identity_cache_requests.value(result='hit') - hits, 1)
+        self.assertEqual(identity_cache_requests.value(result='miss') - misses, 1)
+
+        user.tea_type = 'mint tea'
+        self.session.commit()
+        UserManager.invalidate(user.slack_id)
+        self.assertEqual(UserManager.get_identity(user.slack_id).tea_type, 'mint tea')
+
+    def test_get_identity_unknown_user(self):
+        misses = identity_cache_requests.value(result='miss')
+        self.assertIsNone(UserManager.get_identity('U000000'))
+        self.assertIsNone(UserManager.get_identity('U000000'))  # Unknown users are not cached
+        self.assertEqual(identity_cache_requests.value(result='miss') - misses, 2)
+
+    def test_identity_cache_evicts_least_recently_used(self):
+        cache = IdentityCache(size=2)
+        users = [UserIdentity(self._create_user()) for _ in range(3)]
+        cache.set('U1', users[0])
+        cache.set('U2', users[1])
+        cache.get('U1')
+        cache.set('U3', users[2])
+
+        self.assertIs(cache.get('U1'), users[0])
+        self.assertIsNone(cache.get('U2'))
+        self.assertIs(cache.get('U3'), users[2])
+
+
+class EventClaimManagerTestCase(BaseTestCase):
+    def test_claim(self):
+        event = {'type': 'message', 'channel': 'tearoom', 'ts': '1500000000.000100'}
+        self.assertTrue(EventClaimManager.claim(event))
+        self.assertFalse(EventClaimManager.claim(event))
+        self.assertTrue(EventClaimManager.claim(dict(event, channel='kitchen')))
+        self.assertTrue(EventClaimManager.claim({'type': 'message', 'channel': 'tearoom'}))
+
+    def test_prune(self):
+        EventClaimManager.claim({'channel': 'tearoom', 'ts': '1.0'})
+        self.session.add(EventClaim(workspace='default', channel='tearoom', ts='2.0', claimed=datetime.utcnow() - timedelta(days=1)))
+        self.session.commit()
+
+        EventClaimManager.prune()
+        self.assertEqual([ts for ts, in self.session.query(EventClaim.ts)], ['1.0'])
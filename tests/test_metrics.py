@@ -0,0 +1,111 @@
+import requests
+from sqlalchemy import create_engine
+from unittest import TestCase
+
+from src.metrics import (
+    Counter, Histogram, LatencyTracker, Registry, database_duration, instrument_engine, start_metrics_server
+)
+
+
+class LatencyTrackerTestCase(TestCase):
+    def test_percentiles(self):
+        tracker = LatencyTracker(window=100)
+        self.assertIsNone(tracker.percentile(50))
+
+        for millisecond in range(1, 201):
+            tracker.record(millisecond / 1000.0)
+
+        self.assertEqual(tracker.count, 200)
+        self.assertEqual(tracker.percentile(0), 0.101)
+        self.assertEqual(tracker.percentile(100), 0.2)
+
+
+class HistogramTestCase(TestCase):
+    def test_observe(self):
+        histogram = Histogram('test_seconds', 'Test', ['command'], buckets=(0.1, 1))
+        histogram.observe(0.05, command='brew')
+        histogram.observe(0.5, command='brew')
+        histogram.observe(5, command='brew')
+        histogram.observe(0.05, command='me')
+
+        self.assertEqual(histogram.count(command='brew'), 3)
+        self.assertEqual(histogram.count(command='stats'), 0)
+        self.assertEqual(list(histogram.samples()), [
+            'test_seconds_bucket{command="brew",le="0.1"} 1',
+            'test_seconds_bucket{command="brew",le="1.0"} 2',
+            'test_seconds_bucket{command="brew",le="+Inf"} 3',
+            'test_seconds_sum{command="brew"} 5.55',
+            'test_seconds_count{command="brew"} 3',
+            'test_seconds_bucket{command="me",le="0.1"} 1',
+            'test_seconds_bucket{command="me",le="1.0"} 1',
+            'test_seconds_bucket{command="me",le="+Inf"} 1',
+            'test_seconds_sum{command="me"} 0.05',
+            'test_seconds_count{command="me"} 1',
+        ])
+
+    def test_time(self):
+        histogram = Histogram('test_seconds', 'Test', ['outcome'])
+        with histogram.time(outcome='ok'):
+            pass
+
+        with self.assertRaises(ValueError):
+            with histogram.time(outcome='ok'):
+                raise ValueError()
+
+        with histogram.time(outcome='ok') as timer:
+            timer.labels['outcome'] = 'ignored'
+
+        self.assertEqual(histogram.count(outcome='ok'), 1)
+        self.assertEqual(histogram.count(outcome='error'), 1)
+        self.assertEqual(histogram.count(outcome='ignored'), 1)
+
+
+class RegistryTestCase(TestCase):
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter('test_total', 'Things counted', ['result'])
+        counter.inc(result='hit')
+        counter.inc(2, result='hit')
+        counter.inc(result='say "miss"')
+
+        self.assertEqual(counter.value(result='hit'), 3)
+        self.assertEqual(registry.render(), (
+            '# HELP test_total Things counted\n'
+            '# TYPE test_total counter\n'
+            'test_total{result="hit"} 3\n'
+            'test_total{result="say \\"miss\\""} 1\n'
+        ))
+
+    def test_render_gauge(self):
+        registry = Registry()
+        gauge = registry.gauge('test_depth', 'Things waiting')
+        self.assertEqual(gauge.value(), 0)
+
+        gauge.set_function(lambda: 3)
+        self.assertEqual(registry.render(), '# HELP test_depth Things waiting\n# TYPE test_depth gauge\ntest_depth 3\n')
+
+    def test_instrument_engine(self):
+        engine = create_engine('sqlite://')
+        instrument_engine(engine)
+        selects = database_duration.count(statement='SELECT')
+
+        engine.execute('CREATE TABLE things (id INTEGER)')
+        engine.execute('SELECT * FROM things')
+
+        self.assertEqual(database_duration.count(statement='SELECT'), selects + 1)
+        self.assertGreaterEqual(database_duration.count(statement='CREATE'), 1)
+
+    def test_metrics_server(self):
+        server = start_metrics_server(0, host='127.0.0.1')
+        try:
+            url = 'http://127.0.0.1:%s' % server.server_address[1]
+            response = requests.get(url + '/metrics')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+            self.assertIn('# TYPE teabot_command_duration_seconds histogram', response.text)
+            self.assertIn('teabot_sender_queue_depth 0', response.text)
+
+            self.assertEqual(requests.get(url + '/').status_code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+
+from src.migrations import MIGRATIONS, current_version, migrate, schema_version, unique_active_brews
+from src.models import Base
+
+# The schema created by the first releases of teabot, before migrations existed
+LEGACY_SCHEMA = [
+    'CREATE TABLE user (id INTEGER NOT NULL, slack_id VARCHAR(255), username VARCHAR(255), email VARCHAR(255), '
+    'real_name VARCHAR(255), first_name VARCHAR(255), last_name VARCHAR(255), deleted BOOLEAN, '
+    'nomination_points INTEGER NOT NULL, tea_type VARCHAR(1024), teas_brewed INTEGER NOT NULL, '
+    'teas_drunk INTEGER NOT NULL, teas_received INTEGER NOT NULL, times_brewed INTEGER NOT NULL, '
+    'PRIMARY KEY (id), UNIQUE (slack_id), UNIQUE (username))',
+    'CREATE TABLE server (id INTEGER NOT NULL, user_id INTEGER, completed BOOLEAN, "limit" INTEGER, '
+    'created DATETIME, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id))',
+    'CREATE TABLE customer (id INTEGER NOT NULL, user_id INTEGER, server_id INTEGER, created DATETIME, '
+    'PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(server_id) REFERENCES server (id))',
+]
+
+
+class MigrationsTestCase(TestCase):
+    def setUp(self):
+        super(MigrationsTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % os.path.join(self.directory, 'teabot.db'))
+
+    def tearDown(self):
+        super(MigrationsTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def assertSchemaMatchesModels(self):
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            self.assertEqual(
+                set(column['name'] for column in inspector.get_columns(table.name)),
+                set(column.name for column in table.columns)
+            )
+            self.assertTrue(
+                set(index.name for index in table.indexes) <=
+                set(index['name'] for index in inspector.get_indexes(table.name))
+            )
+
+    def test_migrate_new_database(self):
+        self.assertEqual(migrate(self.engine), len(MIGRATIONS))
+        self.assertEqual(current_version(self.engine.connect()), len(MIGRATIONS))
+        self.assertSchemaMatchesModels()
+
+    def test_migrate_legacy_database(self):
+        for statement in LEGACY_SCHEMA:
+            self.engine.execute(statement)
+        self.engine.execute(
+            "INSERT INTO user (id, slack_id, username, nomination_points, tea_type, teas_brewed, teas_drunk, "
+            "teas_received, times_brewed) VALUES (1, 'U1', 'george', 3, 'green tea', 12, 8, 4, 5), "
+            "(2, 'U2', 'jon', 0, 'mint tea', 0, 5, 5, 0)"
+        )
+        self.engine.execute("INSERT INTO server (id, user_id, completed) VALUES (1, 1, 1)")
+        self.engine.execute("INSERT INTO customer (id, user_id, server_id) VALUES (1, 2, 1), (2, 2, 1), (3, 3, 1)")
+
+        migrate(self.engine)
+        self.assertSchemaMatchesModels()
+        self.assertEqual(
+            self.engine.execute(
+                'SELECT username, teas_brewed, teas_drunk, teas_received, workspace FROM user ORDER BY id'
+            ).fetchall(),
+            [('george', 11, 8, 4, 'default'), ('jon', 0, 4, 4, 'default')]  # Without the duplicate's cup
+        )
+        self.assertEqual(
+            self.engine.execute('SELECT id, channel, workspace, customer_count FROM server').fetchall(),
+            [(1, None, 'default', 2)]
+        )
+
+        # Duplicate customers are dropped and can't be added again
+        self.assertEqual(self.engine.execute('SELECT id FROM customer ORDER BY id').fetchall(), [(1,), (3,)])
+        with self.assertRaises(IntegrityError):
+            self.engine.execute("INSERT INTO customer (user_id, server_id) VALUES (2, 1)")
+
+        # Usernames are only unique within a workspace
+        self.engine.execute(
+            "INSERT INTO user (slack_id, username, workspace, nomination_points, teas_brewed, teas_drunk, "
+            "teas_received, times_brewed) VALUES ('U1', 'george', 'T2', 0, 0, 0, 0, 0)"
+        )
+        with self.assertRaises(IntegrityError):
+            self.engine.execute(
+                "INSERT INTO user (slack_id, username, workspace, nomination_points, teas_brewed, teas_drunk, "
+                "teas_received, times_brewed) VALUES ('U2', 'george', 'T2', 0, 0, 0, 0, 0)"
+            )
+
+    def test_migrate_legacy_database_rebuilds_rollups(self):
+        for statement in LEGACY_SCHEMA:
+            self.engine.execute(statement)
+        self.engine.execute(
+            "INSERT INTO server (id, user_id, completed, created) VALUES "
+            "(1, 1, 1, '2026-10-12 09:00:00.000000'), (2, 1, 1, '2026-10-14 09:00:00.000000'), "
+            "(3, 2, 0, '2026-10-14 10:00:00.000000')"
+        )
+        self.engine.execute("INSERT INTO customer (user_id, server_id) VALUES (2, 1), (2, 1), (3, 1), (2, 3)")
+
+        migrate(self.engine)
+        self.assertEqual(self.engine.execute(
+            'SELECT day, user_id, teas_brewed, teas_drunk, times_brewed, teas_received FROM daily_stats '
+            'ORDER BY day, user_id'
+        ).fetchall(), [
+            ('2026-10-12', 1, 3, 1, 1, 0), ('2026-10-12', 2, 0, 1, 0, 1), ('2026-10-12', 3, 0, 1, 0, 1),
+            ('2026-10-14', 1, 1, 1, 1, 0),
+        ])
+        self.assertEqual(self.engine.execute(
+            'SELECT week, user_id, teas_brewed, teas_drunk, times_brewed, teas_received FROM weekly_stats '
+            'ORDER BY user_id'
+        ).fetchall(), [
+            ('2026-10-12', 1, 4, 2, 2, 0), ('2026-10-12', 2, 0, 1, 0, 1), ('2026-10-12', 3, 0, 1, 0, 1),
+        ])
+
+    def test_migrate_completes_extra_active_brews(self):
+        with self.engine.begin() as connection:
+            current_version(connection)
+            for number, fn in enumerate(MIGRATIONS[:MIGRATIONS.index(unique_active_brews)], 1):
+                fn(connection)
+                connection.execute(schema_version.insert(), version=number)
+        self.engine.execute(
+            "INSERT INTO server (id, user_id, completed, channel) VALUES "
+            "(1, 1, 0, 'tearoom'), (2, 1, 0, 'tearoom'), (3, 1, 0, 'kitchen'), (4, 1, 1, 'kitchen')"
+        )
+
+        migrate(self.engine)
+        self.assertEqual(
+            self.engine.execute('SELECT id, completed FROM server ORDER BY id').fetchall(),
+            [(1, False), (2, True), (3, False), (4, True)]
+        )
+        with self.assertRaises(IntegrityError):
+            self.engine.execute("INSERT INTO server (user_id, completed, channel) VALUES (1, 0, 'kitchen')")
+        self.engine.execute("INSERT INTO server (user_id, completed, channel) VALUES (1, 1, 'kitchen')")
+
+    def test_migrate_is_idempotent(self):
+        migrate(self.engine)
+        self.engine.execute("INSERT INTO user (id, slack_id, username, nomination_points, teas_brewed, teas_drunk, "
+                            "teas_received, times_brewed) VALUES (1, 'U1', 'george', 0, 0, 0, 0, 0)")
+        migrate(self.engine)
+        self.assertEqual(self.engine.execute('SELECT COUNT(*) FROM user').scalar(), 1)
+        self.assertEqual(self.engine.execute('SELECT COUNT(*) FROM schema_version').scalar(), len(MIGRATIONS))
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+from threading import Thread
+from unittest import TestCase
+
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from src.conf import DATABASE_POOL_RECYCLE, DATABASE_POOL_SIZE
+from src.models import Base, User, make_engine
+
+
+class MakeEngineTestCase(TestCase):
+    def setUp(self):
+        super(MakeEngineTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///%s' % os.path.join(self.directory, 'teabot.db')
+
+    def tearDown(self):
+        super(MakeEngineTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_sqlite_profile(self):
+        engine = make_engine(self.url, 'sqlite')
+        self.assertIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.pool.size(), DATABASE_POOL_SIZE)
+
+        connection = engine.connect()
+        self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+        self.assertEqual(connection.execute('PRAGMA busy_timeout').scalar(), 10000)
+        connection.close()
+
+    def test_sqlite_profile_in_memory(self):
+        engine = make_engine('sqlite://', 'sqlite')
+        self.assertEqual(engine.execute('SELECT 1').scalar(), 1)
+
+    def test_server_profile(self):
+        engine = make_engine(self.url, 'server')
+        self.assertIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.pool.size(), DATABASE_POOL_SIZE)
+        self.assertEqual(engine.pool._recycle, DATABASE_POOL_RECYCLE)
+        self.assertEqual(engine.execute('SELECT 1').scalar(), 1)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            make_engine(self.url, 'oracle')
+
+    def test_concurrent_writers(self):
+        engine = make_engine(self.url, 'sqlite')
+        Base.metadata.create_all(engine)
+        session_factory = sessionmaker(bind=engine)
+        errors = []
+
+        def write(prefix):
+            session = session_factory()
+            try:
+                for index in range(50):
+                    session.add(User(slack_id='%s%s' % (prefix, index), username='%s%s' % (prefix, index)))
+                    session.commit()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                session.close()
+
+        threads = [Thread(target=write, args=(prefix,)) for prefix in ('A', 'B', 'C')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(engine.execute('SELECT COUNT(*) FROM user').scalar(), 150)
@@ -0,0 +1,134 @@
+import os
+import pstats
+import shutil
+import tempfile
+
+from mock import patch
+
+from src.app import Dispatcher, Listener
+from src.managers import UserIdentity
+from src.models import engine
+from src.profiling import Profiler
+from tests.utils import BaseTestCase
+
+
+class ProfilerTestCase(BaseTestCase):
+    def setUp(self):
+        super(ProfilerTestCase, self).setUp()
+        self.slack_id = self._create_user(tea_type='green tea').slack_id
+        self.listener = Listener([UserIdentity(self._create_user(slack_id='U123456', username='teabot'))], workers=0)
+        self.dump_dir = tempfile.mkdtemp()
+        self.profiler = Profiler(engine, sample_rate=0, dump_dir=self.dump_dir, report_interval=0)
+        self.profiler.enable()
+
+        self.patchers = [patch('src.app.profiler', self.profiler), patch('src.app.post_message')]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        super(ProfilerTestCase, self).tearDown()
+        for patcher in self.patchers:
+            patcher.stop()
+        self.profiler.disable()
+        shutil.rmtree(self.dump_dir)
+
+    def _dispatch(self, text):
+        self.listener.dispatch({'channel': 'tearoom', 'text': '<@U123456> %s' % text, 'user': self.slack_id})
+
+    def test_records_queries_per_command(self):
+        self._dispatch('stats')
+        self._dispatch('stats')
+        self._dispatch('help')
+        self._dispatch('dance')
+
+        self.assertEqual(sorted(self.profiler.commands), ['help', 'stats', 'unknown'])
+        stats = self.profiler.commands['stats']
+        self.assertEqual(stats.events, 2)
+        self.assertGreater(stats.queries, 0)
+        self.assertGreaterEqual(stats.max_queries * 2, stats.queries)
+        self.assertGreater(stats.db_time, 0)
+        self.assertGreaterEqual(stats.wall_time, stats.db_time)
+
+        report = self.profiler.report().split('\n')
+        self.assertEqual(len(report), 4)
+        self.assertTrue(report[2].startswith('stats '))
+
+    def test_queries_outside_events_are_not_recorded(self):
+        self._dispatch('help')
+        queries = self.profiler.commands['help'].queries
+        self._create_user()
+        self.assertEqual(self.profiler.commands['help'].queries, queries)
+
+    def test_dumps_sampled_events(self):
+        self.profiler.sample_rate = 1
+        self._dispatch('stats')
+
+        dumps = os.listdir(self.dump_dir)
+        self.assertEqual(len(dumps), 1)
+        self.assertTrue(dumps[0].startswith('teabot-stats-'))
+        self.assertGreater(pstats.Stats(os.path.join(self.dump_dir, dumps[0])).total_calls, 0)
+
+    def test_disabled(self):
+        self.profiler.disable()
+        self._dispatch('stats')
+        self.assertEqual(self.profiler.commands, {})
+
+
+class QueryBudgetTestCase(BaseTestCase):
+    """
+    The number of statements each command may execute once the user's identity is cached
+    """
+    def setUp(self):
+        super(QueryBudgetTestCase, self).setUp()
+        self.dispatcher = Dispatcher(UserIdentity(self._create_user(slack_id='U123456', username='teabot')))
+        self.user = self._create_user(tea_type='green tea', nomination_points=10)
+        self.other_user = self._create_user(tea_type='mint tea')
+
+        self.patchers = [patch('src.app.post_message'), patch('src.app.brew_countdown')]
+        for patcher in self.patchers:
+            patcher.start()
+
+        self._command('ping')
+        self._command('ping', self.other_user)
+
+    def tearDown(self):
+        super(QueryBudgetTestCase, self).tearDown()
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def _command(self, text, user=None):
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> %s' % text,
+            'user': (user or self.user).slack_id
+        })
+
+    def test_read_only_commands(self):
+        for text, budget in (('help', 0), ('ping', 0), ('leaderboard', 1), ('leaderboard 5', 0), ('stats', 2),
+                             ('stats week', 2)):
+            with self.assertMaxQueries(budget):
+                self._command(text)
+
+            with self.assertMaxQueries(0):  # Served from the response cache until the data changes
+                self._command(text)
+
+    def test_brew_and_me(self):
+        with self.assertMaxQueries(2):
+            self._command('brew')
+
+        self.other_user.slack_id  # Reload the user expired by the brew's commit outside of the budget
+        with self.assertMaxQueries(2):  # Joining is one conditional update and one insert
+            self._command('me', self.other_user)
+
+    def test_nominate(self):
+        with self.assertMaxQueries(3):
+            self._command('nominate <@%s>' % self.other_user.slack_id)
+
+    def test_register(self):
+        with self.assertMaxQueries(3):
+            self._command('register black tea', self.other_user)
+
+    def test_over_budget(self):
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(0):
+                self._command('stats')
@@ -0,0 +1,118 @@
+import re
+
+from mock import patch
+from sqlalchemy import event
+
+from src.app import Dispatcher
+from src.conf import NOMINATION_POINTS_REQUIRED
+from src.leaderboard import leaderboards
+from src.managers import UserIdentity, UserManager
+from src.models import Server, engine, unit_of_work
+from src.rollups import record_brew
+from src.tasks import _brew_countdown
+from tests.utils import BaseTestCase
+
+# A SCAN step reads a whole table (or a whole index), SEARCH steps use an index to find the rows they need.
+# Subqueries show up as a CO-ROUTINE or MATERIALIZE step followed by a scan of their (already filtered) rows.
+SCAN_RE = re.compile(r'^SCAN (?:TABLE |SUBQUERY )?(\w+)')
+SUBQUERY_RE = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (?:SUBQUERY )?(\w+)')
+
+
+class QueryPlanTestCase(BaseTestCase):
+    """
+    Runs each command and checks the query plan of every statement it issues so that a full table scan can't
+    slip into the dispatcher or the countdown unnoticed.
+    """
+    def setUp(self):
+        super(QueryPlanTestCase, self).setUp()
+        self.teabot = UserIdentity(self._create_user(slack_id='U123456', username='teabot'))
+        self.user = self._create_user(tea_type='green tea', nomination_points=NOMINATION_POINTS_REQUIRED)
+        self.other_user = self._create_user(tea_type='mint tea', teas_brewed=3)
+        for index in range(20):
+            self._create_user(tea_type='tea %s' % index if index % 2 else None)
+
+        server = self._create_server(self._create_user(tea_type='earl grey').id, completed=True, channel='kitchen')
+        self._create_customer(self.user.id, server.id)
+        record_brew(self.session, server.user_id, [self.user.id])
+        self.session.commit()
+
+        self.patchers = [patch('src.app.post_message'), patch('src.tasks.post_message'), patch('src.app.brew_countdown')]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def tearDown(self):
+        super(QueryPlanTestCase, self).tearDown()
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def _statements(self, fn, *args):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                statements.append((statement, parameters))
+
+        UserManager.invalidate()
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            fn(*args)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        return statements
+
+    def _command(self, text, user=None):
+        return self._statements(Dispatcher(self.teabot).dispatch, {
+            'channel': 'tearoom',
+            'text': '<@U123456> %s' % text,
+            'user': (user or self.user).slack_id
+        })
+
+    def assertNoFullScans(self, statements, allowed=()):
+        """
+        :param allowed: tables the statements may read in full, for queries that return every row by design
+        """
+        self.assertTrue(statements)
+        connection = engine.connect()
+        try:
+            for statement, parameters in statements:
+                plan = [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+                subqueries = set(SUBQUERY_RE.match(step).group(1) for step in plan if SUBQUERY_RE.match(step))
+                scans = [
+                    step for step in plan
+                    if SCAN_RE.match(step) and SCAN_RE.match(step).group(1) not in subqueries | set(allowed)
+                ]
+                self.assertEqual(scans, [], '%s\n%s' % (statement, '\n'.join(plan)))
+        finally:
+            connection.close()
+
+    def test_brew(self):
+        self.assertNoFullScans(self._command('brew 4'))
+
+    def test_me(self):
+        self._command('brew', self.other_user)
+        self.assertNoFullScans(self._command('me'))
+
+    def test_nominate(self):
+        self.assertNoFullScans(self._command('nominate <@%s>' % self.other_user.slack_id))
+
+    def test_leaderboard(self):
+        with unit_of_work():
+            leaderboards.current().load()  # Done once at startup, then served from memory
+            self.assertNoFullScans(self._command('leaderboard'))
+            self.assertNoFullScans(self._command('leaderboard <@%s>' % self.other_user.slack_id))
+
+    def test_stats(self):
+        self.assertNoFullScans(self._command('stats'), allowed=['user'])  # Lists every registered user
+        self.assertNoFullScans(self._command('stats <@%s>' % self.other_user.slack_id))
+        self.assertNoFullScans(self._command('stats today'))
+        self.assertNoFullScans(self._command('stats week'))
+        self.assertNoFullScans(self._command('stats month <@%s>' % self.other_user.slack_id))
+
+    def test_register(self):
+        self.assertNoFullScans(self._command('register oolong'))
+
+    def test_brew_countdown(self):
+        self._command('brew', self.other_user)
+        self._command('me')
+        server_id = self.session.query(Server.id).filter_by(channel='tearoom', completed=False).scalar()
+        self.assertNoFullScans(self._statements(_brew_countdown, server_id))
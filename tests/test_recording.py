@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from src.recording import EventRecorder, read_recording
+
+
+class EventRecorderTestCase(TestCase):
+    def setUp(self):
+        super(EventRecorderTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events.log')
+
+    def tearDown(self):
+        super(EventRecorderTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        recorder = EventRecorder(self.path)
+        with patch('src.recording.time.time', side_effect=[1500000000.0, 1500000002.5]):
+            recorder.record({'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> brew'})
+            recorder.record({'type': 'presence_change'})
+        recorder.close()
+
+        # Restarting appends to the same log
+        recorder = EventRecorder(self.path)
+        with patch('src.recording.time.time', return_value=1500000010.0):
+            recorder.record({'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> me'})
+        recorder.close()
+
+        self.assertEqual(list(read_recording(self.path)), [
+            (
+                1500000000.0,
+                {'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> brew', 'workspace': 'default'}
+            ),
+            (1500000002.5, {'type': 'presence_change', 'workspace': 'default'}),
+            (1500000010.0, {'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> me', 'workspace': 'default'}),
+        ])
+
+    def test_workspace(self):
+        recorder = EventRecorder(self.path)
+        with patch('src.recording.time.time', return_value=1500000000.0):
+            recorder.record({'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> brew', 'workspace': 'T2'})
+        recorder.close()
+        with open(self.path, 'a') as recording:  # Recorded before events carried their workspace
+            recording.write('[1500000001.0,{"type":"hello"}]\n')
+
+        self.assertEqual(list(read_recording(self.path)), [
+            (1500000000.0, {'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> brew', 'workspace': 'T2'}),
+            (1500000001.0, {'type': 'hello', 'workspace': 'default'}),
+        ])
+
+    def test_skips_truncated_line(self):
+        with open(self.path, 'w') as recording:
+            recording.write('[1500000000.0,{"type":"hello"}]\n[1500000001.0,{"type":"mess')
+
+        self.assertEqual(list(read_recording(self.path)), [(1500000000.0, {'type': 'hello', 'workspace': 'default'})])
@@ -0,0 +1,105 @@
+import multiprocessing
+
+from mock import patch
+
+from src.app import Dispatcher
+from src.managers import ServerManager, UserIdentity
+from src.models import Customer, Server, Session, User, engine, unit_of_work
+from src.tasks import complete_brew
+from tests.utils import BaseTestCase
+
+REPLICAS = 4
+
+
+def _join_all(user_ids):
+    for user_id in user_ids:
+        ServerManager.join('tearoom', user_id)
+
+
+def _start_brews(user_ids):
+    for user_id in user_ids:
+        ServerManager.start_brew('tearoom', user_id)
+
+
+def _replica(start, fn, *args):
+    # Forked replicas must not share the parent's database connections
+    Session.remove()
+    engine.dispose()
+    start.wait()
+    with unit_of_work():
+        fn(*args)
+
+
+class ReplicasTestCase(BaseTestCase):
+    """
+    Several processes sharing one database, like replicas of teabot do
+    """
+    def setUp(self):
+        super(ReplicasTestCase, self).setUp()
+        self.teabot = UserIdentity(self._create_user(slack_id='U123456', username='teabot'))
+        self.user = self._create_user(tea_type='green tea')
+        self.post_message_patcher = patch('src.tasks.post_message')
+        self.post_message_patcher.start()
+        self.app_post_message_patcher = patch('src.app.post_message')
+        self.app_post_message_patcher.start()
+
+    def tearDown(self):
+        super(ReplicasTestCase, self).tearDown()
+        self.post_message_patcher.stop()
+        self.app_post_message_patcher.stop()
+
+    def _run_replicas(self, fn, *args):
+        start = multiprocessing.Event()
+        replicas = [multiprocessing.Process(target=_replica, args=(start, fn) + args) for _ in range(REPLICAS)]
+        for replica in replicas:
+            replica.start()
+        start.set()
+        for replica in replicas:
+            replica.join(30)
+            self.assertEqual(replica.exitcode, 0)
+
+    def test_brew_is_completed_once(self):
+        server_id = self._create_server(self.user.id).id
+        self._run_replicas(complete_brew, server_id)
+
+        self.session.expire_all()
+        self.assertTrue(self.session.query(Server).get(server_id).completed)
+        self.assertEqual(
+            self.session.query(User.teas_brewed, User.times_brewed).filter_by(id=self.user.id).one(), (1, 1)
+        )
+
+    def test_event_is_claimed_once(self):
+        event = {'channel': 'tearoom', 'text': '<@U123456> brew', 'user': self.user.slack_id, 'ts': '1500000000.000100'}
+        with patch('src.app.REPLICAS_ENABLED', True), patch('src.app.brew_countdown'):
+            self._run_replicas(lambda: Dispatcher(self.teabot).dispatch(event))
+
+        self.assertEqual(self.session.query(Server).filter_by(channel='tearoom').count(), 1)
+
+    def test_not_understood_is_replied_once(self):
+        replies = multiprocessing.Value('i', 0)
+
+        def post_message(*args):
+            with replies.get_lock():
+                replies.value += 1
+
+        event = {'channel': 'tearoom', 'text': 'hey <@U123456>', 'user': self.user.slack_id, 'ts': '1500000000.000200'}
+        with patch('src.app.REPLICAS_ENABLED', True), patch('src.app.post_message', side_effect=post_message):
+            self._run_replicas(lambda: Dispatcher(self.teabot).dispatch(event))
+
+        self.assertEqual(replies.value, 1)
+
+    def test_joins_respect_limit(self):
+        server_id = self._create_server(self.user.id, limit=4).id
+        user_ids = [self._create_user(tea_type='green tea').id for _ in range(10)]
+        self._run_replicas(_join_all, user_ids)
+
+        customers = self.session.query(Customer.user_id).filter_by(server_id=server_id).all()
+        self.assertEqual(len(customers), 3)
+        self.assertEqual(len(set(customers)), 3)
+        self.assertEqual(self.session.query(Server.customer_count).filter_by(id=server_id).scalar(), 3)
+
+    def test_one_brew_per_channel(self):
+        user_ids = [self._create_user(tea_type='green tea').id for _ in range(5)]
+        self._run_replicas(_start_brews, user_ids)
+
+        self.assertEqual(self.session.query(Server).filter_by(channel='tearoom', completed=False).count(), 1)
@@ -0,0 +1,36 @@
+from unittest import TestCase
+
+from src.metrics import response_cache_requests
+from src.responses import ResponseCache
+
+
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        super(ResponseCacheTestCase, self).setUp()
+        self.cache = ResponseCache(size=2)
+
+    def test_versions(self):
+        hits, misses = response_cache_requests.value(result='hit'), response_cache_requests.value(result='miss')
+        version = self.cache.version('default')
+        self.cache.set('default', 'help', version, ('Help', {}))
+        self.assertEqual(self.cache.get('default', 'help'), ('Help', {}))
+        self.assertIsNone(self.cache.get('T2', 'help'))
+
+        self.cache.bump('T2')
+        self.assertEqual(self.cache.get('default', 'help'), ('Help', {}))
+        self.cache.bump('default')
+        self.assertIsNone(self.cache.get('default', 'help'))
+        self.assertEqual(response_cache_requests.value(result='hit') - hits, 2)
+        self.assertEqual(response_cache_requests.value(result='miss') - misses, 2)
+
+    def test_rendered_before_a_write(self):
+        version = self.cache.version('default')
+        self.cache.bump('default')  # Data changed while the reply was being rendered
+        self.cache.set('default', 'stats', version, ('', {'attachments': []}))
+        self.assertIsNone(self.cache.get('default', 'stats'))
+
+    def test_size(self):
+        for key in ('help', 'stats', 'leaderboard'):
+            self.cache.set('default', key, 0, (key, {}))
+        self.assertIsNone(self.cache.get('default', 'help'))
+        self.assertEqual(self.cache.get('default', 'leaderboard'), ('leaderboard', {}))
@@ -0,0 +1,76 @@
+from datetime import date, datetime
+
+from src.models import Customer, DailyStats, Server, WeeklyStats
+from src.rollups import _insert_missing_rows, get_stats, rebuild_rollups, record_brew, week_start
+from tests.utils import BaseTestCase
+
+
+class RollupsTestCase(BaseTestCase):
+    def setUp(self):
+        super(RollupsTestCase, self).setUp()
+        self.server_user = self._create_user(tea_type='green tea')
+        self.customer = self._create_user(tea_type='mint tea')
+
+    def _record(self, day):
+        record_brew(self.session, self.server_user.id, [self.customer.id], day)
+        self.session.commit()
+
+    def test_week_start(self):
+        self.assertEqual(week_start(date(2026, 10, 18)), date(2026, 10, 12))
+        self.assertEqual(week_start(date(2026, 10, 12)), date(2026, 10, 12))
+
+    def test_record_brew(self):
+        self._record(date(2026, 10, 12))
+        self._record(date(2026, 10, 14))
+        self._record(date(2026, 10, 14))
+
+        self.assertEqual(self.session.query(DailyStats).count(), 4)
+        self.assertEqual(self.session.query(WeeklyStats).count(), 2)
+        weekly = self.session.query(WeeklyStats).filter_by(user_id=self.server_user.id).one()
+        self.assertEqual((weekly.teas_brewed, weekly.teas_drunk, weekly.times_brewed, weekly.teas_received), (6, 3, 3, 0))
+        weekly = self.session.query(WeeklyStats).filter_by(user_id=self.customer.id).one()
+        self.assertEqual((weekly.teas_brewed, weekly.teas_drunk, weekly.times_brewed, weekly.teas_received), (0, 3, 0, 3))
+
+    def test_rows_inserted_by_another_brew(self):
+        self._record(date(2026, 10, 14))
+        row = dict(day=date(2026, 10, 14), user_id=self.server_user.id, teas_drunk=0, teas_brewed=0, times_brewed=0,
+                   teas_received=0)
+        _insert_missing_rows(self.session, DailyStats.__table__, [row])  # Found missing just before the other brew
+        self.session.commit()
+
+        daily = self.session.query(DailyStats).filter_by(user_id=self.server_user.id).one()
+        self.assertEqual((daily.teas_brewed, daily.times_brewed), (2, 1))
+
+    def test_get_stats(self):
+        self._record(date(2026, 9, 30))
+        self._record(date(2026, 10, 2))
+        self._record(date(2026, 10, 14))
+        today = date(2026, 10, 14)
+
+        self.assertEqual(get_stats('today', user_id=self.server_user.id, today=today), [
+            (self.server_user.real_name, {'teas_drunk': 1, 'teas_brewed': 2, 'times_brewed': 1, 'teas_received': 0})
+        ])
+        self.assertEqual(get_stats('week', today=today), [
+            (self.server_user.real_name, {'teas_drunk': 1, 'teas_brewed': 2, 'times_brewed': 1, 'teas_received': 0}),
+            (self.customer.real_name, {'teas_drunk': 1, 'teas_brewed': 0, 'times_brewed': 0, 'teas_received': 1}),
+        ])
+        self.assertEqual(get_stats('month', user_id=self.customer.id, today=today), [
+            (self.customer.real_name, {'teas_drunk': 2, 'teas_brewed': 0, 'times_brewed': 0, 'teas_received': 2})
+        ])
+        self.assertEqual(get_stats('today', today=date(2026, 10, 15)), [])
+
+    def test_rebuild_rollups(self):
+        server = Server(user_id=self.server_user.id, completed=True, created=datetime(2026, 10, 14, 9))
+        self.session.add(server)
+        self.session.add(Server(user_id=self.server_user.id, completed=False))
+        self.session.flush()
+        self.session.add(Customer(user_id=self.customer.id, server_id=server.id))
+        self.session.commit()
+        self._record(date(2026, 10, 14))  # Replaced by the rebuild
+
+        rebuild_rollups()
+        self.session.commit()
+        self.assertEqual(get_stats('week', today=date(2026, 10, 14)), [
+            (self.server_user.real_name, {'teas_drunk': 1, 'teas_brewed': 2, 'times_brewed': 1, 'teas_received': 0}),
+            (self.customer.real_name, {'teas_drunk': 1, 'teas_brewed': 0, 'times_brewed': 0, 'teas_received': 1}),
+        ])
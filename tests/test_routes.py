@@ -1,9 +1,15 @@
-from mock import patch
+import errno
+import socket
+import time
 
-from src.app import Dispatcher
+from mock import Mock, patch
+
+from src.app import Dispatcher, Listener, teabot_identity
 from src.conf import NOMINATION_POINTS_REQUIRED
-from src.managers import ServerManager, CustomerManager
-from src.models import Customer, Server
+from src.managers import ServerManager, CustomerManager, UserIdentity, UserManager
+from src.metrics import command_duration, identity_cache_requests
+from src.models import Customer, Server, Session, User, get_session, unit_of_work
+from src.rollups import record_brew
 from tests.utils import BaseTestCase
 
 
@@ -11,7 +17,7 @@ class DispatcherTestCase(BaseTestCase):
     def setUp(self):
         super(DispatcherTestCase, self).setUp()
         self.tea_bot = self._create_user(slack_id='U123456', username='teabot')
-        self.dispatcher = Dispatcher(self.tea_bot)
+        self.dispatcher = Dispatcher(UserIdentity(self.tea_bot))
         self.registered_user = self._create_user(first_name='Jon', tea_type='green tea')
         self.unregistered_user = self._create_user(first_name='George')
 
@@ -23,70 +29,147 @@ class DispatcherTestCase(BaseTestCase):
         self.patcher.stop()
 
     def test_command_with_column(self):
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> ping',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with('pong', 'tearoom')
 
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456>: ping',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with('pong', 'tearoom')
 
+    def test_read_only_commands_use_cached_identity(self):
+        hits, misses = identity_cache_requests.value(result='hit'), identity_cache_requests.value(result='miss')
+        slack_id = self.registered_user.slack_id
+        with self.assertMaxQueries(1):  # Only the first identity lookup
+            for text in ('<@U123456> ping', '<@U123456> help', '<@U123456> ping'):
+                self.dispatcher.dispatch({'channel': 'tearoom', 'text': text, 'user': slack_id})
+        self.assertEqual(identity_cache_requests.value(result='hit') - hits, 2)
+        self.assertEqual(identity_cache_requests.value(result='miss') - misses, 1)
+
+    def test_read_only_replies_are_cached(self):
+        slack_id = self.registered_user.slack_id
+        self.dispatcher.dispatch({'channel': 'tearoom', 'text': '<@U123456> stats', 'user': slack_id})
+        reply = self.mock_post_message.call_args
+
+        with self.assertMaxQueries(0):
+            self.dispatcher.dispatch({'channel': 'kitchen', 'text': '<@U123456> stats', 'user': slack_id})
+        self.assertEqual(self.mock_post_message.call_args[0][0], reply[0][0])
+        self.assertEqual(self.mock_post_message.call_args[0][1], 'kitchen')
+        self.assertEqual(self.mock_post_message.call_args[1], reply[1])
+
+        # Registering changes the stats
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> register black tea',
+            'user': self.unregistered_user.slack_id
+        })
+        self.dispatcher.dispatch({'channel': 'tearoom', 'text': '<@U123456> stats', 'user': slack_id})
+        self.assertEqual(len(self.mock_post_message.call_args[1]['attachments']), 2)
+
     def test_brew_unregistered(self):
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> brew',
             'user': self.unregistered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with('You need to register first.', 'tearoom')
 
     def test_brew(self):
-        self.assertFalse(ServerManager.has_active_server())
+        self.assertFalse(ServerManager.has_active_server('tearoom'))
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> brew',
                 'user': self.registered_user.slack_id
-            }])
-            mock_brew_countdown.assert_called_with('tearoom')
-            self.assertTrue(ServerManager.has_active_server())
+            })
+            self.assertEqual(mock_brew_countdown.call_args[0][0].channel, 'tearoom')
+            self.assertTrue(ServerManager.has_active_server('tearoom'))
 
     def test_brew_with_active_server(self):
         self._create_server(self.registered_user.id)
-        self.assertTrue(ServerManager.has_active_server())
+        self.assertTrue(ServerManager.has_active_server('tearoom'))
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> brew',
                 'user': self.registered_user.slack_id
-            }])
+            })
             mock_brew_countdown.apply_async.assert_not_called()
             self.mock_post_message.assert_called_with('Someone else is already making tea. Want in?', 'tearoom')
-            self.assertTrue(ServerManager.has_active_server())
+            self.assertTrue(ServerManager.has_active_server('tearoom'))
+
+    def test_brew_started_at_the_same_time(self):
+        self._create_server(self.registered_user.id)
+        with patch('src.app.brew_countdown') as mock_brew_countdown, \
+                patch('src.app.ServerManager.has_active_server', return_value=False):
+            self.dispatcher.dispatch({
+                'channel': 'tearoom',
+                'text': '<@U123456> brew',
+                'user': self.registered_user.slack_id
+            })
+            mock_brew_countdown.assert_not_called()
+            self.mock_post_message.assert_called_with('Someone else is already making tea. Want in?', 'tearoom')
+        self.assertEqual(self.session.query(Server).filter_by(channel='tearoom', completed=False).count(), 1)
+
+    def test_nominate_while_a_brew_starts(self):
+        self.registered_user.nomination_points = NOMINATION_POINTS_REQUIRED
+        nominated_user = self._create_user(tea_type='abc', nomination_points=NOMINATION_POINTS_REQUIRED)
+        self._create_server(self.registered_user.id)
+        with patch('src.app.brew_countdown') as mock_brew_countdown, \
+                patch('src.app.ServerManager.has_active_server', return_value=False):
+            self.dispatcher.dispatch({
+                'channel': 'tearoom',
+                'text': '<@U123456> nominate <@%s>' % nominated_user.slack_id,
+                'user': self.registered_user.slack_id
+            })
+            mock_brew_countdown.assert_not_called()
+            self.mock_post_message.assert_called_with(
+                'Someone else is already making tea, I\'ll save your nomination for later :smile:',
+                'tearoom'
+            )
+        self.assertEqual(self.session.query(Server).filter_by(channel='tearoom', completed=False).count(), 1)
+        self.assertEqual(self.session.query(Customer).count(), 0)
+        self.assertEqual(
+            self.session.query(User.nomination_points).filter_by(id=nominated_user.id).scalar(),
+            NOMINATION_POINTS_REQUIRED
+        )
+
+    def test_brew_in_another_channel(self):
+        self._create_server(self.registered_user.id, channel='kitchen')
+        with patch('src.app.brew_countdown') as mock_brew_countdown:
+            self.dispatcher.dispatch({
+                'channel': 'tearoom',
+                'text': '<@U123456> brew',
+                'user': self.registered_user.slack_id
+            })
+            self.assertEqual(mock_brew_countdown.call_args[0][0].channel, 'tearoom')
+            self.assertTrue(ServerManager.has_active_server('kitchen'))
+            self.assertTrue(ServerManager.has_active_server('tearoom'))
 
     def test_brew_with_limit(self):
         # Brew with bad limit
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> brew 0',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             'That is quite selfish Jon. You have to choose a number greater than 1!',
             'tearoom'
         )
 
         # Brew with non-numerical limit
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> brew abcd',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             'I did not understand what `abcd` means',
             'tearoom'
@@ -94,13 +177,13 @@ class DispatcherTestCase(BaseTestCase):
 
         # Test with a good limit value
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> brew 3',
                 'user': self.registered_user.slack_id
-            }])
-            mock_brew_countdown.assert_called_with('tearoom')
-            self.assertTrue(ServerManager.has_active_server())
+            })
+            self.assertEqual(mock_brew_countdown.call_args[0][0].channel, 'tearoom')
+            self.assertTrue(ServerManager.has_active_server('tearoom'))
             self.assertTrue(
                 self.session.query(Server).filter_by(
                     user_id=self.registered_user.id,
@@ -113,32 +196,62 @@ class DispatcherTestCase(BaseTestCase):
         user = self._create_user(tea_type='mint tea')
         server = self._create_server(user.id)
         self.assertIsNone(CustomerManager.get_for_user_server(self.registered_user.id, server.id))
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> me',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             'Hang tight %s, tea is being served soon' % self.registered_user.display_name,
             'tearoom'
         )
         self.assertIsNotNone(CustomerManager.get_for_user_server(self.registered_user.id, server.id))
 
+    def test_me_twice(self):
+        user = self._create_user(tea_type='mint tea')
+        server_id = self._create_server(user.id).id
+        for _ in range(2):
+            self.dispatcher.dispatch({
+                'channel': 'tearoom',
+                'text': '<@U123456> me',
+                'user': self.registered_user.slack_id
+            })
+        self.mock_post_message.assert_called_with(
+            'You said it once already %s.' % self.registered_user.display_name,
+            'tearoom'
+        )
+        self.assertEqual(self.session.query(Customer).filter_by(server_id=server_id).count(), 1)
+        self.assertEqual(self.session.query(Server.customer_count).filter_by(id=server_id).scalar(), 1)
+
+    def test_me_in_another_channel(self):
+        user = self._create_user(tea_type='mint tea')
+        server = self._create_server(user.id, channel='kitchen')
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> me',
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with(
+            'No one has volunteered to make tea, why dont you make it %s?' % self.registered_user.display_name,
+            'tearoom'
+        )
+        self.assertIsNone(CustomerManager.get_for_user_server(self.registered_user.id, server.id))
+
     def test_me_unregistered(self):
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> me',
             'user': self.unregistered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with('You need to register first.', 'tearoom')
 
     def test_me_without_server(self):
         self.assertEqual(self.session.query(Customer).filter_by(user_id=self.registered_user.id).count(), 0)
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> me',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             'No one has volunteered to make tea, why dont you make it %s?' % self.registered_user.display_name,
             'tearoom'
@@ -148,11 +261,11 @@ class DispatcherTestCase(BaseTestCase):
     def test_me_as_server(self):
         server = self._create_server(self.registered_user.id)
         self.assertIsNone(CustomerManager.get_for_user_server(self.registered_user.id, server.id))
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> me',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             '%s you are making tea! :face_with_rolling_eyes:' % self.registered_user.display_name,
             'tearoom'
@@ -162,11 +275,11 @@ class DispatcherTestCase(BaseTestCase):
     def test_me_with_limit(self):
         user = self._create_user(tea_type='mint tea')
         server = self._create_server(user.id, limit=2)
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> me',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             'Hang tight %s, tea is being served soon' % self.registered_user.display_name,
             'tearoom'
@@ -178,37 +291,51 @@ class DispatcherTestCase(BaseTestCase):
         user2 = self._create_user(tea_type='green tea')
         server = self._create_server(user1.id, limit=2)
 
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> me',
             'user': user2.slack_id
-        }])
+        })
         self.mock_post_message.clear()
 
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> me',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             'I am sorry %s but %s will only brew 2 cups' % (self.registered_user.display_name, user1.display_name),
             'tearoom'
         )
         self.assertIsNone(CustomerManager.get_for_user_server(self.registered_user.id, server.id))
 
+    def test_me_without_limit_not_joined(self):
+        user1 = self._create_user(tea_type='mint tea', first_name='Sam')
+        self._create_server(user1.id)
+        with patch('src.app.ServerManager.join', return_value=None):  # The brew filled up or changed meanwhile
+            self.dispatcher.dispatch({
+                'channel': 'tearoom',
+                'text': '<@U123456> me',
+                'user': self.registered_user.slack_id
+            })
+        self.mock_post_message.assert_called_with(
+            'I am sorry %s but %s will only brew 0 cups' % (self.registered_user.display_name, user1.display_name),
+            'tearoom'
+        )
+
     def test_nominate(self):
         self.registered_user.nomination_points = NOMINATION_POINTS_REQUIRED
         self.registered_user1 = self._create_user(tea_type='abc')
         self.session.flush()
         self.session.commit()
 
-        self.assertFalse(ServerManager.has_active_server())
+        self.assertFalse(ServerManager.has_active_server('tearoom'))
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> nominate <@%s>' % self.registered_user1.slack_id,
                 'user': self.registered_user.slack_id
-            }])
+            })
             self.mock_post_message.assert_any_call(
                 '%s has nominated %s to make tea! Who wants in?' % (
                     self.registered_user.display_name,
@@ -218,11 +345,11 @@ class DispatcherTestCase(BaseTestCase):
                 gif_search_phrase='celebrate'
             )
             self.assertEqual(
-                self.session.query(Server).filter_by(
+                self.session.query(Server.customer_count).filter_by(
                     user_id=self.registered_user1.id,
                     completed=False
-                ).count(),
-                1
+                ).all(),
+                [(1,)]
             )
             self.assertEqual(
                 self.session.query(Customer).filter_by(
@@ -230,20 +357,20 @@ class DispatcherTestCase(BaseTestCase):
                 ).count(),
                 1
             )
-            mock_brew_countdown.assert_called_with('tearoom')
+            self.assertEqual(mock_brew_countdown.call_args[0][0].channel, 'tearoom')
 
     def test_nominate_not_enough_points(self):
         self.registered_user1 = self._create_user(tea_type='abc')
         self.session.flush()
         self.session.commit()
 
-        self.assertFalse(ServerManager.has_active_server())
+        self.assertFalse(ServerManager.has_active_server('tearoom'))
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> nominate <@%s>' % self.registered_user1.slack_id,
                 'user': self.registered_user.slack_id
-            }])
+            })
             self.mock_post_message.assert_any_call(
                 'You can\'t nominate someone unless you brew tea %s times!' % NOMINATION_POINTS_REQUIRED,
                 'tearoom'
@@ -264,13 +391,13 @@ class DispatcherTestCase(BaseTestCase):
             mock_brew_countdown.apply_async.assert_not_called()
 
     def test_nominate_unregistered(self):
-        self.assertFalse(ServerManager.has_active_server())
+        self.assertFalse(ServerManager.has_active_server('tearoom'))
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> nominate <@%s>' % self.registered_user.slack_id,
                 'user': self.unregistered_user.slack_id
-            }])
+            })
             self.mock_post_message.assert_called_with('You need to register first.', 'tearoom')
             self.assertEqual(
                 self.session.query(Server).filter_by(
@@ -291,13 +418,13 @@ class DispatcherTestCase(BaseTestCase):
         self.registered_user1 = self._create_user(tea_type='abc')
         self._create_server(self.registered_user.id)
 
-        self.assertTrue(ServerManager.has_active_server())
+        self.assertTrue(ServerManager.has_active_server('tearoom'))
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> nominate <@%s>' % self.registered_user1.slack_id,
                 'user': self.registered_user.slack_id
-            }])
+            })
             self.mock_post_message.assert_any_call(
                 'Someone else is already making tea, I\'ll save your nomination for later :smile:',
                 'tearoom'
@@ -320,13 +447,13 @@ class DispatcherTestCase(BaseTestCase):
     def test_nominate_no_mention(self):
         self.registered_user1 = self._create_user(tea_type='abc')
 
-        self.assertFalse(ServerManager.has_active_server())
+        self.assertFalse(ServerManager.has_active_server('tearoom'))
         with patch('src.app.brew_countdown') as mock_brew_countdown:
-            self.dispatcher.dispatch([{
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> nominate',
                 'user': self.registered_user.slack_id
-            }])
+            })
             self.mock_post_message.assert_any_call('You must nominate another user to brew!', 'tearoom')
             self.assertEqual(
                 self.session.query(Server).filter_by(
@@ -352,11 +479,11 @@ class DispatcherTestCase(BaseTestCase):
             times_brewed=2
         )
 
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> stats',
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             '',
             'tearoom',
@@ -395,11 +522,11 @@ class DispatcherTestCase(BaseTestCase):
             times_brewed=2
         )
 
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> stats <@%s>' % self.registered_user1.slack_id,
             'user': self.registered_user.slack_id
-        }])
+        })
         self.mock_post_message.assert_called_with(
             '',
             'tearoom',
@@ -418,25 +545,149 @@ class DispatcherTestCase(BaseTestCase):
             ]
         )
 
+    def test_leaderboard(self):
+        user1 = self._create_user(tea_type='abc', teas_brewed=5)
+        user2 = self._create_user(tea_type='abc', teas_brewed=8)
+
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> leaderboard',
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with(
+            '*Teabot Leaderboard*\n\n'
+            '1. _%s_ has brewed *8* cups of tea\n'
+            '2. _%s_ has brewed *5* cups of tea\n'
+            '3. _%s_ has brewed *0* cups of tea\n' % (user2.real_name, user1.real_name, self.registered_user.real_name),
+            'tearoom'
+        )
+
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> leaderboard 1',
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with(
+            '*Teabot Leaderboard*\n\n1. _%s_ has brewed *8* cups of tea\n' % user2.real_name,
+            'tearoom'
+        )
+
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> leaderboard -3',
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with('I did not understand what `-3` means', 'tearoom')
+
+    def test_leaderboard_for_user(self):
+        user1 = self._create_user(tea_type='abc', teas_brewed=5)
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> leaderboard <@%s>' % user1.slack_id,
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with('<@%s> is number *1* on the leaderboard' % user1.slack_id, 'tearoom')
+
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> leaderboard <@%s>' % self.unregistered_user.slack_id,
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with(
+            '<@%s> is not on the leaderboard yet' % self.unregistered_user.slack_id,
+            'tearoom'
+        )
+
+    def test_stats_for_window(self):
+        user1 = self._create_user(tea_type='abc', teas_brewed=5)
+        self._create_user(tea_type='abc', teas_brewed=3)
+        record_brew(self.session, user1.id, [self.registered_user.id])
+        self.session.commit()
+
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> stats week',
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with(
+            '*Stats for this week*',
+            'tearoom',
+            attachments=[
+                {
+                    "fallback": "Teabot Stats",
+                    "pretext": "",
+                    "author_name": "%s" % self.registered_user.real_name,
+                    "fields": [
+                        {
+                            "value": "Number of tea cups consumed -> 1\nNumber of tea cups brewed -> 0\nNumber of times you've brewed tea -> 0\nNumber of tea cups you were served -> 1",
+                            "short": False
+                        },
+                    ]
+                },
+                {
+                    "fallback": "Teabot Stats",
+                    "pretext": "",
+                    "author_name": "%s" % user1.real_name,
+                    "fields": [
+                        {
+                            "value": "Number of tea cups consumed -> 1\nNumber of tea cups brewed -> 2\nNumber of times you've brewed tea -> 1\nNumber of tea cups you were served -> 0",
+                            "short": False
+                        },
+                    ]
+                }
+            ]
+        )
+
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> stats today <@%s>' % self.unregistered_user.slack_id,
+            'user': self.registered_user.slack_id
+        })
+        self.mock_post_message.assert_called_with(
+            '*Stats for today*',
+            'tearoom',
+            attachments=[
+                {
+                    "fallback": "Teabot Stats",
+                    "pretext": "",
+                    "author_name": "%s" % self.unregistered_user.real_name,
+                    "fields": [
+                        {
+                            "value": "Number of tea cups consumed -> 0\nNumber of tea cups brewed -> 0\nNumber of times you've brewed tea -> 0\nNumber of tea cups you were served -> 0",
+                            "short": False
+                        },
+                    ]
+                }
+            ]
+        )
+
     def test_register(self):
         self.assertIsNone(self.unregistered_user.tea_type)
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> register peppermint tea',
             'user': self.unregistered_user.slack_id
-        }])
+        })
 
         self.session.refresh(self.unregistered_user)
         self.assertEqual(self.unregistered_user.tea_type, 'peppermint tea')
         self.mock_post_message.assert_called_with('Welcome to the tea party George', 'tearoom')
 
+    def test_register_invalidates_identity(self):
+        self.dispatcher.dispatch({
+            'channel': 'tearoom',
+            'text': '<@U123456> register peppermint tea',
+            'user': self.unregistered_user.slack_id
+        })
+        self.assertEqual(UserManager.get_identity(self.unregistered_user.slack_id).tea_type, 'peppermint tea')
+
     def test_register_without_tea_type(self):
         self.assertIsNone(self.unregistered_user.tea_type)
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> register',
             'user': self.unregistered_user.slack_id
-        }])
+        })
 
         self.session.refresh(self.unregistered_user)
         self.assertIsNone(self.unregistered_user.tea_type)
@@ -447,40 +698,224 @@ class DispatcherTestCase(BaseTestCase):
 
     def test_register_update_tea_type(self):
         self.assertEqual(self.registered_user.tea_type, 'green tea')
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> register peppermint tea',
             'user': self.registered_user.slack_id
-        }])
+        })
 
         self.session.refresh(self.registered_user)
         self.assertEqual(self.registered_user.tea_type, 'peppermint tea')
         self.mock_post_message.assert_called_with('I have updated your tea preference.', 'tearoom')
 
     def test_did_not_understand(self):
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': '<@U123456> unknown command',
             'user': self.registered_user.slack_id
-        }])
+        })
 
         self.mock_post_message.assert_called_with('I did not understand that. Try `@teabot help`', 'tearoom')
 
-        self.dispatcher.dispatch([{
+        self.dispatcher.dispatch({
             'channel': 'tearoom',
             'text': 'hey <@U123456>',
             'user': self.registered_user.slack_id
-        }])
+        })
 
         self.mock_post_message.assert_called_with('I did not understand that. Try `@teabot help`', 'tearoom')
 
+    def test_command_duration(self):
+        pings = command_duration.count(command='ping', outcome='ok')
+        unknown = command_duration.count(command='unknown', outcome='not_understood')
+        ignored = command_duration.count(command='ping', outcome='ignored')
+
+        self.dispatcher.dispatch({'channel': 'tearoom', 'text': '<@U123456> ping', 'user': self.registered_user.slack_id})
+        self.dispatcher.dispatch({'channel': 'tearoom', 'text': 'hey <@U123456>', 'user': self.registered_user.slack_id})
+        self.dispatcher.dispatch({'channel': 'tearoom', 'text': '<@U999999> ping', 'user': self.registered_user.slack_id})
+
+        self.assertEqual(command_duration.count(command='ping', outcome='ok'), pings + 1)
+        self.assertEqual(command_duration.count(command='unknown', outcome='not_understood'), unknown + 1)
+        self.assertEqual(command_duration.count(command='ping', outcome='ignored'), ignored + 1)
+
     def test_update_users(self):
         with patch('src.app.update_slack_users') as mock_update_slack_users:
-            self.dispatcher.dispatch([{
+            mock_update_slack_users.return_value = {'added': 2, 'updated': 1, 'unchanged': 10}
+            self.dispatcher.dispatch({
                 'channel': 'tearoom',
                 'text': '<@U123456> update_users',
                 'user': self.unregistered_user.slack_id
-            }])
+            })
 
             mock_update_slack_users.assert_called_once_with()
-            self.mock_post_message.assert_called_once_with('I have updated the user registry', 'tearoom')
+            self.mock_post_message.assert_called_once_with(
+                'I have updated the user registry (2 added, 1 updated, 10 unchanged)',
+                'tearoom'
+            )
+
+
+class ListenerTestCase(BaseTestCase):
+    def setUp(self):
+        super(ListenerTestCase, self).setUp()
+        self.teabot = UserIdentity(self._create_user(slack_id='U123456', username='teabot'))
+        self.listener = Listener([self.teabot], workers=0)
+
+    def test_read_events_drains_every_batch(self):
+        with patch('src.app.get_client') as mock_get_client:
+            mock_client = mock_get_client.return_value
+            mock_client.rtm_read.side_effect = [[{'type': 'hello'}, {'type': 'message'}], [{'type': 'message'}], []]
+            self.assertEqual(
+                list(self.listener.read_events('T2')),
+                [{'type': 'hello'}, {'type': 'message'}, {'type': 'message'}]
+            )
+            self.assertEqual(mock_client.rtm_read.call_count, 3)
+            mock_get_client.assert_called_once_with('T2')
+
+    def test_handle_event(self):
+        with patch('src.app.Dispatcher') as mock_dispatcher:
+            self.listener.handle_event({'type': 'presence_change'})
+            mock_dispatcher.assert_not_called()
+
+            event = {'type': 'message', 'text': '<@U123456> ping', 'ts': '%.6f' % (time.time() - 2)}
+            self.listener.handle_event(event)
+            mock_dispatcher.return_value.dispatch.assert_called_once_with(event)
+            self.assertEqual(self.listener.ingest_lag.count, 1)
+            self.assertGreaterEqual(self.listener.ingest_lag.percentile(50), 2)
+
+    def test_handle_event_drops_duplicates(self):
+        event = {'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> me', 'ts': '1500000000.000100'}
+        with patch('src.app.Dispatcher') as mock_dispatcher:
+            self.listener.handle_event(event)
+            self.listener.handle_event(dict(event))
+            mock_dispatcher.return_value.dispatch.assert_called_once_with(event)
+
+    def test_handle_event_with_workers(self):
+        listener = Listener([self.teabot], workers=2)
+        with patch('src.app.Dispatcher') as mock_dispatcher:
+            event = {'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> ping'}
+            listener.handle_event(event)
+            listener.dispatch_pool.join()
+            mock_dispatcher.return_value.dispatch.assert_called_once_with(event)
+        listener.dispatch_pool.shutdown()
+
+    def test_receive_records_events(self):
+        listener = Listener([self.teabot], workers=0, recorder=Mock())
+        with patch('src.app.Dispatcher') as mock_dispatcher:
+            listener.receive({'type': 'presence_change'})
+            listener.receive({'type': 'message', 'channel': 'tearoom', 'text': '<@U123456> ping'})
+
+        self.assertEqual(listener.recorder.record.call_count, 2)
+        self.assertEqual(mock_dispatcher.return_value.dispatch.call_count, 1)
+
+    def test_dispatch_unit_of_work(self):
+        with patch('src.app.post_message'):
+            self.listener.dispatch({'type': 'message', 'text': '<@U123456> ping', 'user': 'U000000'})
+        self.assertFalse(Session.registry.has())
+
+    def test_dispatch_rolls_back_on_error(self):
+        user_id = self.teabot.id
+
+        def dispatch(event):
+            get_session().add(Server(user_id=user_id, channel='tearoom'))
+            raise ValueError()
+
+        with patch('src.app.Dispatcher') as mock_dispatcher:
+            mock_dispatcher.return_value.dispatch.side_effect = dispatch
+            with self.assertRaises(ValueError):
+                self.listener.dispatch({'type': 'message', 'text': '<@U123456> brew'})
+
+        self.assertFalse(Session.registry.has())
+        self.assertFalse(ServerManager.has_active_server('tearoom'))
+
+    def test_dispatch_to_workspace(self):
+        other_teabot = UserIdentity(self._create_user(slack_id='U123456', username='teabot', workspace='T2'))
+        listener = Listener([self.teabot, other_teabot], workers=0)
+        with patch('src.app.Dispatcher') as mock_dispatcher:
+            listener.dispatch({'type': 'message', 'text': '<@U123456> ping', 'workspace': 'T2'})
+            mock_dispatcher.assert_called_once_with(other_teabot)
+
+            listener.dispatch({'type': 'message', 'text': '<@U123456> ping', 'workspace': 'T3'})
+            self.assertEqual(mock_dispatcher.call_count, 1)
+
+    def test_connect_failure_is_retried_with_backoff(self):
+        other_teabot = UserIdentity(self._create_user(slack_id='U123456', username='teabot', workspace='T2'))
+        listener = Listener([self.teabot, other_teabot], workers=0)
+        clients = {'default': Mock(), 'T2': Mock()}
+        clients['default'].rtm_connect.return_value = False
+
+        with patch('src.app.get_client', side_effect=clients.get), patch('src.app.time') as mock_time, \
+                patch('src.app.select.select', return_value=([], [], [])):
+            mock_time.time.return_value = 1000
+            listener.connect()
+            clients['T2'].rtm_connect.assert_called_once_with()
+            self.assertIsNone(clients['default'].server.websocket)
+
+            for now, attempts in ((1000.5, 1), (1001, 2), (1002.5, 2), (1003, 3), (1006.5, 3), (1007, 4)):
+                mock_time.time.return_value = now
+                listener.poll()
+                self.assertEqual(clients['default'].rtm_connect.call_count, attempts)
+
+            clients['default'].rtm_connect.return_value = True
+            mock_time.time.return_value = 1015
+            listener.poll()
+            mock_time.time.return_value = 2000
+            listener.poll()
+            self.assertEqual(clients['default'].rtm_connect.call_count, 5)
+            clients['T2'].rtm_connect.assert_called_once_with()
+
+    def test_connection_error_only_disconnects_its_workspace(self):
+        other_teabot = UserIdentity(self._create_user(slack_id='U123456', username='teabot', workspace='T2'))
+        listener = Listener([self.teabot, other_teabot], workers=0)
+        clients = {'default': Mock(), 'T2': Mock()}
+        websocket = clients['default'].server.websocket
+        clients['default'].rtm_read.side_effect = socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        clients['T2'].rtm_read.side_effect = [[{'type': 'message', 'text': '<@U123456> ping', 'ts': '999.5'}], []]
+
+        with patch('src.app.get_client', side_effect=clients.get), patch('src.app.time') as mock_time, \
+                patch('src.app.Dispatcher') as mock_dispatcher, \
+                patch.object(listener, 'wait_for_events', return_value=['default', 'T2']):
+            mock_time.time.return_value = 1000
+            listener.poll()
+            mock_dispatcher.assert_called_once_with(other_teabot)
+            websocket.shutdown.assert_called_once_with()
+            self.assertIsNone(clients['default'].server.websocket)
+
+            listener.wait_for_events.return_value = []
+            mock_time.time.return_value = 1001
+            listener.poll()
+            clients['default'].rtm_connect.assert_called_once_with()
+            clients['T2'].rtm_connect.assert_not_called()
+
+    def test_workspaces_are_isolated(self):
+        other_teabot = UserIdentity(self._create_user(slack_id='U123456', username='teabot', workspace='T2'))
+        self._create_user(slack_id='U1', username='jon', tea_type='green tea')
+        self._create_user(slack_id='U1', username='jon', tea_type='black tea', workspace='T2')
+        listener = Listener([self.teabot, other_teabot], workers=0)
+
+        with patch('src.app.post_message'), patch('src.app.brew_countdown'):
+            for workspace in ('default', 'T2'):
+                listener.dispatch({
+                    'type': 'message',
+                    'channel': 'tearoom',
+                    'text': '<@U123456> brew',
+                    'user': 'U1',
+                    'workspace': workspace
+                })
+
+        self.assertEqual(
+            sorted(self.session.query(Server.workspace).filter_by(channel='tearoom', completed=False)),
+            [('T2',), ('default',)]
+        )
+
+    def test_teabot_identity(self):
+        with patch('src.app.get_client') as mock_get_client:
+            self.assertEqual(teabot_identity('default').slack_id, 'U123456')
+            mock_get_client.assert_not_called()
+
+            mock_get_client.return_value.api_call.return_value = {'ok': True, 'user_id': 'U654321', 'user': 'teabot'}
+            with unit_of_work('T2'):
+                teabot = teabot_identity('T2')  # Its users are not synced yet
+            mock_get_client.assert_called_once_with('T2')
+            mock_get_client.return_value.api_call.assert_called_once_with('auth.test')
+
+        self.assertEqual((teabot.workspace, teabot.slack_id, teabot.id), ('T2', 'U654321', None))
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+from threading import Event
+from unittest import TestCase
+
+from src.clock import clock
+from src.scheduler import Scheduler
+
+
+class SchedulerTestCase(TestCase):
+    def setUp(self):
+        super(SchedulerTestCase, self).setUp()
+        self.scheduler = Scheduler()
+        self.calls = []
+        self.done = Event()
+
+    def _job(self, name):
+        self.calls.append(name)
+        if name == 'last':
+            self.done.set()
+
+    def test_runs_jobs_in_deadline_order(self):
+        now = datetime.utcnow()
+        self.scheduler.schedule(1, now + timedelta(milliseconds=200), self._job, 'last')
+        self.scheduler.schedule(2, now - timedelta(seconds=5), self._job, 'overdue')
+        self.scheduler.schedule(3, now + timedelta(milliseconds=50), self._job, 'soon')
+
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.calls, ['overdue', 'soon', 'last'])
+        self.assertEqual(self.scheduler.pending(), [])
+
+    def test_cancel(self):
+        now = datetime.utcnow()
+        self.scheduler.schedule(1, now + timedelta(milliseconds=50), self._job, 'cancelled')
+        self.scheduler.schedule(2, now + timedelta(milliseconds=100), self._job, 'last')
+        self.assertEqual(sorted(self.scheduler.pending()), [1, 2])
+
+        self.assertTrue(self.scheduler.cancel(1))
+        self.assertFalse(self.scheduler.cancel(1))
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.calls, ['last'])
+
+    def test_reschedule(self):
+        now = datetime.utcnow()
+        self.scheduler.schedule(1, now + timedelta(seconds=60), self._job, 'late')
+        self.scheduler.schedule(1, now, self._job, 'last')
+
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.calls, ['last'])
+
+    def test_run_pending_with_frozen_clock(self):
+        scheduler = Scheduler(background=False)
+        clock.freeze(datetime(2017, 5, 1, 10))
+        try:
+            scheduler.schedule(1, datetime(2017, 5, 1, 10, 2), self._job, 'brew')
+            scheduler.schedule(2, datetime(2017, 5, 1, 10, 1), self._job, 'cancelled')
+            scheduler.schedule(3, datetime(2017, 5, 1, 10, 5), self._job, 'later')
+            scheduler.cancel(2)
+
+            self.assertEqual(scheduler.run_pending(), 0)
+            clock.freeze(datetime(2017, 5, 1, 10, 2))
+            self.assertEqual(scheduler.run_pending(), 1)
+            self.assertEqual(self.calls, ['brew'])
+            self.assertEqual(scheduler.pending(), [3])
+            self.assertIsNone(scheduler._thread)
+        finally:
+            clock.unfreeze()
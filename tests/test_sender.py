@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+import requests
+from mock import Mock, patch
+
+from src.metrics import slack_messages
+from src.sender import MessageSender, TokenBucket
+
+
+class TokenBucketTestCase(TestCase):
+    @patch('src.sender.time.time', return_value=100)
+    def test_reserve(self, mock_time):
+        bucket = TokenBucket(rate=1, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 1)
+
+        mock_time.return_value = 103
+        self.assertEqual(bucket.reserve(), 0)
+
+
+class MessageSenderTestCase(TestCase):
+    def setUp(self):
+        super(MessageSenderTestCase, self).setUp()
+        self.sender = MessageSender(tokens={'default': 'xoxb-test', 'T2': 'xoxb-other'}, workers=2)
+        self.sender.session = Mock()
+        self.sleep_patcher = patch('src.sender.time.sleep')
+        self.mock_sleep = self.sleep_patcher.start()
+
+    def tearDown(self):
+        super(MessageSenderTestCase, self).tearDown()
+        self.sleep_patcher.stop()
+
+    def test_send(self):
+        self.sender.session.post.return_value = Mock(status_code=200, **{'json.return_value': {'ok': True}})
+        self.sender.send('chat.postMessage', 'tearoom', text='pong', mrkdwn=False, attachments=None)
+        self.sender.join()
+
+        self.sender.session.post.assert_called_once_with(
+            'https://slack.com/api/chat.postMessage',
+            data={'token': 'xoxb-test', 'channel': 'tearoom', 'text': 'pong', 'mrkdwn': 'false'},
+            timeout=10
+        )
+        self.assertEqual(self.sender.stats(), {'queue_depth': 0, 'sent': 1, 'retried': 0, 'failed': 0})
+
+    def test_send_to_workspace(self):
+        self.sender.session.post.return_value = Mock(status_code=200, **{'json.return_value': {'ok': True}})
+        self.sender.send('chat.postMessage', 'tearoom', workspace='T2', text='pong')
+        self.sender.join()
+
+        self.assertEqual(self.sender.session.post.call_args[1]['data']['token'], 'xoxb-other')
+        self.assertEqual(list(self.sender.buckets), [('T2', 'tearoom')])
+
+    def test_retry_after(self):
+        self.sender.session.post.side_effect = [
+            Mock(status_code=429, headers={'Retry-After': '7'}),
+            requests.ConnectionError(),
+            Mock(status_code=200, **{'json.return_value': {'ok': True}}),
+        ]
+        self.sender.send_now('chat.postMessage', 'tearoom', {'text': 'pong'})
+
+        self.mock_sleep.assert_any_call(7.0)
+        self.assertEqual(self.sender.session.post.call_count, 3)
+        self.assertEqual(self.sender.stats(), {'queue_depth': 0, 'sent': 1, 'retried': 2, 'failed': 0})
+
+    def test_give_up(self):
+        self.sender.session.post.return_value = Mock(status_code=429, headers={})
+        failed = slack_messages.value(outcome='failed')
+        self.sender.send_now('chat.postMessage', 'tearoom', {'text': 'pong'})
+
+        self.assertEqual(self.sender.session.post.call_count, 4)
+        self.assertEqual(self.mock_sleep.call_count, 3)  # Not after the last attempt
+        self.assertEqual(self.sender.stats(), {'queue_depth': 0, 'sent': 0, 'retried': 3, 'failed': 1})
+        self.assertEqual(slack_messages.value(outcome='failed'), failed + 1)
+
+    def test_slack_error(self):
+        self.sender.session.post.return_value = Mock(
+            status_code=200, **{'json.return_value': {'ok': False, 'error': 'channel_not_found'}}
+        )
+        self.sender.send_now('chat.postMessage', 'tearoom', {'text': 'pong'})
+
+        self.sender.session.post.assert_called_once()
+        self.assertEqual(self.sender.stats(), {'queue_depth': 0, 'sent': 0, 'retried': 0, 'failed': 1})
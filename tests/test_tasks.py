@@ -1,6 +1,16 @@
+from datetime import datetime, timedelta
+
 from mock import patch
+from sqlalchemy.exc import OperationalError
 
-from src.tasks import _brew_countdown
+from src.conf import BREW_COUNTDOWN
+from src.leaderboard import leaderboards
+from src.models import Server, User, unit_of_work
+from src.responses import response_cache
+from src.tasks import (
+    _brew_countdown, brew_countdown, cancel_brew_countdown, check_leaderboard, complete_brew, prune_event_claims,
+    restore_brew_countdowns, sweep_brews, update_slack_users, warm_up
+)
 from tests.utils import BaseTestCase
 
 
@@ -9,8 +19,8 @@ class TasksTestCase(BaseTestCase):
         super(TasksTestCase, self).setUp()
         self.user = self._create_user(tea_type='green tea')
 
-        self.brew_countdown_patcher = patch('src.tasks.time.sleep')
-        self.brew_countdown_patcher.start()
+        self.scheduler_patcher = patch('src.tasks.scheduler')
+        self.mock_scheduler = self.scheduler_patcher.start()
         self.post_message_patcher = patch('src.tasks.post_message')
         self.mock_post_message = self.post_message_patcher.start()
 
@@ -18,7 +28,7 @@ class TasksTestCase(BaseTestCase):
         server = self._create_server(self.user.id)
         self.assertFalse(server.completed)
 
-        _brew_countdown('tearoom')
+        _brew_countdown(server.id)
         self.session.refresh(server)
         self.assertTrue(server.completed)
         self.assertEqual(self.user.teas_drunk, 1)
@@ -34,7 +44,7 @@ class TasksTestCase(BaseTestCase):
         self._create_customer(user1.id, server.id)
         self.assertFalse(server.completed)
 
-        _brew_countdown('tearoom')
+        _brew_countdown(server.id)
         self.session.refresh(server)
         self.assertTrue(server.completed)
         self.assertEqual(self.user.teas_drunk, 1)
@@ -52,7 +62,186 @@ class TasksTestCase(BaseTestCase):
             'tearoom'
         )
 
+    def test_brew_countdown_with_many_customers(self):
+        server = self._create_server(self.user.id)
+        users = [self._create_user(tea_type='tea %s' % index) for index in range(5)]
+        for user in users:
+            self._create_customer(user.id, server.id)
+
+        _brew_countdown(server.id)
+        self.assertEqual(self.user.teas_brewed, 6)
+        self.assertEqual(self.user.nomination_points, 1)
+        for user in users:
+            self.assertEqual(user.teas_drunk, 1)
+            self.assertEqual(user.teas_received, 1)
+        self.mock_post_message.assert_called_with(
+            '\n'.join(['Time is up!'] + ['%s wants %s' % (user.display_name, user.tea_type) for user in users]),
+            'tearoom'
+        )
+
+    def test_brew_countdown_updates_leaderboard(self):
+        server_id = self._create_server(self.user.id).id
+        self._create_customer(self._create_user(tea_type='green tea').id, server_id)
+        real_name = self.user.real_name
+        with unit_of_work():
+            leaderboards.current().load()
+
+        _brew_countdown(server_id)
+        with unit_of_work():
+            self.assertEqual(leaderboards.current().top(1), [(real_name, 2)])
+            self.assertEqual(leaderboards.current().check(), [])
+
+    def test_brew_countdown_invalidates_replies(self):
+        server = self._create_server(self.user.id)
+        version = response_cache.version('default')
+        _brew_countdown(server.id)
+        self.assertGreater(response_cache.version('default'), version)
+
+    def test_brew_countdown_query_count(self):
+        server = self._create_server(self.user.id)
+        for index in range(10):
+            self._create_customer(self._create_user(tea_type='green tea').id, server.id)
+        server_id = server.id
+
+        # However many customers there are: a read of the brew, the update closing it, a read of its customers and
+        # two bulk updates of their counters, then a read, a bulk insert and two bulk updates for each of the daily
+        # and weekly rollups
+        with self.assertMaxQueries(13) as counter:
+            _brew_countdown(server_id)
+        self.assertEqual(len([statement for statement in counter.statements if statement.startswith('UPDATE')]), 7)
+
+    def test_brew_countdown_completes_its_server(self):
+        kitchen_server = self._create_server(self.user.id, channel='kitchen')
+        server = self._create_server(self._create_user(tea_type='mint tea').id)
+
+        _brew_countdown(server.id)
+        self.session.refresh(server)
+        self.session.refresh(kitchen_server)
+        self.assertTrue(server.completed)
+        self.assertFalse(kitchen_server.completed)
+
+    def test_stale_brew_countdown_keeps_newer_brew(self):
+        old_server_id = self._create_server(self.user.id, completed=True).id
+        server_id = self._create_server(self.user.id).id
+
+        _brew_countdown(old_server_id)
+        self.assertFalse(self.session.query(Server.completed).filter_by(id=server_id).scalar())
+        self.mock_post_message.assert_not_called()
+
+    def test_brew_countdown(self):
+        server = self._create_server(self.user.id, channel='tearoom')
+        self.assertAlmostEqual(
+            (server.deadline - datetime.utcnow()).total_seconds(), BREW_COUNTDOWN, delta=5
+        )
+
+        brew_countdown(server)
+        self.mock_scheduler.schedule.assert_called_once_with(
+            server.id, server.deadline, complete_brew, server.id, 'default'
+        )
+
+        cancel_brew_countdown(server)
+        self.mock_scheduler.cancel.assert_called_once_with(server.id)
+
+    def test_restore_brew_countdowns(self):
+        deadline = datetime.utcnow() - timedelta(seconds=30)
+        server = self._create_server(self.user.id, channel='tearoom', deadline=deadline)
+        self._create_server(self.user.id, completed=True, channel='kitchen')
+
+        restore_brew_countdowns()
+        self.mock_scheduler.schedule.assert_called_once_with(server.id, deadline, complete_brew, server.id, 'default')
+
+    def test_sweep_brews(self):
+        user_id = self.user.id
+        overdue_id = self._create_server(
+            self.user.id, channel='tearoom', deadline=datetime.utcnow() - timedelta(seconds=30)
+        ).id
+        running_id = self._create_server(self.user.id, channel='kitchen', deadline=datetime.utcnow()).id
+
+        sweep_brews()
+        self.assertTrue(self.session.query(Server.completed).filter_by(id=overdue_id).scalar())
+        self.assertFalse(self.session.query(Server.completed).filter_by(id=running_id).scalar())
+        self.assertEqual(self.mock_scheduler.schedule.call_args[0][0], 'brew_sweep')
+
+        sweep_brews()
+        self.assertEqual(self.session.query(User.times_brewed).filter_by(id=user_id).scalar(), 1)
+
+    def test_prune_event_claims_is_rescheduled_after_errors(self):
+        with patch('src.tasks.EventClaimManager.prune', side_effect=OperationalError('DELETE', {}, None)):
+            with self.assertRaises(OperationalError):
+                prune_event_claims()
+        self.assertEqual(self.mock_scheduler.schedule.call_args[0][0], 'event_claim_pruning')
+
+    def test_check_leaderboard_survives_a_failing_workspace(self):
+        with patch.object(leaderboards['T2'], 'check', side_effect=OperationalError('SELECT', {}, None)), \
+                patch.object(leaderboards['default'], 'check', return_value=[self.user.id]), \
+                patch.object(leaderboards['default'], 'load') as mock_load:
+            check_leaderboard()
+
+        mock_load.assert_called_once_with()
+        self.assertEqual(self.mock_scheduler.schedule.call_args[0][0], 'leaderboard_check')
+
+    def _member(self, slack_id, name, real_name):
+        return {'id': slack_id, 'name': name, 'profile': {'real_name': real_name, 'email': '%s@tea.com' % name}}
+
+    def test_update_slack_users(self):
+        members = [self._member('U1', 'george', 'George'), self._member('U2', 'jon', 'Jon')]
+        with patch('src.tasks.get_client') as mock_get_client:
+            mock_get_client.return_value.api_call.return_value = {'ok': True, 'members': members}
+            self.assertEqual(update_slack_users(), {'added': 2, 'updated': 0, 'unchanged': 0})
+
+            members[1] = self._member('U2', 'jon', 'Jon Snow')
+            members.append(self._member('U3', 'sam', 'Sam'))
+            self.assertEqual(update_slack_users(), {'added': 1, 'updated': 1, 'unchanged': 1})
+            self.assertEqual(update_slack_users(), {'added': 0, 'updated': 0, 'unchanged': 3})
+
+        users = self.session.query(User).filter(User.slack_id.in_(['U1', 'U2', 'U3'])).order_by(User.slack_id).all()
+        self.assertEqual(
+            [(user.username, user.real_name, user.email) for user in users],
+            [('george', 'George', 'george@tea.com'), ('jon', 'Jon Snow', 'jon@tea.com'), ('sam', 'Sam', 'sam@tea.com')]
+        )
+
+    def test_update_slack_users_slack_error(self):
+        with patch('src.tasks.get_client') as mock_get_client:
+            mock_get_client.return_value.api_call.return_value = {'ok': False}
+            self.assertIsNone(update_slack_users())
+
+    def test_update_slack_users_per_workspace(self):
+        with patch('src.tasks.get_client') as mock_get_client:
+            mock_get_client.return_value.api_call.return_value = {'ok': True, 'members': [
+                self._member('U1', 'george', 'George')
+            ]}
+            self.assertEqual(update_slack_users(), {'added': 1, 'updated': 0, 'unchanged': 0})
+            with unit_of_work('T2'):
+                self.assertEqual(update_slack_users(), {'added': 1, 'updated': 0, 'unchanged': 0})
+            mock_get_client.assert_called_with('T2')
+
+        self.assertEqual(
+            sorted(self.session.query(User.workspace, User.username).filter_by(slack_id='U1')),
+            [('T2', 'george'), ('default', 'george')]
+        )
+
+    def test_warm_up(self):
+        with patch('src.tasks.get_client') as mock_get_client:
+            mock_get_client.return_value.api_call.side_effect = [
+                IOError(), {'ok': True, 'members': [self._member('U1', 'george', 'George')]}
+            ]
+            warm_up(['T2', 'default'])  # A workspace failing doesn't hold the others back
+
+        self.assertEqual(self.session.query(User.workspace).filter_by(slack_id='U1').all(), [('default',)])
+        with unit_of_work():
+            self.assertTrue(leaderboards.current().loaded)
+        self.assertFalse(leaderboards['T2'].loaded)
+
+    def test_brew_countdown_per_workspace(self):
+        server_id = self._create_server(self.user.id, channel='tearoom').id
+        with unit_of_work('T2'):
+            _brew_countdown(server_id)
+        self.assertFalse(self.session.query(Server.completed).filter_by(id=server_id).scalar())
+
+        _brew_countdown(server_id)
+        self.assertTrue(self.session.query(Server.completed).filter_by(id=server_id).scalar())
+
     def tearDown(self):
         super(TasksTestCase, self).tearDown()
-        self.brew_countdown_patcher.stop()
+        self.scheduler_patcher.stop()
         self.post_message_patcher.stop()
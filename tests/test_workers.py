@@ -0,0 +1,43 @@
+import random
+import time
+from threading import Lock
+from unittest import TestCase
+
+from src.workers import DispatchPool
+
+
+class DispatchPoolTestCase(TestCase):
+    def setUp(self):
+        super(DispatchPoolTestCase, self).setUp()
+        self.handled = []
+        self.lock = Lock()
+
+    def _handler(self, channel, index):
+        time.sleep(random.random() / 1000)
+        with self.lock:
+            self.handled.append((channel, index))
+
+    def test_keeps_order_per_key(self):
+        pool = DispatchPool(self._handler, workers=4, queue_size=10)
+        for index in range(50):
+            for channel in ('kitchen', 'tearoom', 'general'):
+                pool.submit(channel, channel, index)
+        pool.join()
+        pool.shutdown()
+
+        self.assertEqual(len(self.handled), 150)
+        for channel in ('kitchen', 'tearoom', 'general'):
+            self.assertEqual([index for key, index in self.handled if key == channel], list(range(50)))
+
+    def test_handler_errors_do_not_stop_worker(self):
+        def handler(index):
+            if index == 0:
+                raise ValueError()
+            self.handled.append(index)
+
+        pool = DispatchPool(handler, workers=1)
+        pool.submit('tearoom', 0)
+        pool.submit('tearoom', 1)
+        pool.join()
+        pool.shutdown()
+        self.assertEqual(self.handled, [1])
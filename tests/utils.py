@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 
 import uuid
+from contextlib import contextmanager
 from unittest import TestCase
 
+from src.leaderboard import leaderboards
+from src.managers import UserManager
 from src.models import Base, User, get_session, engine, Server, Customer
+from src.profiling import QueryCounter
+from src.responses import response_cache
 
 
 class BaseTestCase(TestCase):
@@ -11,25 +16,44 @@ class BaseTestCase(TestCase):
         super(BaseTestCase, self).setUp()
         Base.metadata.create_all(engine)
         self.session = get_session()
+        leaderboards.clear()
+        UserManager.invalidate()
+        response_cache.clear()
 
     def tearDown(self):
         super(BaseTestCase, self).tearDown()
         self.session.rollback()
         Base.metadata.drop_all(engine)
 
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        """
+        Fail if the block executes more than `budget` SQL statements (on the current thread)
+        """
+        with QueryCounter(engine) as counter:
+            yield counter
+
+        if counter.count > budget:
+            self.fail('%s queries executed, the budget is %s:\n%s' % (counter.count, budget, '\n'.join(counter.statements)))
+
     @classmethod
     def _create_customer(cls, user_id, server_id):
         session = get_session()
         customer = Customer(user_id=user_id, server_id=server_id)
         session.add(customer)
+        session.query(Server).filter_by(id=server_id).update(
+            {Server.customer_count: Server.customer_count + 1}, synchronize_session=False
+        )
         session.flush()
         session.commit()
         return customer
 
     @classmethod
-    def _create_server(cls, user_id, completed=False, limit=None):
+    def _create_server(cls, user_id, completed=False, limit=None, channel='tearoom', deadline=None):
         session = get_session()
-        server = Server(user_id=user_id, completed=completed, limit=limit)
+        server = Server(user_id=user_id, completed=completed, limit=limit, channel=channel)
+        if deadline:
+            server.deadline = deadline
         session.add(server)
         session.flush()
         session.commit()